@@ -6,7 +6,9 @@ Administrative functions for system management
 from fastapi import APIRouter, Depends, HTTPException, status, Query
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
+import httpx
 from typing import Optional
+from datetime import datetime, timezone
 import logging
 
 from app.db.database import get_db
@@ -16,10 +18,15 @@ from app.schemas import (
     SubjectMappingResponse,
     AuditLogResponse,
     SystemStatsResponse,
+    BulkSubmissionCreate,
+    BulkSubmissionProgressResponse,
 )
 from app.services.artifact_service import ArtifactService, SubjectMappingService, AuditService
-from app.services.submission_service import SubmissionService
-from app.services.moodle_client import MoodleClient, MoodleAPIError
+from app.services.submission_queue_service import submission_queue_processor
+from app.services.bulk_submission_service import BulkSubmissionService, bulk_submission_runner
+from app.services.subject_catalog_service import subject_catalog
+from app.services.subject_discovery_service import SubjectDiscoveryService, mapping_refresher
+from app.services.moodle_client import MoodleAPIError, MoodleUnavailableError
 from app.api.routes.auth import get_current_staff
 from app.core.config import settings
 
@@ -90,6 +97,9 @@ async def create_subject_mapping(
     
     await db.commit()
     
+    # Papers with this code may have been cached as unresolvable
+    await SubjectDiscoveryService.invalidate_subject(new_mapping.subject_code)
+    
     return SubjectMappingResponse(
         id=new_mapping.id,
         subject_code=new_mapping.subject_code,
@@ -115,6 +125,8 @@ async def sync_mappings_from_config(
     mapping_service = SubjectMappingService(db)
     created = await mapping_service.sync_from_config()
     await db.commit()
+    if created:
+        await SubjectDiscoveryService.clear_negative_cache()
     
     return {
         "message": f"Synced {created} new mappings from configuration",
@@ -128,9 +140,10 @@ async def discover_assignments_from_moodle(
     current_staff: StaffUser = Depends(get_current_staff)
 ):
     """
-    Discover assignments from Moodle using admin token
+    Rebuild the subject catalog from Moodle using admin token
     
-    This uses the configured admin token to fetch course and assignment information
+    Crawls all courses and assignments, swaps in the new index and creates
+    mappings for uploaded subject codes that have none yet
     """
     if not settings.moodle_admin_token:
         raise HTTPException(
@@ -138,31 +151,60 @@ async def discover_assignments_from_moodle(
             detail="Admin token not configured"
         )
     
-    client = MoodleClient(token=settings.moodle_admin_token)
-    
     try:
-        # Get site info to verify token works
-        site_info = await client.get_site_info()
-        
-        # This is a simplified example - in production you would:
-        # 1. Get all courses the admin can see
-        # 2. For each course, get assignments
-        # 3. Create or update mappings
-        
-        return {
-            "message": "Discovery successful",
-            "site": site_info.get("sitename"),
-            "user": site_info.get("fullname"),
-            "note": "Use the Moodle admin panel to find course and assignment IDs"
-        }
-        
+        result = await subject_catalog.refresh()
+    except MoodleUnavailableError as e:
+        logger.warning(f"Moodle unavailable during subject discovery: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Moodle is temporarily unavailable. Please try again shortly."
+        )
     except MoodleAPIError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Moodle API error: {e.message}"
         )
-    finally:
-        await client.close()
+    except httpx.HTTPError as e:
+        logger.error(f"Subject discovery could not reach Moodle: {e!r}")
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Could not reach Moodle"
+        )
+    
+    return {
+        "message": "Discovery successful",
+        **result
+    }
+
+
+@router.post("/mappings/refresh", status_code=status.HTTP_202_ACCEPTED)
+async def refresh_mappings_from_moodle(
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Re-discover all subject mappings from Moodle in the background
+    
+    Crawls Moodle once, diffs the result against the stored mappings and
+    writes only the changes. Poll GET /admin/mappings/refresh for progress.
+    """
+    if not settings.moodle_admin_token:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Admin token not configured"
+        )
+    
+    logger.info(f"Mapping refresh requested by {current_staff.username}")
+    return mapping_refresher.start(settings.moodle_admin_token)
+
+
+@router.get("/mappings/refresh")
+async def get_mapping_refresh_status(
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Get progress of the current or last mapping refresh
+    """
+    return mapping_refresher.status()
 
 
 @router.delete("/mappings/{mapping_id}")
@@ -187,6 +229,7 @@ async def delete_subject_mapping(
     
     mapping.is_active = False
     await db.commit()
+    await SubjectDiscoveryService.invalidate_subject(mapping.subject_code)
     
     return {"message": f"Mapping {mapping.subject_code} deactivated"}
 
@@ -270,7 +313,7 @@ async def retry_queued_submissions(
     current_staff: StaffUser = Depends(get_current_staff)
 ):
     """
-    Manually trigger retry of queued submissions
+    Manually trigger retry of queued submissions that are due
     """
     if not settings.moodle_admin_token:
         raise HTTPException(
@@ -278,10 +321,8 @@ async def retry_queued_submissions(
             detail="Admin token not configured for queue processing"
         )
     
-    submission_service = SubmissionService(db)
-    result = await submission_service.retry_queued_submissions(settings.moodle_admin_token)
-    
-    return result
+    # Claims rows like the background processor, so the two never overlap
+    return await submission_queue_processor.drain_once()
 
 
 @router.get("/queue/status")
@@ -318,6 +359,124 @@ async def get_queue_status(
     }
 
 
+# ============================================
+# Bulk Submission
+# ============================================
+
+@router.post(
+    "/bulk-submissions",
+    response_model=BulkSubmissionProgressResponse,
+    status_code=status.HTTP_202_ACCEPTED
+)
+async def start_bulk_submission(
+    selection: BulkSubmissionCreate,
+    db: AsyncSession = Depends(get_db),
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Submit every pending paper of a subject and/or exam session on the
+    students' behalf, using the admin token
+    
+    The run continues in the background (and after a restart); poll
+    /admin/bulk-submissions/{run_id} for progress.
+    """
+    if not settings.moodle_admin_token:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Admin token not configured for bulk submission"
+        )
+    if not selection.subject_code and not selection.exam_session:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Select a subject_code and/or exam_session"
+        )
+    
+    bulk_service = BulkSubmissionService(db)
+    run = await bulk_service.create_run(
+        subject_code=selection.subject_code,
+        exam_session=selection.exam_session,
+        created_by=current_staff.username,
+        admin_token=settings.moodle_admin_token
+    )
+    
+    audit_service = AuditService(db)
+    await audit_service.log_action(
+        action="bulk_submission_started",
+        action_category="admin",
+        actor_type="staff",
+        actor_id=str(current_staff.id),
+        actor_username=current_staff.username,
+        description=f"Bulk submission of {run.total_items} papers",
+        request_data=selection.model_dump()
+    )
+    
+    progress = await bulk_service.get_progress(run)
+    await db.commit()
+    
+    # Otherwise a submission_worker.py process picks the run up
+    if run.status == "RUNNING" and settings.submission_worker_embedded:
+        bulk_submission_runner.start(run.id)
+    
+    return progress
+
+
+@router.get("/bulk-submissions", response_model=list[BulkSubmissionProgressResponse])
+async def list_bulk_submissions(
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    List recent bulk submission runs with their progress
+    """
+    bulk_service = BulkSubmissionService(db)
+    return [await bulk_service.get_progress(run) for run in await bulk_service.list_runs(limit)]
+
+
+@router.get("/bulk-submissions/{run_id}", response_model=BulkSubmissionProgressResponse)
+async def get_bulk_submission(
+    run_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Progress, throughput and ETA of a bulk submission run
+    """
+    bulk_service = BulkSubmissionService(db)
+    run = await bulk_service.get_run(run_id)
+    if not run:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Bulk submission run not found"
+        )
+    return await bulk_service.get_progress(run)
+
+
+@router.post("/bulk-submissions/{run_id}/cancel", response_model=BulkSubmissionProgressResponse)
+async def cancel_bulk_submission(
+    run_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Stop a bulk submission run after the papers already in flight
+    """
+    bulk_service = BulkSubmissionService(db)
+    run = await bulk_service.get_run(run_id)
+    if not run:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Bulk submission run not found"
+        )
+    
+    if run.status == "RUNNING":
+        run.status = "CANCELLED"
+        run.finished_at = datetime.now(timezone.utc)
+        await db.commit()
+    
+    return await bulk_service.get_progress(run)
+
+
 # ============================================
 # Artifact Management
 # ============================================
@@ -28,7 +28,7 @@ from app.core.security import (
     token_encryption,
 )
 from app.core.config import settings
-from app.services.moodle_client import MoodleClient, MoodleAPIError
+from app.services.moodle_client import MoodleClient, MoodleAPIError, MoodleUnavailableError
 from app.services.artifact_service import ArtifactService
 
 logger = logging.getLogger(__name__)
@@ -254,6 +254,12 @@ async def student_login(
             pending_submissions=len(pending_papers)
         )
         
+    except MoodleUnavailableError as e:
+        logger.warning(f"Moodle unavailable during login for {credentials.username}: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Moodle is temporarily unavailable. Please try again shortly."
+        )
     except MoodleAPIError as e:
         logger.warning(f"Moodle authentication failed for {credentials.username}: {e}")
         raise HTTPException(
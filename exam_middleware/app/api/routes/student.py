@@ -4,27 +4,32 @@ Handles student dashboard and submission
 """
 
 from fastapi import APIRouter, Depends, HTTPException, status, Request, Query, Header
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import Optional
+from typing import Optional, Tuple
+from urllib.parse import quote
 import logging
 import os
+import aiofiles.os
 
 from app.db.database import get_db
-from app.db.models import StudentSession
+from app.db.models import StudentSession, SubmissionJob, ExaminationArtifact, WorkflowStatus
 from app.schemas import (
     StudentDashboardResponse,
     StudentPendingPaper,
     SubmissionRequest,
-    SubmissionResponse,
+    SubmissionJobResponse,
+    SubmissionBatchResponse,
     ArtifactResponse,
     WorkflowStatusEnum,
 )
-from app.services.artifact_service import ArtifactService, SubjectMappingService, AuditService
-from app.services.submission_service import SubmissionService
+from app.services.artifact_service import ArtifactService, AuditService
+from app.services.submission_job_service import SubmissionJobService, submission_worker
 from app.services.subject_discovery_service import SubjectDiscoveryService
+from app.services.draft_staging_service import draft_stager
 from app.api.routes.auth import get_current_student_session, get_decrypted_token
 from app.core.security import token_encryption
+from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
@@ -54,7 +59,6 @@ async def get_dashboard(
     - User information
     """
     artifact_service = ArtifactService(db)
-    mapping_service = SubjectMappingService(db)
     discovery_service = SubjectDiscoveryService(db)  # For dynamic discovery
     
     # Get user's Moodle token for dynamic discovery
@@ -75,41 +79,41 @@ async def get_dashboard(
         if match:
             register_number = match.group(1)
     
-    # Get pending papers for this student
-    pending_artifacts = await artifact_service.get_pending_for_student(
-        register_number=register_number,
-        moodle_user_id=session.moodle_user_id
+    # Pending and submitted papers in one query
+    pending_artifacts, submitted_artifacts = await artifact_service.get_dashboard_artifacts(
+        register_number=register_number
     )
     
-    # Get submitted papers
-    submitted_artifacts = await artifact_service.get_submitted_for_student(
-        register_number=register_number
+    # Resolve every subject at once: one mapping query for cache misses and
+    # concurrent Moodle discovery only for codes still unknown
+    assignments = await discovery_service.get_assignment_infos(
+        [a.parsed_subject_code for a in pending_artifacts if a.parsed_subject_code],
+        user_token=user_token
     )
     
     # Build pending papers list with subject info
     pending_papers = []
+    stageable_artifacts = []
     for artifact in pending_artifacts:
-        # Get subject mapping for additional info
-        mapping = None
-        if artifact.parsed_subject_code:
-            mapping = await mapping_service.get_mapping(artifact.parsed_subject_code)
-        
-        # Check if we have a valid assignment mapping (now with dynamic discovery!)
-        assignment_id = await discovery_service.get_assignment_id(
-            artifact.parsed_subject_code,
-            user_token=user_token
-        ) if artifact.parsed_subject_code else None
+        info = assignments.get((artifact.parsed_subject_code or "").upper().strip())
+        assignment_id = info.get("assignment_id") if info else None
         
         pending_papers.append(StudentPendingPaper(
             artifact_uuid=str(artifact.artifact_uuid),
             subject_code=artifact.parsed_subject_code or "Unknown",
-            subject_name=mapping.subject_name if mapping else None,
-            assignment_name=mapping.moodle_assignment_name if mapping else None,
+            subject_name=info.get("subject_name") if info else None,
+            assignment_name=info.get("assignment_name") if info else None,
             filename=artifact.original_filename,
             uploaded_at=artifact.uploaded_at,
             can_submit=assignment_id is not None,
             message=None if assignment_id else "Assignment mapping not found. Contact admin."
         ))
+        if assignment_id:
+            stageable_artifacts.append(artifact)
+    
+    # Start uploading submittable papers to the draft area so submit is fast
+    if user_token and stageable_artifacts:
+        draft_stager.schedule(stageable_artifacts, user_token, session.moodle_user_id)
     
     # Build submitted papers list
     submitted_papers = [
@@ -196,16 +200,100 @@ async def get_paper_details(
     }
 
 
+def _x_accel_uri(file_path: str) -> Optional[str]:
+    """
+    Map a stored file to nginx's internal location
+    
+    Returns None for files outside the upload directory, which are then
+    served by the app as before.
+    """
+    upload_root = os.path.abspath(settings.upload_dir)
+    absolute = os.path.abspath(file_path)
+    if os.path.commonpath([upload_root, absolute]) != upload_root:
+        return None
+    
+    relative = os.path.relpath(absolute, upload_root).replace(os.sep, "/")
+    return settings.x_accel_redirect_prefix.rstrip("/") + "/" + quote(relative)
+
+
+def _content_disposition(filename: str) -> str:
+    """Content-Disposition header matching what FileResponse sends"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against our ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def _parse_byte_range(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single "bytes=" range into inclusive (start, end) offsets
+    
+    Returns None for headers that should be ignored (malformed, other units
+    or multiple ranges), in which case the full file is sent. The caller
+    answers 416 when start lies beyond the end of the file.
+    """
+    units, _, spec = range_header.partition("=")
+    if units.strip().lower() != "bytes" or "," in spec:
+        return None
+    
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            return max(file_size - length, 0) if length else file_size, file_size - 1
+        start = int(first)
+        end = min(int(last), file_size - 1) if last else file_size - 1
+    except ValueError:
+        return None
+    
+    if start < 0 or (last and int(last) < start):
+        return None
+    return start, end
+
+
+async def _iter_file_range(file_path: str, offset: int, length: int):
+    """Stream part of a file in upload-sized chunks"""
+    async with aiofiles.open(file_path, 'rb') as f:
+        await f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            chunk = await f.read(min(settings.upload_chunk_size_bytes, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
 @router.get("/paper/{artifact_uuid}/view")
 async def view_paper_file(
     artifact_uuid: str,
+    request: Request,
     session: StudentSession = Depends(get_session_from_header),
     db: AsyncSession = Depends(get_db)
 ):
     """
     View/download the actual paper file
     
-    Returns the file for display in the browser
+    Returns the file for display in the browser. With X_ACCEL_REDIRECT_ENABLED
+    the app only authorises the request and nginx sends the bytes.
+    
+    Responses carry a strong ETag derived from the stored SHA-256, so
+    re-views are answered with 304 Not Modified, and single byte ranges are
+    served as 206 Partial Content for PDF viewers that seek.
     """
     artifact_service = ArtifactService(db)
     artifact = await artifact_service.get_by_uuid(artifact_uuid)
@@ -223,90 +311,179 @@ async def view_paper_file(
             detail="You can only view your own papers"
         )
     
+    # Determine media type
+    media_type = artifact.mime_type or "application/pdf"
+    etag = f'"{artifact.file_hash}"'
+    cache_headers = {
+        "ETag": etag,
+        # Always revalidate - a matching ETag costs a 304 and no file access
+        "Cache-Control": "private, no-cache",
+    }
+    
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+    
+    # Offload mode: nginx streams the file with sendfile (and handles Range)
+    if settings.x_accel_redirect_enabled:
+        internal_uri = _x_accel_uri(artifact.file_blob_path)
+        if internal_uri:
+            return Response(
+                media_type=media_type,
+                headers={
+                    "X-Accel-Redirect": internal_uri,
+                    "Content-Disposition": _content_disposition(artifact.original_filename),
+                    "Cache-Control": cache_headers["Cache-Control"],
+                }
+            )
+    
     # Check if file exists
-    if not os.path.exists(artifact.file_blob_path):
+    try:
+        file_size = (await aiofiles.os.stat(artifact.file_blob_path)).st_size
+    except FileNotFoundError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="File not found on server"
         )
     
-    # Determine media type
-    media_type = artifact.mime_type or "application/pdf"
+    headers = {
+        **cache_headers,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": _content_disposition(artifact.original_filename),
+    }
+    
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    byte_range = None
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = _parse_byte_range(range_header, file_size)
+    
+    if byte_range:
+        start, end = byte_range
+        if start >= file_size or start > end:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={**headers, "Content-Range": f"bytes */{file_size}"}
+            )
+        
+        return StreamingResponse(
+            _iter_file_range(artifact.file_blob_path, start, end - start + 1),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type=media_type,
+            headers={
+                **headers,
+                "Content-Range": f"bytes {start}-{end}/{file_size}",
+                "Content-Length": str(end - start + 1),
+            }
+        )
     
     return FileResponse(
         path=artifact.file_blob_path,
         media_type=media_type,
-        filename=artifact.original_filename
+        headers=headers
     )
 
 
-@router.post("/submit/{artifact_uuid}", response_model=SubmissionResponse)
-async def submit_paper_by_uuid(
-    artifact_uuid: str,
-    request: Request,
-    session: StudentSession = Depends(get_session_from_header),
-    db: AsyncSession = Depends(get_db)
-):
-    """
-    Submit a paper to Moodle by artifact UUID (simplified endpoint)
-    """
+def _register_number_for(session: StudentSession) -> str:
+    """Extract register number from fullname (format: "Name 212222020029")"""
     import re
     
-    # Extract register number from fullname (format: "Name 212222020029")
     register_number = session.moodle_username  # fallback
     if session.moodle_fullname:
         match = re.search(r'\b(\d{12})\b', session.moodle_fullname)
         if match:
             register_number = match.group(1)
+    return register_number
+
+
+def _job_response(job: SubmissionJob, artifact) -> SubmissionJobResponse:
+    return SubmissionJobResponse(
+        job_id=str(job.job_uuid),
+        artifact_uuid=str(artifact.artifact_uuid),
+        status=job.status,
+        message=job.message,
+        workflow_status=WorkflowStatusEnum(artifact.workflow_status.value),
+        moodle_submission_id=artifact.moodle_submission_id,
+        submitted_at=artifact.submit_timestamp,
+        created_at=job.created_at,
+        finished_at=job.finished_at,
+        poll_url=f"/student/submit/jobs/{job.job_uuid}"
+    )
+
+
+async def _enqueue_submission(
+    artifact_uuid: str,
+    request: Request,
+    session: StudentSession,
+    db: AsyncSession
+) -> SubmissionJobResponse:
+    """
+    Validate a submission and hand it to the background workers
+    
+    The checks here are the cheap, local ones from SubmissionService so the
+    student gets an immediate error; the worker repeats them before talking
+    to Moodle.
+    """
+    register_number = _register_number_for(session)
     
-    # Get the decrypted Moodle token
-    moodle_token = get_decrypted_token(session)
+    artifact_service = ArtifactService(db)
+    artifact = await artifact_service.get_by_uuid(artifact_uuid)
+    if not artifact:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Artifact not found"
+        )
+    
+    if artifact.parsed_reg_no != register_number:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="You can only submit your own papers"
+        )
     
-    # Create submission service
-    submission_service = SubmissionService(db)
+    if artifact.workflow_status in [WorkflowStatus.COMPLETED, WorkflowStatus.SUBMITTED_TO_LMS]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="This paper has already been submitted"
+        )
     
-    # Execute submission
-    success, message, result = await submission_service.submit_artifact(
-        artifact_uuid=artifact_uuid,
-        moodle_token=moodle_token,
+    job = await SubmissionJobService(db).enqueue(
+        artifact,
+        moodle_token=get_decrypted_token(session),
         moodle_user_id=session.moodle_user_id,
         moodle_username=session.moodle_username,
         register_number=register_number,
         actor_ip=request.client.host if request.client else None,
         lock_submission=True
     )
-    
     await db.commit()
+    submission_worker.notify()
     
-    if not success:
-        if result and result.get("queued"):
-            return SubmissionResponse(
-                success=False,
-                message=message,
-                artifact_uuid=artifact_uuid,
-                workflow_status=WorkflowStatusEnum.QUEUED
-            )
-        
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=message
-        )
-    
-    # Get updated artifact for response
-    artifact_service = ArtifactService(db)
-    artifact = await artifact_service.get_by_uuid(artifact_uuid)
+    return _job_response(job, artifact)
+
+
+@router.post(
+    "/submit/{artifact_uuid}",
+    response_model=SubmissionJobResponse,
+    status_code=status.HTTP_202_ACCEPTED
+)
+async def submit_paper_by_uuid(
+    artifact_uuid: str,
+    request: Request,
+    session: StudentSession = Depends(get_session_from_header),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Submit a paper to Moodle by artifact UUID (simplified endpoint)
     
-    return SubmissionResponse(
-        success=True,
-        message=message,
-        artifact_uuid=artifact_uuid,
-        workflow_status=WorkflowStatusEnum(artifact.workflow_status.value),
-        moodle_submission_id=artifact.moodle_submission_id,
-        submitted_at=artifact.submit_timestamp
-    )
+    Returns 202 with a job id; poll /student/submit/jobs/{job_id} for the result.
+    """
+    return await _enqueue_submission(artifact_uuid, request, session, db)
 
 
-@router.post("/submit", response_model=SubmissionResponse)
+@router.post(
+    "/submit",
+    response_model=SubmissionJobResponse,
+    status_code=status.HTTP_202_ACCEPTED
+)
 async def submit_paper(
     submission: SubmissionRequest,
     request: Request,
@@ -318,72 +495,84 @@ async def submit_paper(
     
     This is the main submission endpoint that:
     1. Validates the student owns the paper
-    2. Uploads the file to Moodle draft area
-    3. Links the file to the assignment
-    4. Finalizes the submission
+    2. Queues a submission job and returns 202 with its id
     
-    The submission is atomic - if any step fails, the operation can be retried.
+    A background worker then uploads the file to the Moodle draft area,
+    links it to the assignment and finalizes the submission. Poll
+    /student/submit/jobs/{job_id} for the outcome.
     """
-    import re
-    
     if not submission.confirm_submission:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="You must confirm the submission"
         )
     
-    # Extract register number from fullname (format: "Name 212222020029")
-    register_number = session.moodle_username  # fallback
-    if session.moodle_fullname:
-        match = re.search(r'\b(\d{12})\b', session.moodle_fullname)
-        if match:
-            register_number = match.group(1)
+    return await _enqueue_submission(submission.artifact_uuid, request, session, db)
+
+
+@router.get("/submit/jobs/{job_id}", response_model=SubmissionJobResponse)
+async def get_submission_job(
+    job_id: str,
+    session: StudentSession = Depends(get_session_from_header),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Get the state of a submission job
+    """
+    job = await SubmissionJobService(db).get_by_uuid(job_id)
+    if not job or job.moodle_user_id != session.moodle_user_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Submission job not found"
+        )
+    
+    artifact = await db.get(ExaminationArtifact, job.artifact_id)
+    return _job_response(job, artifact)
+
+
+@router.post(
+    "/submit-all",
+    response_model=SubmissionBatchResponse,
+    status_code=status.HTTP_202_ACCEPTED
+)
+async def submit_all_papers(
+    request: Request,
+    session: StudentSession = Depends(get_session_from_header),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Submit every pending paper of the student in one request
     
-    # Get the decrypted Moodle token
-    moodle_token = get_decrypted_token(session)
+    Queues one submission job per paper with a single insert and returns
+    202 with the jobs; papers that already have a job in progress report
+    that job. Poll /student/submit/jobs/{job_id} for each outcome.
+    """
+    register_number = _register_number_for(session)
     
-    # Create submission service
-    submission_service = SubmissionService(db)
+    pending = await ArtifactService(db).get_pending_for_student(
+        register_number=register_number,
+        moodle_user_id=session.moodle_user_id
+    )
+    # Same cheap checks as single submit; the worker repeats them
+    artifacts = [artifact for artifact in pending if artifact.parsed_reg_no == register_number]
     
-    # Execute submission
-    success, message, result = await submission_service.submit_artifact(
-        artifact_uuid=submission.artifact_uuid,
-        moodle_token=moodle_token,
+    jobs = await SubmissionJobService(db).enqueue_many(
+        artifacts,
+        moodle_token=get_decrypted_token(session),
         moodle_user_id=session.moodle_user_id,
         moodle_username=session.moodle_username,
         register_number=register_number,
         actor_ip=request.client.host if request.client else None,
         lock_submission=True
     )
-    
     await db.commit()
+    if jobs:
+        submission_worker.notify()
     
-    if not success:
-        # Check if it was queued
-        if result and result.get("queued"):
-            return SubmissionResponse(
-                success=False,
-                message=message,
-                artifact_uuid=submission.artifact_uuid,
-                workflow_status=WorkflowStatusEnum.QUEUED
-            )
-        
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=message
-        )
-    
-    # Get updated artifact for response
-    artifact_service = ArtifactService(db)
-    artifact = await artifact_service.get_by_uuid(submission.artifact_uuid)
-    
-    return SubmissionResponse(
-        success=True,
-        message=message,
-        artifact_uuid=submission.artifact_uuid,
-        workflow_status=WorkflowStatusEnum(artifact.workflow_status.value),
-        moodle_submission_id=artifact.moodle_submission_id,
-        submitted_at=artifact.submit_timestamp
+    artifacts_by_id = {artifact.id: artifact for artifact in artifacts}
+    return SubmissionBatchResponse(
+        total=len(jobs),
+        jobs=[_job_response(job, artifacts_by_id[job.artifact_id]) for job in jobs]
     )
 
 
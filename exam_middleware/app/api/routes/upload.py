@@ -3,20 +3,23 @@ Upload API Routes
 Handles file uploads from staff
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Request
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Request, Header
 from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 import logging
 
 from app.db.database import get_db
-from app.db.models import StaffUser
+from app.db.models import StaffUser, ExaminationArtifact
 from app.schemas import (
     FileUploadResponse,
     BulkUploadResponse,
+    UploadSessionCreate,
+    UploadSessionResponse,
     ErrorResponse,
 )
 from app.services.file_processor import file_processor
+from app.services.upload_session_service import upload_session_service, UploadSessionError
 from app.services.artifact_service import ArtifactService, AuditService
 from app.api.routes.auth import get_current_staff
 
@@ -25,6 +28,183 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
+async def _discard_unreferenced_blobs(
+    artifact_service: ArtifactService,
+    stored_files: Dict[str, str]
+) -> None:
+    """
+    Delete stored blobs that no artifact references
+    
+    Blobs are content-addressed and may be shared with other artifacts,
+    so a file is only removed once its reference count is zero. Callers
+    pass only blobs their own request wrote; the count is re-checked under
+    the exclusive blob lock so a concurrent upload that reuses the blob and
+    has not committed yet keeps it.
+    
+    Args:
+        artifact_service: Service bound to the current session
+        stored_files: Mapping of file_hash -> file_path
+    """
+    if not stored_files:
+        return
+    await artifact_service.lock_blobs(list(stored_files), exclusive=True)
+    counts = await artifact_service.get_blob_reference_counts(list(stored_files))
+    for file_hash, file_path in stored_files.items():
+        if counts.get(file_hash, 0) == 0:
+            await file_processor.delete_file(file_path)
+
+
+def _upload_response(
+    artifact: ExaminationArtifact,
+    duplicate: bool,
+    filename: Optional[str] = None
+) -> FileUploadResponse:
+    """Successful upload result; duplicates point at the artifact that was kept"""
+    return FileUploadResponse(
+        success=True,
+        message="Paper already uploaded, existing file kept" if duplicate else "File uploaded successfully",
+        filename=filename,
+        artifact_uuid=str(artifact.artifact_uuid),
+        parsed_register_number=artifact.parsed_reg_no,
+        parsed_subject_code=artifact.parsed_subject_code,
+        workflow_status=artifact.workflow_status.value,
+        duplicate=duplicate
+    )
+
+
+async def _create_artifacts_batch(
+    db: AsyncSession,
+    artifact_service: ArtifactService,
+    accepted: List[Tuple[str, Dict[str, Any]]],
+    uploaded_by_staff_id: int
+) -> List[FileUploadResponse]:
+    """
+    Create artifact rows for a batch of stored files in one round-trip
+    
+    On failure the batch is rolled back and its unreferenced blobs are
+    removed. Committing is left to the caller.
+    
+    Args:
+        db: Current session
+        artifact_service: Service bound to the session
+        accepted: List of (filename, ingest metadata) pairs
+        uploaded_by_staff_id: Staff member performing the upload
+        
+    Returns:
+        One FileUploadResponse per accepted file, in input order
+    """
+    try:
+        created = await artifact_service.create_artifacts_bulk(
+            [
+                {
+                    "raw_filename": filename,
+                    "original_filename": metadata.get("original_filename", filename),
+                    "file_blob_path": metadata["file_path"],
+                    "file_hash": metadata["hash"],
+                    "parsed_reg_no": metadata.get("parsed_register_no"),
+                    "parsed_subject_code": metadata.get("parsed_subject_code"),
+                    "file_size_bytes": metadata.get("size_bytes"),
+                    "mime_type": metadata.get("mime_type"),
+                }
+                for filename, metadata in accepted
+            ],
+            uploaded_by_staff_id=uploaded_by_staff_id
+        )
+    except Exception as e:
+        logger.error(f"Failed to create artifacts for batch: {e}")
+        await db.rollback()
+        
+        await _discard_unreferenced_blobs(artifact_service, {
+            metadata["hash"]: metadata["file_path"]
+            for _, metadata in accepted
+            if not metadata.get("deduplicated")
+        })
+        
+        return [
+            FileUploadResponse(
+                success=False,
+                message=f"Failed to process: {str(e)}",
+                filename=filename,
+                errors=[str(e)]
+            )
+            for filename, _ in accepted
+        ]
+    
+    # Duplicates resolve to an existing artifact; drop new blobs
+    # that ended up unreferenced
+    await _discard_unreferenced_blobs(artifact_service, {
+        metadata["hash"]: metadata["file_path"]
+        for (_, metadata), (artifact, _) in zip(accepted, created)
+        if artifact.file_blob_path != metadata["file_path"] and not metadata.get("deduplicated")
+    })
+    
+    return [
+        _upload_response(artifact, duplicate, filename)
+        for (filename, _), (artifact, duplicate) in zip(accepted, created)
+    ]
+
+
+async def _store_archive(
+    db: AsyncSession,
+    fileobj: Any,
+    archive_name: str,
+    uploaded_by_staff_id: int
+) -> List[FileUploadResponse]:
+    """
+    Ingest every member of an archive, committing artifacts batch by batch
+    
+    Args:
+        db: Current session
+        fileobj: Seekable binary file holding the archive
+        archive_name: Archive filename (for error reporting)
+        uploaded_by_staff_id: Staff member performing the upload
+        
+    Returns:
+        One FileUploadResponse per archive member
+        
+    Raises:
+        HTTPException: 400 if the file is not a readable archive
+    """
+    artifact_service = ArtifactService(db)
+    results: List[FileUploadResponse] = []
+    
+    try:
+        async for batch in file_processor.ingest_archive(fileobj):
+            accepted = []
+            for filename, is_valid, message, metadata in batch:
+                if is_valid:
+                    accepted.append((filename, metadata))
+                else:
+                    results.append(FileUploadResponse(
+                        success=False,
+                        message=message,
+                        filename=filename,
+                        errors=[message]
+                    ))
+            
+            if accepted:
+                results.extend(await _create_artifacts_batch(
+                    db, artifact_service, accepted, uploaded_by_staff_id
+                ))
+                await db.commit()
+    except ValueError as e:
+        logger.warning(f"Archive upload rejected: {e}")
+        if not results:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
+        # Keep what was stored before the archive turned out to be truncated
+        results.append(FileUploadResponse(
+            success=False,
+            message=str(e),
+            filename=archive_name,
+            errors=[str(e)]
+        ))
+    
+    return results
+
+
 @router.post("/single", response_model=FileUploadResponse)
 async def upload_single_file(
     file: UploadFile = File(...),
@@ -50,26 +230,10 @@ async def upload_single_file(
             detail="Filename is required"
         )
     
-    # Read file content
-    content = await file.read()
-    
-    # Validate file
-    is_valid, message, metadata = file_processor.validate_file(content, file.filename)
-    
-    if not is_valid:
-        logger.warning(f"File validation failed: {message}")
-        return FileUploadResponse(
-            success=False,
-            message=message,
-            errors=[message]
-        )
-    
-    # Save file
+    # Stream to disk: validate, hash and store in a single pass
     try:
-        file_path, file_hash = await file_processor.save_file(
-            file_content=content,
-            original_filename=file.filename,
-            subfolder="pending"
+        is_valid, message, metadata = await file_processor.ingest_stream(
+            file, file.filename
         )
     except Exception as e:
         logger.error(f"Failed to save file: {e}")
@@ -79,12 +243,23 @@ async def upload_single_file(
             errors=[str(e)]
         )
     
+    if not is_valid:
+        logger.warning(f"File validation failed: {message}")
+        return FileUploadResponse(
+            success=False,
+            message=message,
+            errors=[message]
+        )
+    
+    file_path = metadata["file_path"]
+    file_hash = metadata["hash"]
+    
     # Create artifact record
     artifact_service = ArtifactService(db)
     audit_service = AuditService(db)
     
     try:
-        artifact = await artifact_service.create_artifact(
+        artifact, duplicate = await artifact_service.create_artifact(
             raw_filename=file.filename,
             original_filename=metadata.get("original_filename", file.filename),
             file_blob_path=file_path,
@@ -109,23 +284,20 @@ async def upload_single_file(
             request_data={"filename": file.filename, "size": metadata.get("size_bytes")}
         )
         
+        if duplicate and artifact.file_blob_path != file_path and not metadata.get("deduplicated"):
+            await _discard_unreferenced_blobs(artifact_service, {file_hash: file_path})
+        
         await db.commit()
         
-        return FileUploadResponse(
-            success=True,
-            message="File uploaded successfully",
-            artifact_uuid=str(artifact.artifact_uuid),
-            parsed_register_number=artifact.parsed_reg_no,
-            parsed_subject_code=artifact.parsed_subject_code,
-            workflow_status=artifact.workflow_status.value
-        )
+        return _upload_response(artifact, duplicate)
         
     except Exception as e:
         logger.error(f"Failed to create artifact: {e}")
         await db.rollback()
         
-        # Clean up the saved file
-        await file_processor.delete_file(file_path)
+        # Clean up the saved file unless another artifact shares the blob
+        if not metadata.get("deduplicated"):
+            await _discard_unreferenced_blobs(artifact_service, {file_hash: file_path})
         
         return FileUploadResponse(
             success=False,
@@ -145,76 +317,50 @@ async def upload_bulk_files(
     Upload multiple examination papers at once
     
     Each file should follow the pattern: REGISTER_SUBJECT.pdf
+    
+    Files are validated and written concurrently (BULK_UPLOAD_CONCURRENCY),
+    then all artifact rows are created with a single batched insert.
     """
-    results = []
-    successful = 0
-    failed = 0
+    results: List[Optional[FileUploadResponse]] = [None] * len(files)
     
-    for file in files:
+    named = [(i, file) for i, file in enumerate(files) if file.filename]
+    for i, file in enumerate(files):
         if not file.filename:
-            results.append(FileUploadResponse(
+            results[i] = FileUploadResponse(
                 success=False,
                 message="Filename is required",
                 errors=["Missing filename"]
-            ))
-            failed += 1
-            continue
-        
-        # Read file content
-        content = await file.read()
-        
-        # Validate file
-        is_valid, message, metadata = file_processor.validate_file(content, file.filename)
-        
+            )
+    
+    # Stage 1: validate, hash and store files in parallel
+    ingested = await file_processor.ingest_many(
+        [(file, file.filename) for _, file in named]
+    )
+    
+    accepted = []
+    for (i, file), (is_valid, message, metadata) in zip(named, ingested):
         if not is_valid:
-            results.append(FileUploadResponse(
+            results[i] = FileUploadResponse(
                 success=False,
                 message=message,
                 errors=[message]
-            ))
-            failed += 1
-            continue
-        
-        # Save file
-        try:
-            file_path, file_hash = await file_processor.save_file(
-                file_content=content,
-                original_filename=file.filename,
-                subfolder="pending"
-            )
-            
-            # Create artifact
-            artifact_service = ArtifactService(db)
-            artifact = await artifact_service.create_artifact(
-                raw_filename=file.filename,
-                original_filename=metadata.get("original_filename", file.filename),
-                file_blob_path=file_path,
-                file_hash=file_hash,
-                parsed_reg_no=metadata.get("parsed_register_no"),
-                parsed_subject_code=metadata.get("parsed_subject_code"),
-                file_size_bytes=metadata.get("size_bytes"),
-                mime_type=metadata.get("mime_type"),
-                uploaded_by_staff_id=current_staff.id
             )
-            
-            results.append(FileUploadResponse(
-                success=True,
-                message="File uploaded successfully",
-                artifact_uuid=str(artifact.artifact_uuid),
-                parsed_register_number=artifact.parsed_reg_no,
-                parsed_subject_code=artifact.parsed_subject_code,
-                workflow_status=artifact.workflow_status.value
-            ))
-            successful += 1
-            
-        except Exception as e:
-            logger.error(f"Failed to process file {file.filename}: {e}")
-            results.append(FileUploadResponse(
-                success=False,
-                message=f"Failed to process: {str(e)}",
-                errors=[str(e)]
-            ))
-            failed += 1
+            continue
+        accepted.append((i, file, metadata))
+    
+    # Stage 2: create every artifact row in one round-trip
+    if accepted:
+        responses = await _create_artifacts_batch(
+            db,
+            ArtifactService(db),
+            [(file.filename, metadata) for _, file, metadata in accepted],
+            current_staff.id
+        )
+        for (i, _, _), response in zip(accepted, responses):
+            results[i] = response
+    
+    successful = sum(1 for r in results if r.success)
+    failed = len(results) - successful
     
     # Log bulk upload
     audit_service = AuditService(db)
@@ -239,6 +385,225 @@ async def upload_bulk_files(
     )
 
 
+@router.post("/archive", response_model=BulkUploadResponse)
+async def upload_archive(
+    file: UploadFile = File(...),
+    request: Request = None,
+    db: AsyncSession = Depends(get_db),
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Upload a ZIP or TAR archive of examination papers
+    
+    Scanners export one archive per exam hall; every member should follow
+    the pattern REGISTER_SUBJECT.pdf (folders inside the archive are ignored).
+    
+    Members are streamed out of the archive one by one without extracting
+    it, and artifacts are created and committed every ARCHIVE_BATCH_SIZE files.
+    """
+    if not file.filename or not file_processor.is_archive(file.filename):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Expected an archive: {', '.join(file_processor.ARCHIVE_EXTENSIONS)}"
+        )
+    
+    results = await _store_archive(db, file.file, file.filename, current_staff.id)
+    
+    successful = sum(1 for r in results if r.success)
+    failed = len(results) - successful
+    
+    audit_service = AuditService(db)
+    await audit_service.log_action(
+        action="archive_upload",
+        action_category="upload",
+        actor_type="staff",
+        actor_id=str(current_staff.id),
+        actor_username=current_staff.username,
+        actor_ip=request.client.host if request and request.client else None,
+        description=f"Archive upload {file.filename}: {successful} successful, {failed} failed",
+        request_data={
+            "archive": file.filename,
+            "total": len(results),
+            "successful": successful,
+            "failed": failed
+        }
+    )
+    
+    await db.commit()
+    
+    return BulkUploadResponse(
+        total_files=len(results),
+        successful=successful,
+        failed=failed,
+        results=results
+    )
+
+
+@router.post("/sessions", response_model=UploadSessionResponse, status_code=status.HTTP_201_CREATED)
+async def create_upload_session(
+    body: UploadSessionCreate,
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Start a resumable chunked upload
+    
+    Use this instead of /bulk for large scan batches (a single scan or a
+    ZIP/TAR archive) over unreliable links:
+    1. POST /sessions with the filename and total size
+    2. PUT /sessions/{id}/chunks/{n} for every chunk, with an
+       X-Chunk-SHA256 header; chunks may be retried or sent in parallel
+    3. GET /sessions/{id} after an interruption to see the missing chunks
+    4. POST /sessions/{id}/finalize to create the artifacts
+    """
+    try:
+        return await upload_session_service.create_session(
+            filename=body.filename,
+            total_size=body.total_size,
+            staff_id=current_staff.id,
+            chunk_size=body.chunk_size
+        )
+    except UploadSessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+
+
+@router.get("/sessions/{session_id}", response_model=UploadSessionResponse)
+async def get_upload_session(
+    session_id: str,
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Get received and missing chunks of an upload session
+    """
+    try:
+        return await upload_session_service.get_session(session_id, current_staff.id)
+    except UploadSessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+
+
+@router.put("/sessions/{session_id}/chunks/{index}", response_model=UploadSessionResponse)
+async def upload_session_chunk(
+    session_id: str,
+    index: int,
+    request: Request,
+    checksum: str = Header(..., alias="X-Chunk-SHA256"),
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Upload one chunk of a session as the raw request body
+    
+    The X-Chunk-SHA256 header must carry the hex SHA-256 of the chunk.
+    """
+    try:
+        return await upload_session_service.write_chunk(
+            session_id,
+            index,
+            request.stream(),
+            checksum,
+            staff_id=current_staff.id
+        )
+    except UploadSessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+
+
+@router.post("/sessions/{session_id}/finalize", response_model=BulkUploadResponse)
+async def finalize_upload_session(
+    session_id: str,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Assemble a completed session and create its artifacts
+    
+    Archives are expanded like /archive; any other file is handled like
+    /single, reading straight from the stored chunks. A session can only be
+    finalized once; a concurrent call gets 409. The session is removed once
+    its files are stored.
+    """
+    try:
+        session = await upload_session_service.claim(session_id, current_staff.id)
+    except UploadSessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+    
+    filename = session["filename"]
+    
+    try:
+        if file_processor.is_archive(filename):
+            with await upload_session_service.open_assembled(session_id) as fileobj:
+                results = await _store_archive(db, fileobj, filename, current_staff.id)
+        else:
+            stream = await upload_session_service.stream_assembled(session_id)
+            try:
+                is_valid, message, metadata = await file_processor.ingest_stream(stream, filename)
+            finally:
+                stream.close()
+            
+            if is_valid:
+                results = await _create_artifacts_batch(
+                    db, ArtifactService(db), [(filename, metadata)], current_staff.id
+                )
+            else:
+                results = [FileUploadResponse(
+                    success=False,
+                    message=message,
+                    filename=filename,
+                    errors=[message]
+                )]
+    except BaseException:
+        # Let the client retry the finalize
+        await upload_session_service.release(session_id)
+        raise
+    
+    await upload_session_service.discard_session(session_id)
+    
+    successful = sum(1 for r in results if r.success)
+    failed = len(results) - successful
+    
+    audit_service = AuditService(db)
+    await audit_service.log_action(
+        action="session_upload",
+        action_category="upload",
+        actor_type="staff",
+        actor_id=str(current_staff.id),
+        actor_username=current_staff.username,
+        actor_ip=request.client.host if request.client else None,
+        description=f"Resumable upload {filename}: {successful} successful, {failed} failed",
+        request_data={
+            "session_id": session_id,
+            "filename": filename,
+            "size": session["total_size"],
+            "total": len(results),
+            "successful": successful,
+            "failed": failed
+        }
+    )
+    
+    await db.commit()
+    
+    return BulkUploadResponse(
+        total_files=len(results),
+        successful=successful,
+        failed=failed,
+        results=results
+    )
+
+
+@router.delete("/sessions/{session_id}")
+async def abort_upload_session(
+    session_id: str,
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """
+    Abort an upload session and delete its chunks
+    """
+    try:
+        await upload_session_service.discard_session(session_id, current_staff.id)
+    except UploadSessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+    
+    return {"success": True, "message": "Upload session discarded"}
+
+
 @router.get("/pending")
 async def get_pending_uploads(
     limit: int = 50,
@@ -17,7 +17,7 @@ Usage:
         ...
 """
 
-from typing import Optional, Any, Callable, TypeVar, Dict
+from typing import Optional, Any, Callable, TypeVar, Dict, Awaitable
 from datetime import datetime, timedelta
 from functools import wraps
 import asyncio
@@ -278,5 +278,73 @@ def cached(ttl: int = 300, key_prefix: str = ""):
     return decorator
 
 
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key into one in-flight task.
+    
+    The first caller for a key starts the work; callers that arrive while it
+    is still running await the same task instead of repeating it. Nothing is
+    kept once the task finishes - pair it with a cache for that.
+    
+    The work runs as its own task, so a caller that is cancelled (e.g. a
+    client disconnecting) does not cancel it for the others.
+    
+    Usage:
+        result = await flights.do(f"subject:{code}", lambda: discover(code))
+    """
+    
+    def __init__(self):
+        self._flights: Dict[str, asyncio.Task] = {}
+        self._stats = {
+            "started": 0,
+            "coalesced": 0
+        }
+    
+    async def do(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run func for key, or join the call already in flight for key.
+        
+        Args:
+            key: Identity of the call
+            func: Zero-argument coroutine function doing the work
+            
+        Returns:
+            The result (or exception) of the shared call
+        """
+        task = self._flights.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(func())
+            self._flights[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+            self._stats["started"] += 1
+        else:
+            self._stats["coalesced"] += 1
+            logger.debug(f"Coalesced in-flight call: {key}")
+        
+        return await asyncio.shield(task)
+    
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # Mark the exception as retrieved if every caller went away
+        if not task.cancelled():
+            task.exception()
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get single-flight statistics.
+        
+        Returns:
+            Dictionary with in-flight, started and coalesced counts
+        """
+        return {"in_flight": len(self._flights), **self._stats}
+
+
 # Subject mapping specific cache (longer TTL)
 subject_cache = SimpleCache(default_ttl=1800)  # 30 minutes
+
+# Subject codes that could not be resolved (short TTL, set per entry)
+subject_negative_cache = SimpleCache(default_ttl=120)
+
+# Concurrent lookups of the same subject share one resolution
+subject_flights = SingleFlight()
@@ -3,7 +3,7 @@ Examination Middleware - Configuration Module
 Pydantic Settings for type-safe configuration management
 """
 
-from typing import List, Optional
+from typing import List, Optional, Dict, Tuple
 from pydantic_settings import BaseSettings
 from pydantic import Field
 from functools import lru_cache
@@ -50,10 +50,81 @@ class Settings(BaseSettings):
     moodle_service: str = Field(default="moodle_mobile_app")
     moodle_admin_token: Optional[str] = None
     
+    # Shared Moodle connection pool (see moodle_client.get_shared_http_client)
+    moodle_timeout_seconds: float = Field(default=30.0)
+    moodle_http2: bool = Field(default=True)
+    moodle_max_connections: int = Field(default=100)
+    moodle_max_keepalive_connections: int = Field(default=20)
+    moodle_keepalive_expiry_seconds: float = Field(default=60.0)
+    moodle_batch_calls: bool = Field(default=True)
+    
+    # Circuit breaker and adaptive concurrency limit (see moodle_guard)
+    moodle_breaker_failure_threshold: int = Field(default=5)
+    moodle_breaker_reset_seconds: float = Field(default=30.0)
+    moodle_concurrency_initial: int = Field(default=20)
+    moodle_concurrency_min: int = Field(default=2)
+    moodle_latency_target_seconds: float = Field(default=2.0)
+    moodle_concurrency_wait_seconds: float = Field(default=10.0)
+    
+    # Outbound rate per worker (see moodle_rate_limiter): JSON map of
+    # wsfunction -> [requests per second, burst]; "default" covers the rest
+    moodle_rate_limits: str = Field(
+        default='{"default": [20, 40], "core_files_upload": [4, 8], '
+                '"mod_assign_save_submission": [8, 16], "mod_assign_submit_for_grading": [8, 16]}'
+    )
+    moodle_rate_interactive_share: int = Field(default=3)
+    
     # File Storage
     upload_dir: str = Field(default="./uploads")
     max_file_size_mb: int = Field(default=50)
     allowed_extensions: str = Field(default=".pdf,.jpg,.jpeg,.png")
+    upload_chunk_size_kb: int = Field(default=1024)
+    bulk_upload_concurrency: int = Field(default=8)
+    archive_batch_size: int = Field(default=100)
+    upload_session_chunk_size_mb: int = Field(default=8)
+    upload_session_max_size_mb: int = Field(default=4096)
+    upload_session_ttl_hours: int = Field(default=24)
+    
+    # Hot folder ingest (hot_folder_ingest.py)
+    hot_folder_dir: str = Field(default="./hot_folder")
+    hot_folder_settle_seconds: float = Field(default=5.0)
+    hot_folder_batch_size: int = Field(default=100)
+    hot_folder_force_polling: bool = Field(default=False)
+    
+    # Background submission jobs (see submission_job_service)
+    submission_worker_embedded: bool = Field(default=True)
+    submission_worker_concurrency: int = Field(default=8)
+    submission_worker_poll_seconds: float = Field(default=1.0)
+    submission_job_lease_seconds: int = Field(default=120)
+    submission_claim_timeout_seconds: int = Field(default=900)
+    
+    # Retry queue consumer (see submission_queue_service)
+    submission_queue_concurrency: int = Field(default=4)
+    submission_queue_batch_size: int = Field(default=20)
+    submission_queue_poll_seconds: float = Field(default=5.0)
+    submission_queue_lease_seconds: int = Field(default=900)
+    submission_queue_backoff_base_seconds: float = Field(default=30.0)
+    submission_queue_backoff_max_seconds: float = Field(default=1800.0)
+    
+    # Staff bulk submission runs (see bulk_submission_service)
+    bulk_submission_concurrency: int = Field(default=8)
+    bulk_submission_chunk_size: int = Field(default=50)
+    bulk_submission_lease_seconds: int = Field(default=600)
+    
+    # Preloaded subject -> assignment index (see subject_catalog_service)
+    subject_catalog_enabled: bool = Field(default=True)
+    subject_catalog_refresh_minutes: float = Field(default=30.0)
+    subject_catalog_crawl_concurrency: int = Field(default=4)
+    subject_negative_cache_seconds: int = Field(default=120)
+    
+    # Upload pending papers to the Moodle draft area when the dashboard opens
+    submission_prestage_enabled: bool = Field(default=False)
+    submission_prestage_concurrency: int = Field(default=4)
+    submission_prestage_max_age_hours: float = Field(default=12.0)
+    
+    # Let nginx serve paper files via X-Accel-Redirect after the app's checks
+    x_accel_redirect_enabled: bool = Field(default=False)
+    x_accel_redirect_prefix: str = Field(default="/_protected_uploads/")
     
     # ML Service
     ml_service_url: str = Field(default="http://localhost:8501")
@@ -149,6 +220,32 @@ class Settings(BaseSettings):
         """Max file size in bytes"""
         return self.max_file_size_mb * 1024 * 1024
     
+    @property
+    def upload_chunk_size_bytes(self) -> int:
+        """Chunk size used when streaming uploads to disk"""
+        return self.upload_chunk_size_kb * 1024
+    
+    @property
+    def upload_session_chunk_size_bytes(self) -> int:
+        """Largest chunk accepted by a resumable upload session"""
+        return self.upload_session_chunk_size_mb * 1024 * 1024
+    
+    @property
+    def upload_session_max_size_bytes(self) -> int:
+        """Largest file accepted by a resumable upload session"""
+        return self.upload_session_max_size_mb * 1024 * 1024
+    
+    @property
+    def moodle_rate_limits_map(self) -> Dict[str, Tuple[float, float]]:
+        """Parse MOODLE_RATE_LIMITS; a rate of 0 disables limiting"""
+        try:
+            return {
+                function: (float(rate), float(burst))
+                for function, (rate, burst) in json.loads(self.moodle_rate_limits).items()
+            }
+        except (json.JSONDecodeError, TypeError, ValueError):
+            return {"default": (20.0, 40.0)}
+    
     def get_subject_assignment_mapping(self) -> dict:
         """Return subject code to assignment ID mapping"""
         return {
@@ -2,6 +2,7 @@
 SQLAlchemy Database Configuration and Session Management
 """
 
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.pool import AsyncAdaptedQueuePool
@@ -79,6 +80,12 @@ async def get_db() -> AsyncGenerator[AsyncSession, None]:
             await session.close()
 
 
+# Idempotent DDL for columns added after a table was first created
+SCHEMA_UPGRADES = [
+    "ALTER TABLE examination_artifacts ADD COLUMN IF NOT EXISTS submission_claimed_at TIMESTAMPTZ",
+]
+
+
 async def init_db() -> None:
     """
     Initialize database - create all tables
@@ -87,6 +94,9 @@ async def init_db() -> None:
         # Import all models to ensure they're registered
         from app.db import models  # noqa
         await conn.run_sync(Base.metadata.create_all)
+        # Columns added to tables that create_all leaves alone once they exist
+        for statement in SCHEMA_UPGRADES:
+            await conn.execute(text(statement))
         logger.info("Database tables created successfully")
 
 
@@ -85,6 +85,7 @@ class ExaminationArtifact(Base):
     validated_at = Column(DateTime(timezone=True), nullable=True)
     submit_timestamp = Column(DateTime(timezone=True), nullable=True)
     completed_at = Column(DateTime(timezone=True), nullable=True)
+    submission_claimed_at = Column(DateTime(timezone=True), nullable=True)  # See claim_for_submission
     
     # Audit
     uploaded_by_staff_id = Column(Integer, ForeignKey("staff_users.id"), nullable=True)
@@ -102,6 +103,7 @@ class ExaminationArtifact(Base):
     __table_args__ = (
         Index('ix_artifacts_reg_subject', 'parsed_reg_no', 'parsed_subject_code'),
         Index('ix_artifacts_status', 'workflow_status'),
+        Index('ix_artifacts_file_hash', 'file_hash'),  # Blob reference counting
         UniqueConstraint('parsed_reg_no', 'parsed_subject_code', name='uq_paper_submission'),
     )
     
@@ -292,6 +294,103 @@ class SubmissionQueue(Base):
     )
 
 
+class SubmissionJob(Base):
+    """
+    Student submission accepted by the API and run by the submission worker
+    The student's Moodle token is kept encrypted until the job finishes
+    """
+    __tablename__ = "submission_jobs"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_uuid = Column(UUID(as_uuid=True), default=uuid.uuid4, unique=True, nullable=False)
+    
+    # What to submit, and on whose behalf
+    artifact_id = Column(Integer, ForeignKey("examination_artifacts.id"), nullable=False, index=True)
+    moodle_user_id = Column(BigInteger, nullable=False)
+    moodle_username = Column(String(100), nullable=False)
+    register_number = Column(String(20), nullable=False)
+    encrypted_token = Column(Text, nullable=True)  # cleared once the job finishes
+    actor_ip = Column(String(45), nullable=True)
+    lock_submission = Column(Boolean, default=True)
+    
+    # Job State
+    status = Column(String(20), default="QUEUED")  # QUEUED, RUNNING, SUCCEEDED, FAILED
+    message = Column(Text, nullable=True)
+    result = Column(JSONB, nullable=True)
+    
+    # Timestamps
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    # Renewed by the running worker; an expired lease means the worker died
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    
+    # Index for claiming work; at most one active job per artifact
+    __table_args__ = (
+        Index('ix_submission_job_status_created', 'status', 'created_at'),
+        Index(
+            'uq_submission_job_active_artifact', 'artifact_id',
+            unique=True,
+            postgresql_where=status.in_(["QUEUED", "RUNNING"])
+        ),
+    )
+
+
+class BulkSubmissionRun(Base):
+    """
+    Staff-initiated submission of every pending paper of a subject or exam session
+    Progress is checkpointed per item in bulk_submission_items
+    """
+    __tablename__ = "bulk_submission_runs"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_uuid = Column(UUID(as_uuid=True), default=uuid.uuid4, unique=True, nullable=False)
+    
+    # Selection
+    subject_code = Column(String(20), nullable=True)
+    exam_session = Column(String(50), nullable=True)
+    
+    # Run State
+    status = Column(String(20), default="RUNNING")  # RUNNING, COMPLETED, CANCELLED
+    total_items = Column(Integer, default=0)
+    succeeded = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    skipped = Column(Integer, default=0)
+    
+    # Audit
+    created_by = Column(String(100), nullable=True)
+    
+    # Timestamps
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class BulkSubmissionItem(Base):
+    """
+    One artifact of a bulk submission run (the run's checkpoint)
+    """
+    __tablename__ = "bulk_submission_items"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_id = Column(Integer, ForeignKey("bulk_submission_runs.id"), nullable=False)
+    artifact_id = Column(Integer, ForeignKey("examination_artifacts.id"), nullable=False)
+    assignment_id = Column(Integer, nullable=True)
+    
+    # Item State
+    status = Column(String(20), default="PENDING")  # PENDING, RUNNING, DONE, FAILED, SKIPPED
+    error = Column(Text, nullable=True)
+    
+    # Timestamps
+    claimed_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    
+    # Index for claiming work, grouped by assignment
+    __table_args__ = (
+        Index('ix_bulk_item_run_status_assignment', 'run_id', 'status', 'assignment_id'),
+    )
+
+
 class SystemConfig(Base):
     """
     Runtime configuration storage
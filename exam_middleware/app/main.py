@@ -17,7 +17,14 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
 from app.core.config import settings
-from app.db.database import engine, Base
+from app.db.database import engine, init_db
+from app.services.moodle_client import close_shared_http_client
+from app.services.submission_job_service import submission_worker
+from app.services.submission_queue_service import submission_queue_processor
+from app.services.draft_staging_service import draft_stager
+from app.services.bulk_submission_service import bulk_submission_runner
+from app.services.subject_catalog_service import subject_catalog
+from app.services.subject_discovery_service import mapping_refresher
 from app.api.routes import (
     auth_router,
     upload_router,
@@ -52,8 +59,7 @@ async def lifespan(app: FastAPI):
     logger.info("Starting Examination Middleware...")
     
     # Create database tables
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    await init_db()
     logger.info("Database tables created/verified")
     
     # Ensure upload and storage directories exist
@@ -73,14 +79,31 @@ async def lifespan(app: FastAPI):
     static_path = Path("app/static")
     static_path.mkdir(parents=True, exist_ok=True)
     
+    # Subject lookups resolve from a preloaded catalog of Moodle assignments
+    if settings.subject_catalog_enabled:
+        await subject_catalog.start()
+    
+    # Run submission jobs in this process unless a separate worker does
+    if settings.submission_worker_embedded:
+        await submission_worker.start()
+        await submission_queue_processor.start()
+        await bulk_submission_runner.resume()
+    
     logger.info("Examination Middleware started successfully")
     
     yield
     
     # Shutdown
     logger.info("Shutting down Examination Middleware...")
+    await submission_worker.stop()
+    await submission_queue_processor.stop()
+    await draft_stager.stop()
+    await bulk_submission_runner.stop()
+    await subject_catalog.stop()
+    await mapping_refresher.stop()
     await engine.dispose()
     logger.info("Database connections closed")
+    await close_shared_http_client()
 
 
 # Create FastAPI application
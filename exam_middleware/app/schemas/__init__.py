@@ -12,6 +12,8 @@ from app.schemas.schemas import (
     # File Upload
     FileUploadResponse,
     BulkUploadResponse,
+    UploadSessionCreate,
+    UploadSessionResponse,
     FileMetadata,
     # Artifacts
     ArtifactBase,
@@ -23,7 +25,11 @@ from app.schemas.schemas import (
     # Submission
     SubmissionRequest,
     SubmissionResponse,
+    SubmissionJobResponse,
+    SubmissionBatchResponse,
     SubmissionStatusResponse,
+    BulkSubmissionCreate,
+    BulkSubmissionProgressResponse,
     # Subject Mapping
     SubjectMappingBase,
     SubjectMappingCreate,
@@ -56,6 +62,8 @@ __all__ = [
     "TokenPayload",
     "FileUploadResponse",
     "BulkUploadResponse",
+    "UploadSessionCreate",
+    "UploadSessionResponse",
     "FileMetadata",
     "ArtifactBase",
     "ArtifactCreate",
@@ -65,7 +73,11 @@ __all__ = [
     "StudentDashboardResponse",
     "SubmissionRequest",
     "SubmissionResponse",
+    "SubmissionJobResponse",
+    "SubmissionBatchResponse",
     "SubmissionStatusResponse",
+    "BulkSubmissionCreate",
+    "BulkSubmissionProgressResponse",
     "SubjectMappingBase",
     "SubjectMappingCreate",
     "SubjectMappingResponse",
@@ -83,10 +83,13 @@ class FileUploadResponse(BaseModel):
     """Response for file upload"""
     success: bool
     message: str
+    filename: Optional[str] = None
     artifact_uuid: Optional[str] = None
     parsed_register_number: Optional[str] = None
     parsed_subject_code: Optional[str] = None
     workflow_status: Optional[str] = None
+    # The paper already had an artifact; it was kept and nothing was replaced
+    duplicate: bool = False
     errors: Optional[List[str]] = None
 
 
@@ -98,6 +101,27 @@ class BulkUploadResponse(BaseModel):
     results: List[FileUploadResponse]
 
 
+class UploadSessionCreate(BaseModel):
+    """Request to start a resumable upload session"""
+    filename: str = Field(..., min_length=1, max_length=255)
+    total_size: int = Field(..., gt=0)
+    chunk_size: Optional[int] = Field(None, gt=0)
+
+
+class UploadSessionResponse(BaseModel):
+    """State of a resumable upload session"""
+    session_id: str
+    filename: str
+    total_size: int
+    chunk_size: int
+    total_chunks: int
+    received_chunks: List[int]
+    missing_chunks: List[int]
+    received_bytes: int
+    complete: bool
+    expires_at: datetime
+
+
 class FileMetadata(BaseModel):
     """Extracted file metadata"""
     register_number: str
@@ -213,6 +237,51 @@ class SubmissionResponse(BaseModel):
     errors: Optional[List[str]] = None
 
 
+class SubmissionJobResponse(BaseModel):
+    """Accepted submission job and its current state"""
+    job_id: str
+    artifact_uuid: str
+    status: str  # QUEUED, RUNNING, SUCCEEDED, FAILED
+    message: Optional[str] = None
+    workflow_status: WorkflowStatusEnum
+    moodle_submission_id: Optional[str] = None
+    submitted_at: Optional[datetime] = None
+    created_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    poll_url: str
+
+
+class SubmissionBatchResponse(BaseModel):
+    """Submission jobs accepted by a submit-all request"""
+    total: int
+    jobs: List[SubmissionJobResponse]
+
+
+class BulkSubmissionCreate(BaseModel):
+    """Selection for a staff bulk submission run"""
+    subject_code: Optional[str] = None
+    exam_session: Optional[str] = None
+
+
+class BulkSubmissionProgressResponse(BaseModel):
+    """Progress of a bulk submission run"""
+    run_id: str
+    subject_code: Optional[str] = None
+    exam_session: Optional[str] = None
+    status: str  # RUNNING, COMPLETED, CANCELLED
+    total: int
+    succeeded: int
+    failed: int
+    skipped: int
+    remaining: int
+    by_status: Dict[str, int]
+    throughput_per_minute: float
+    eta_seconds: Optional[int] = None
+    created_by: Optional[str] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+
 class SubmissionStatusResponse(BaseModel):
     """Status of a submission"""
     artifact_uuid: str
@@ -2,23 +2,68 @@
 Services module initialization
 """
 
-from app.services.moodle_client import MoodleClient, MoodleAPIError, moodle_client
+from app.services.moodle_client import (
+    MoodleClient,
+    MoodleAPIError,
+    MoodleUnavailableError,
+    moodle_client,
+)
+from app.services.moodle_guard import MoodleGuard, moodle_guard
 from app.services.file_processor import FileProcessor, file_processor
+from app.services.upload_session_service import (
+    UploadSessionService,
+    UploadSessionError,
+    upload_session_service,
+)
 from app.services.artifact_service import (
     ArtifactService,
     SubjectMappingService,
     AuditService,
 )
+from app.services.draft_staging_service import DraftStager, draft_stager
+from app.services.subject_catalog_service import SubjectCatalog, subject_catalog
 from app.services.submission_service import SubmissionService
+from app.services.submission_job_service import (
+    SubmissionJobService,
+    SubmissionWorker,
+    submission_worker,
+)
+from app.services.bulk_submission_service import (
+    BulkSubmissionService,
+    BulkSubmissionRunner,
+    bulk_submission_runner,
+)
+from app.services.submission_queue_service import (
+    SubmissionQueueProcessor,
+    submission_queue_processor,
+)
 
 __all__ = [
     "MoodleClient",
     "MoodleAPIError",
+    "MoodleUnavailableError",
     "moodle_client",
+    "MoodleGuard",
+    "moodle_guard",
     "FileProcessor",
     "file_processor",
+    "UploadSessionService",
+    "UploadSessionError",
+    "upload_session_service",
     "ArtifactService",
     "SubjectMappingService",
     "AuditService",
+    "DraftStager",
+    "draft_stager",
+    "SubjectCatalog",
+    "subject_catalog",
     "SubmissionService",
+    "SubmissionJobService",
+    "SubmissionWorker",
+    "submission_worker",
+    "BulkSubmissionService",
+    "BulkSubmissionRunner",
+    "bulk_submission_runner",
+    "SubmissionQueueProcessor",
+    "submission_queue_processor",
 ]
@@ -4,10 +4,12 @@ Business logic for managing examination artifacts
 """
 
 import logging
+import uuid
 from typing import Optional, List, Dict, Any, Tuple
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, and_, or_
+from sqlalchemy import select, update, and_, or_, func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import selectinload
 
 from app.db.models import (
@@ -28,6 +30,20 @@ from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Statuses a submission may be started from (see claim_for_submission)
+SUBMITTABLE_STATUSES = [
+    WorkflowStatus.PENDING,
+    WorkflowStatus.PENDING_REVIEW,
+    WorkflowStatus.VALIDATED,
+    WorkflowStatus.READY_FOR_REVIEW,
+    WorkflowStatus.LOCKED_BY_USER,
+    WorkflowStatus.FAILED,
+    WorkflowStatus.QUEUED,
+]
+
+# Statuses held while a submission talks to Moodle
+IN_PROGRESS_STATUSES = [WorkflowStatus.UPLOADING, WorkflowStatus.SUBMITTING]
+
 
 class ArtifactService:
     """
@@ -49,10 +65,14 @@ class ArtifactService:
         file_size_bytes: Optional[int] = None,
         mime_type: Optional[str] = None,
         uploaded_by_staff_id: Optional[int] = None
-    ) -> ExaminationArtifact:
+    ) -> Tuple[ExaminationArtifact, bool]:
         """
         Create a new examination artifact
         
+        Uses the same duplicate rule as create_artifacts_bulk: a paper
+        (register number + subject code) that already has an artifact is
+        not replaced, and the existing artifact is returned instead.
+        
         Args:
             raw_filename: Original uploaded filename
             original_filename: Sanitized filename
@@ -65,51 +85,201 @@ class ArtifactService:
             uploaded_by_staff_id: Staff user who uploaded
             
         Returns:
-            Created ExaminationArtifact
+            Tuple of (artifact, duplicate)
         """
-        # Generate transaction ID for idempotency
-        transaction_id = None
-        if parsed_reg_no and parsed_subject_code:
-            transaction_id = generate_transaction_id(
-                parsed_reg_no,
-                parsed_subject_code,
-                datetime.utcnow().strftime("%Y%m")
+        results = await self.create_artifacts_bulk(
+            [{
+                "raw_filename": raw_filename,
+                "original_filename": original_filename,
+                "file_blob_path": file_blob_path,
+                "file_hash": file_hash,
+                "parsed_reg_no": parsed_reg_no,
+                "parsed_subject_code": parsed_subject_code,
+                "file_size_bytes": file_size_bytes,
+                "mime_type": mime_type,
+            }],
+            uploaded_by_staff_id=uploaded_by_staff_id
+        )
+        return results[0]
+    
+    async def create_artifacts_bulk(
+        self,
+        items: List[Dict[str, Any]],
+        uploaded_by_staff_id: Optional[int] = None
+    ) -> List[Tuple[ExaminationArtifact, bool]]:
+        """
+        Create many artifacts with a single multi-row INSERT ... RETURNING
+        
+        A paper (register number + subject code) that already has an
+        artifact is a duplicate: it is not replaced and the existing artifact
+        is returned with duplicate=True. Duplicates for the whole batch are
+        resolved with one lookup query instead of one per file. Rows inserted concurrently by another writer (e.g. the hot
+        folder racing a bulk upload) are skipped with ON CONFLICT DO NOTHING
+        and re-selected, so one collision does not roll back the batch.
+        
+        Args:
+            items: Dicts with the create_artifact keyword arguments
+                (raw_filename, original_filename, file_blob_path, file_hash,
+                parsed_reg_no, parsed_subject_code, file_size_bytes, mime_type)
+            uploaded_by_staff_id: Staff user who uploaded the batch
+        
+        Returns:
+            (artifact, duplicate) pairs aligned with items
+        """
+        if not items:
+            return []
+        
+        period = datetime.utcnow().strftime("%Y%m")
+        transaction_ids = [
+            generate_transaction_id(item["parsed_reg_no"], item["parsed_subject_code"], period)
+            if item.get("parsed_reg_no") and item.get("parsed_subject_code") else None
+            for item in items
+        ]
+        
+        # One query for every possible duplicate in the batch
+        existing_by_txn: Dict[str, ExaminationArtifact] = {}
+        existing_by_pair: Dict[Tuple[str, str], ExaminationArtifact] = {}
+        reg_numbers = {item["parsed_reg_no"] for item in items if item.get("parsed_reg_no")}
+        if reg_numbers:
+            result = await self.db.execute(
+                select(ExaminationArtifact)
+                .where(ExaminationArtifact.parsed_reg_no.in_(reg_numbers))
             )
-            
-            # Check for existing artifact with same transaction ID
-            existing = await self.get_by_transaction_id(transaction_id)
-            if existing:
+            for artifact in result.scalars().all():
+                if artifact.transaction_id:
+                    existing_by_txn[artifact.transaction_id] = artifact
+                existing_by_pair[(artifact.parsed_reg_no, artifact.parsed_subject_code)] = artifact
+        
+        rows: List[Dict[str, Any]] = []
+        row_index: Dict[int, int] = {}
+        pending_by_txn: Dict[str, int] = {}
+        for i, (item, transaction_id) in enumerate(zip(items, transaction_ids)):
+            pair = (item.get("parsed_reg_no"), item.get("parsed_subject_code"))
+            if transaction_id and (transaction_id in existing_by_txn or pair in existing_by_pair):
                 logger.warning(f"Duplicate artifact detected: {transaction_id}")
-                # Return existing instead of creating duplicate
-                return existing
-        
-        artifact = ExaminationArtifact(
-            raw_filename=raw_filename,
-            original_filename=original_filename,
-            file_blob_path=file_blob_path,
-            file_hash=file_hash,
-            parsed_reg_no=parsed_reg_no,
-            parsed_subject_code=parsed_subject_code,
-            file_size_bytes=file_size_bytes,
-            mime_type=mime_type,
-            uploaded_by_staff_id=uploaded_by_staff_id,
-            transaction_id=transaction_id,
-            workflow_status=WorkflowStatus.PENDING if parsed_reg_no else WorkflowStatus.FAILED
-        )
+                continue
+            if transaction_id and transaction_id in pending_by_txn:
+                # Same paper twice in one batch - both map to the first row
+                row_index[i] = pending_by_txn[transaction_id]
+                continue
+            
+            if transaction_id:
+                pending_by_txn[transaction_id] = len(rows)
+            row_index[i] = len(rows)
+            rows.append({
+                "artifact_uuid": uuid.uuid4(),
+                "raw_filename": item["raw_filename"],
+                "original_filename": item["original_filename"],
+                "file_blob_path": item["file_blob_path"],
+                "file_hash": item["file_hash"],
+                "parsed_reg_no": item.get("parsed_reg_no"),
+                "parsed_subject_code": item.get("parsed_subject_code"),
+                "file_size_bytes": item.get("file_size_bytes"),
+                "mime_type": item.get("mime_type"),
+                "uploaded_by_staff_id": uploaded_by_staff_id,
+                "transaction_id": transaction_id,
+                "workflow_status": WorkflowStatus.PENDING if item.get("parsed_reg_no") else WorkflowStatus.FAILED,
+                "retry_count": 0,
+                "transaction_log": [{
+                    "timestamp": datetime.utcnow().isoformat(),
+                    "action": "created",
+                    "details": {
+                        "filename": item["raw_filename"],
+                        "parsed_reg_no": item.get("parsed_reg_no"),
+                        "parsed_subject_code": item.get("parsed_subject_code")
+                    }
+                }]
+            })
         
-        # Add initial log entry
-        artifact.add_log_entry("created", {
-            "filename": raw_filename,
-            "parsed_reg_no": parsed_reg_no,
-            "parsed_subject_code": parsed_subject_code
-        })
+        created: Dict[uuid.UUID, ExaminationArtifact] = {}
+        if rows:
+            await self.lock_blobs([row["file_hash"] for row in rows])
+            result = await self.db.execute(
+                insert(ExaminationArtifact)
+                .on_conflict_do_nothing()
+                .returning(ExaminationArtifact),
+                rows
+            )
+            created = {artifact.artifact_uuid: artifact for artifact in result.scalars().all()}
+        
+        # Rows that lost a race with a concurrent insert come back empty
+        conflicted = [row for row in rows if row["artifact_uuid"] not in created]
+        if conflicted:
+            result = await self.db.execute(
+                select(ExaminationArtifact).where(or_(
+                    ExaminationArtifact.transaction_id.in_(
+                        [row["transaction_id"] for row in conflicted if row["transaction_id"]]
+                    ),
+                    ExaminationArtifact.parsed_reg_no.in_(
+                        [row["parsed_reg_no"] for row in conflicted if row["parsed_reg_no"]]
+                    )
+                ))
+            )
+            for artifact in result.scalars().all():
+                if artifact.transaction_id:
+                    existing_by_txn[artifact.transaction_id] = artifact
+                existing_by_pair[(artifact.parsed_reg_no, artifact.parsed_subject_code)] = artifact
+            logger.warning(f"{len(conflicted)} artifacts were inserted concurrently, reusing existing rows")
+        
+        def _existing(row: Dict[str, Any]) -> ExaminationArtifact:
+            return (
+                existing_by_txn.get(row["transaction_id"])
+                or existing_by_pair[(row["parsed_reg_no"], row["parsed_subject_code"])]
+            )
         
-        self.db.add(artifact)
-        await self.db.flush()
-        await self.db.refresh(artifact)
+        artifacts = []
+        first_rows = set()
+        for i, (item, transaction_id) in enumerate(zip(items, transaction_ids)):
+            if i in row_index:
+                row_number = row_index[i]
+                artifact = created.get(rows[row_number]["artifact_uuid"])
+                if artifact is not None and row_number not in first_rows:
+                    first_rows.add(row_number)
+                    artifacts.append((artifact, False))
+                else:
+                    artifacts.append((artifact or _existing(rows[row_number]), True))
+            else:
+                pair = (item.get("parsed_reg_no"), item.get("parsed_subject_code"))
+                artifacts.append((existing_by_txn.get(transaction_id) or existing_by_pair[pair], True))
+        
+        logger.info(f"Bulk created {len(created)} artifacts ({len(items) - len(created)} duplicates)")
+        return artifacts
+    
+    async def lock_blobs(self, file_hashes: List[str], exclusive: bool = False) -> None:
+        """
+        Take transaction-scoped advisory locks on blobs
         
-        logger.info(f"Created artifact: {artifact.artifact_uuid}")
-        return artifact
+        Inserts that reference a blob hold the shared lock; cleanup takes the
+        exclusive one before re-counting references, so it cannot delete a
+        blob whose new artifact is not committed yet. Locks are taken in hash
+        order in one statement to avoid deadlocks.
+        """
+        hashes = sorted(set(file_hashes))
+        if not hashes:
+            return
+        lock = func.pg_advisory_xact_lock if exclusive else func.pg_advisory_xact_lock_shared
+        await self.db.execute(select(*[lock(func.hashtext(file_hash)) for file_hash in hashes]))
+    
+    async def get_blob_reference_counts(self, file_hashes: List[str]) -> Dict[str, int]:
+        """
+        Count artifacts referencing each blob in the content-addressed store
+        
+        Blobs are shared between artifacts with identical content, so a file
+        may only be deleted once its count drops to zero.
+        """
+        counts = {file_hash: 0 for file_hash in file_hashes}
+        if not counts:
+            return counts
+        
+        result = await self.db.execute(
+            select(ExaminationArtifact.file_hash, func.count(ExaminationArtifact.id))
+            .where(ExaminationArtifact.file_hash.in_(list(counts)))
+            .group_by(ExaminationArtifact.file_hash)
+        )
+        for file_hash, count in result.all():
+            counts[file_hash] = count
+        
+        return counts
     
     async def get_by_uuid(self, artifact_uuid: str) -> Optional[ExaminationArtifact]:
         """Get artifact by UUID"""
@@ -187,6 +357,60 @@ class ArtifactService:
         )
         return list(result.scalars().all())
     
+    async def get_dashboard_artifacts(
+        self,
+        register_number: str
+    ) -> Tuple[List[ExaminationArtifact], List[ExaminationArtifact]]:
+        """
+        Get a student's pending and submitted artifacts in one query
+        
+        Applies the same matching as get_pending_for_student and
+        get_submitted_for_student: pending papers match the register number
+        or Moodle username, submitted papers only the register number.
+        
+        Args:
+            register_number: 12-digit register number or Moodle username
+            
+        Returns:
+            Tuple of (pending newest upload first, submitted newest submission first)
+        """
+        pending_statuses = {
+            WorkflowStatus.PENDING,
+            WorkflowStatus.PENDING_REVIEW,
+            WorkflowStatus.VALIDATED,
+            WorkflowStatus.READY_FOR_REVIEW
+        }
+        submitted_statuses = {WorkflowStatus.SUBMITTED_TO_LMS, WorkflowStatus.COMPLETED}
+        
+        result = await self.db.execute(
+            select(ExaminationArtifact)
+            .where(
+                and_(
+                    or_(
+                        ExaminationArtifact.parsed_reg_no == register_number,
+                        ExaminationArtifact.moodle_username == register_number
+                    ),
+                    ExaminationArtifact.workflow_status.in_(pending_statuses | submitted_statuses)
+                )
+            )
+            .order_by(ExaminationArtifact.uploaded_at.desc())
+        )
+        
+        pending = []
+        submitted = []
+        for artifact in result.scalars().all():
+            if artifact.workflow_status in pending_statuses:
+                pending.append(artifact)
+            elif artifact.parsed_reg_no == register_number:
+                submitted.append(artifact)
+        
+        # Same order as the submitted query: newest first, never-stamped rows first
+        submitted.sort(
+            key=lambda a: (a.submit_timestamp is None, a.submit_timestamp or datetime.min),
+            reverse=True
+        )
+        return pending, submitted
+    
     async def update_status(
         self,
         artifact_id: int,
@@ -277,6 +501,68 @@ class ArtifactService:
         await self.db.refresh(artifact)
         return artifact
     
+    async def claim_for_submission(
+        self,
+        artifact: ExaminationArtifact,
+        statuses: Optional[List[WorkflowStatus]] = None
+    ) -> bool:
+        """
+        Atomically mark an artifact SUBMITTING before talking to Moodle
+        
+        The conditional UPDATE succeeds for exactly one caller, so a paper
+        is never submitted twice by the student job, the retry queue and a
+        bulk run at the same time. A claim older than
+        SUBMISSION_CLAIM_TIMEOUT_SECONDS was left by a crashed worker and
+        may be taken over. The caller commits right away so the claim is
+        visible to others, and runs the Moodle calls without holding a lock.
+        
+        Args:
+            artifact: Artifact to claim (refreshed with the new status)
+            statuses: Statuses a claim may start from
+                (defaults to SUBMITTABLE_STATUSES)
+            
+        Returns:
+            True if this caller now owns the submission
+        """
+        now = datetime.now(timezone.utc)
+        stale = now - timedelta(seconds=settings.submission_claim_timeout_seconds)
+        result = await self.db.execute(
+            update(ExaminationArtifact)
+            .where(
+                ExaminationArtifact.id == artifact.id,
+                or_(
+                    ExaminationArtifact.workflow_status.in_(statuses or SUBMITTABLE_STATUSES),
+                    and_(
+                        ExaminationArtifact.workflow_status.in_(IN_PROGRESS_STATUSES),
+                        or_(
+                            ExaminationArtifact.submission_claimed_at.is_(None),
+                            ExaminationArtifact.submission_claimed_at < stale
+                        )
+                    )
+                )
+            )
+            .values(workflow_status=WorkflowStatus.SUBMITTING, submission_claimed_at=now)
+            .returning(ExaminationArtifact.id)
+            .execution_options(synchronize_session="fetch")
+        )
+        return result.scalar_one_or_none() is not None
+    
+    async def release_submission_claim(
+        self,
+        artifact_id: int,
+        status: WorkflowStatus
+    ) -> None:
+        """Hand a claimed artifact back without an outcome (e.g. Moodle is down)"""
+        await self.db.execute(
+            update(ExaminationArtifact)
+            .where(
+                ExaminationArtifact.id == artifact_id,
+                ExaminationArtifact.workflow_status.in_(IN_PROGRESS_STATUSES)
+            )
+            .values(workflow_status=status, submission_claimed_at=None)
+            .execution_options(synchronize_session="fetch")
+        )
+    
     async def mark_submitted(
         self,
         artifact_id: int,
@@ -347,8 +633,6 @@ class ArtifactService:
         offset: int = 0
     ) -> Tuple[List[ExaminationArtifact], int]:
         """Get all pending artifacts (for admin view)"""
-        from sqlalchemy import func
-        
         # PERFORMANCE FIX: Use COUNT aggregate instead of loading all rows
         count_result = await self.db.execute(
             select(func.count(ExaminationArtifact.id))
@@ -384,8 +668,6 @@ class ArtifactService:
         PERFORMANCE FIX: Uses single GROUP BY query instead of N queries.
         Previous implementation did one query per status (11+ queries).
         """
-        from sqlalchemy import func
-        
         # Initialize all statuses to 0
         stats = {status.value.lower(): 0 for status in WorkflowStatus}
         
@@ -0,0 +1,451 @@
+"""
+Bulk Submission Service
+Staff-side submission of whole subjects or exam sessions to Moodle
+"""
+
+import uuid
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List, Set, Callable
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update, func, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.database import async_session_maker
+from app.db.models import (
+    BulkSubmissionRun,
+    BulkSubmissionItem,
+    ExaminationArtifact,
+    SubjectMapping,
+    WorkflowStatus,
+)
+from app.services.artifact_service import IN_PROGRESS_STATUSES
+from app.services.moodle_client import MoodleUnavailableError
+from app.services.moodle_guard import moodle_guard
+from app.services.moodle_rate_limiter import background_priority
+from app.services.subject_discovery_service import SubjectDiscoveryService
+from app.services.submission_job_service import SubmissionJobService
+from app.services.submission_service import SubmissionService
+
+logger = logging.getLogger(__name__)
+
+# Papers a bulk run picks up (QUEUED ones belong to the retry queue)
+BULK_SUBMITTABLE_STATUSES = [
+    WorkflowStatus.PENDING,
+    WorkflowStatus.PENDING_REVIEW,
+    WorkflowStatus.VALIDATED,
+    WorkflowStatus.READY_FOR_REVIEW,
+    WorkflowStatus.FAILED,
+]
+
+
+class BulkSubmissionService:
+    """
+    Creating bulk submission runs and reporting their progress
+    
+    A run snapshots the selected artifacts into bulk_submission_items,
+    with the assignment resolved once per subject code. The items are the
+    checkpoint: BulkSubmissionRunner only ever works on items that are not
+    finished yet, so a restarted process resumes where the last one stopped.
+    """
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+    
+    async def create_run(
+        self,
+        subject_code: Optional[str] = None,
+        exam_session: Optional[str] = None,
+        created_by: Optional[str] = None,
+        admin_token: Optional[str] = None
+    ) -> BulkSubmissionRun:
+        """
+        Select the pending papers of a subject and/or exam session
+        
+        Args:
+            subject_code: Only papers of this subject
+            exam_session: Only papers of subjects mapped to this exam session
+            created_by: Staff username, for the audit trail
+            admin_token: Token used for Moodle assignment discovery
+        """
+        conditions = [ExaminationArtifact.workflow_status.in_(BULK_SUBMITTABLE_STATUSES)]
+        if subject_code:
+            conditions.append(ExaminationArtifact.parsed_subject_code == subject_code.upper())
+        if exam_session:
+            conditions.append(ExaminationArtifact.parsed_subject_code.in_(
+                select(SubjectMapping.subject_code).where(SubjectMapping.exam_session == exam_session)
+            ))
+        
+        result = await self.db.execute(
+            select(
+                ExaminationArtifact.id,
+                ExaminationArtifact.parsed_subject_code,
+                ExaminationArtifact.moodle_assignment_id
+            ).where(and_(*conditions))
+        )
+        rows = result.all()
+        
+        # Partition per assignment, resolving each subject code once
+        discovery = SubjectDiscoveryService(self.db)
+        assignment_ids: Dict[str, Optional[int]] = {}
+        for code in {row.parsed_subject_code for row in rows if row.parsed_subject_code}:
+            assignment_ids[code] = await discovery.get_assignment_id(code, user_token=admin_token)
+        
+        run = BulkSubmissionRun(
+            subject_code=subject_code.upper() if subject_code else None,
+            exam_session=exam_session,
+            status="RUNNING",
+            total_items=len(rows),
+            created_by=created_by,
+            started_at=datetime.now(timezone.utc)
+        )
+        self.db.add(run)
+        await self.db.flush()
+        
+        items = []
+        for row in rows:
+            assignment_id = row.moodle_assignment_id or assignment_ids.get(row.parsed_subject_code)
+            items.append(BulkSubmissionItem(
+                run_id=run.id,
+                artifact_id=row.id,
+                assignment_id=assignment_id,
+                status="PENDING" if assignment_id else "SKIPPED",
+                error=None if assignment_id else f"No assignment mapping for {row.parsed_subject_code}"
+            ))
+        run.skipped = sum(1 for item in items if item.status == "SKIPPED")
+        if run.skipped == run.total_items:
+            run.status = "COMPLETED"
+            run.finished_at = datetime.now(timezone.utc)
+        self.db.add_all(items)
+        await self.db.flush()
+        
+        logger.info(
+            f"Bulk submission run {run.run_uuid}: {run.total_items} papers, "
+            f"{len(assignment_ids)} subjects, {run.skipped} without an assignment"
+        )
+        return run
+    
+    async def get_run(self, run_uuid: str) -> Optional[BulkSubmissionRun]:
+        try:
+            run_uuid = uuid.UUID(str(run_uuid))
+        except ValueError:
+            return None
+        result = await self.db.execute(
+            select(BulkSubmissionRun).where(BulkSubmissionRun.run_uuid == run_uuid)
+        )
+        return result.scalar_one_or_none()
+    
+    async def list_runs(self, limit: int = 20) -> List[BulkSubmissionRun]:
+        result = await self.db.execute(
+            select(BulkSubmissionRun).order_by(BulkSubmissionRun.created_at.desc()).limit(limit)
+        )
+        return list(result.scalars().all())
+    
+    async def get_progress(self, run: BulkSubmissionRun) -> Dict[str, Any]:
+        """
+        Counts, throughput and ETA of a run
+        
+        Throughput is items finished per minute since the run started; the
+        ETA assumes the remaining items go at the same rate.
+        """
+        result = await self.db.execute(
+            select(BulkSubmissionItem.status, func.count(BulkSubmissionItem.id))
+            .where(BulkSubmissionItem.run_id == run.id)
+            .group_by(BulkSubmissionItem.status)
+        )
+        by_status = {status: count for status, count in result.all()}
+        
+        finished = run.succeeded + run.failed
+        remaining = by_status.get("PENDING", 0) + by_status.get("RUNNING", 0)
+        
+        end = run.finished_at or datetime.now(timezone.utc)
+        elapsed = (end - run.started_at).total_seconds() if run.started_at else 0
+        throughput = finished / elapsed * 60 if elapsed > 0 else 0.0
+        eta_seconds = remaining / throughput * 60 if throughput > 0 and remaining else None
+        
+        return {
+            "run_id": str(run.run_uuid),
+            "subject_code": run.subject_code,
+            "exam_session": run.exam_session,
+            "status": run.status,
+            "total": run.total_items,
+            "succeeded": run.succeeded,
+            "failed": run.failed,
+            "skipped": run.skipped,
+            "remaining": remaining,
+            "by_status": by_status,
+            "throughput_per_minute": round(throughput, 2),
+            "eta_seconds": round(eta_seconds) if eta_seconds is not None else None,
+            "created_by": run.created_by,
+            "started_at": run.started_at,
+            "finished_at": run.finished_at,
+        }
+
+
+class BulkSubmissionRunner:
+    """
+    Bounded concurrent pipeline that works through bulk submission runs
+    
+    Items are claimed in chunks, ordered by assignment, with FOR UPDATE
+    SKIP LOCKED, so several processes can work on the same run. Every
+    finished item is committed with the run's counters; an item that
+    raised is handed back, and one left RUNNING by a crashed process is
+    claimed again once its lease expires.
+    Submissions use the admin token and yield to student traffic in the
+    Moodle rate limiter.
+    """
+    
+    def __init__(
+        self,
+        admin_token: Optional[str] = None,
+        concurrency: Optional[int] = None,
+        chunk_size: Optional[int] = None,
+        session_maker: Callable = async_session_maker,
+        poll_seconds: float = 5.0
+    ):
+        self.admin_token = admin_token or settings.moodle_admin_token
+        self.concurrency = concurrency or settings.bulk_submission_concurrency
+        self.chunk_size = chunk_size or settings.bulk_submission_chunk_size
+        self.session_maker = session_maker
+        self.poll_seconds = poll_seconds
+        self._tasks: Dict[int, asyncio.Task] = {}
+    
+    def start(self, run_id: int) -> bool:
+        """Work on a run in the background (no-op if already running here)"""
+        task = self._tasks.get(run_id)
+        if task and not task.done():
+            return False
+        self._tasks[run_id] = asyncio.ensure_future(self.run(run_id))
+        return True
+    
+    async def resume(self) -> int:
+        """Pick up runs that were still going when the process stopped"""
+        if not self.admin_token:
+            return 0
+        async with self.session_maker() as db:
+            result = await db.execute(
+                select(BulkSubmissionRun.id).where(BulkSubmissionRun.status == "RUNNING")
+            )
+            run_ids = list(result.scalars().all())
+        started = sum(1 for run_id in run_ids if self.start(run_id))
+        if started:
+            logger.info(f"Working on {started} bulk submission run(s)")
+        return started
+    
+    async def watch(self, stop_event: asyncio.Event, poll_seconds: float = 5.0) -> None:
+        """Keep picking up new and interrupted runs (standalone worker process)"""
+        while not stop_event.is_set():
+            try:
+                await self.resume()
+            except Exception as e:
+                logger.error(f"Could not look for bulk submission runs: {e}")
+            try:
+                await asyncio.wait_for(stop_event.wait(), poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def stop(self) -> None:
+        """Stop working; unfinished items are picked up again on resume"""
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks = {}
+    
+    async def claim_chunk(self, run_id: int) -> List[int]:
+        """Claim pending (or abandoned) items of a run, grouped by assignment"""
+        now = datetime.now(timezone.utc)
+        lease_expired = now - timedelta(seconds=settings.bulk_submission_lease_seconds)
+        
+        async with self.session_maker() as db:
+            result = await db.execute(
+                select(BulkSubmissionItem)
+                .where(
+                    BulkSubmissionItem.run_id == run_id,
+                    or_(
+                        BulkSubmissionItem.status == "PENDING",
+                        and_(
+                            BulkSubmissionItem.status == "RUNNING",
+                            BulkSubmissionItem.claimed_at < lease_expired
+                        )
+                    )
+                )
+                .order_by(BulkSubmissionItem.assignment_id, BulkSubmissionItem.id)
+                .limit(self.chunk_size)
+                .with_for_update(skip_locked=True)
+            )
+            items = result.scalars().all()
+            for item in items:
+                item.status = "RUNNING"
+                item.claimed_at = now
+            await db.commit()
+            return [item.id for item in items]
+    
+    async def process_item(self, item_id: int) -> str:
+        """
+        Submit one item and checkpoint it
+        
+        Returns:
+            The item's new status
+        """
+        async with self.session_maker() as db:
+            item = await db.get(BulkSubmissionItem, item_id)
+            artifact = await db.get(ExaminationArtifact, item.artifact_id)
+            service = SubmissionService(db)
+            counter = None
+            previous_status = artifact.workflow_status
+            
+            if previous_status in [WorkflowStatus.COMPLETED, WorkflowStatus.SUBMITTED_TO_LMS]:
+                # Submitted by the student (or before a crash) in the meantime
+                item.status = "DONE"
+                counter = "succeeded"
+            elif previous_status not in BULK_SUBMITTABLE_STATUSES + IN_PROGRESS_STATUSES:
+                # Queued for retry or otherwise owned elsewhere
+                item.status = "SKIPPED"
+                item.error = f"Paper is {previous_status.value}"
+                counter = "skipped"
+            elif await SubmissionJobService(db).get_active_for_artifact(artifact.id):
+                item.status = "SKIPPED"
+                item.error = "Paper already has a submission job"
+                counter = "skipped"
+            elif not await service.artifact_service.claim_for_submission(artifact, BULK_SUBMITTABLE_STATUSES):
+                # Being submitted by someone else; look again once they are done
+                item.status = "PENDING"
+                item.error = "Paper is being submitted elsewhere"
+            else:
+                # Commit the claim so the Moodle calls run without a lock
+                await db.commit()
+                try:
+                    with background_priority():
+                        result = await service._execute_submission(
+                            artifact=artifact,
+                            assignment_id=item.assignment_id,
+                            moodle_token=self.admin_token,
+                            lock_submission=True
+                        )
+                    await service.artifact_service.mark_submitted(
+                        artifact_id=artifact.id,
+                        moodle_submission_id=result.get("submission_id"),
+                        lms_transaction_id=result.get("transaction_id")
+                    )
+                    await service.audit_service.log_action(
+                        action="bulk_submission_completed",
+                        action_category="submit",
+                        actor_type="staff",
+                        artifact_id=artifact.id,
+                        response_data=result,
+                        description=f"Submitted by bulk run {item.run_id}"
+                    )
+                    item.status = "DONE"
+                    counter = "succeeded"
+                except MoodleUnavailableError as e:
+                    # Not the paper's fault - hand it back for later
+                    await db.rollback()
+                    item = await db.get(BulkSubmissionItem, item_id)
+                    await service.artifact_service.release_submission_claim(
+                        item.artifact_id,
+                        previous_status if previous_status in BULK_SUBMITTABLE_STATUSES else WorkflowStatus.PENDING
+                    )
+                    item.status = "PENDING"
+                    item.error = str(e)
+                except Exception as e:
+                    await db.rollback()
+                    item = await db.get(BulkSubmissionItem, item_id)
+                    await service.artifact_service.mark_failed(
+                        artifact_id=item.artifact_id,
+                        error_message=f"Bulk submission failed: {e}",
+                        queue_for_retry=False
+                    )
+                    item.status = "FAILED"
+                    item.error = str(e)
+                    counter = "failed"
+            
+            if counter:
+                item.finished_at = datetime.now(timezone.utc)
+                column = getattr(BulkSubmissionRun, counter)
+                await db.execute(
+                    update(BulkSubmissionRun)
+                    .where(BulkSubmissionRun.id == item.run_id)
+                    .values({counter: column + 1})
+                )
+            status = item.status
+            await db.commit()
+            return status
+    
+    async def run(self, run_id: int) -> None:
+        """Work through a run until nothing is left to claim"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def guarded(item_id: int) -> str:
+            async with semaphore:
+                try:
+                    return await self.process_item(item_id)
+                except Exception as e:
+                    logger.error(f"Bulk item {item_id} could not be processed: {e}")
+                    return await self._release(item_id, e)
+        
+        while True:
+            async with self.session_maker() as db:
+                run = await db.get(BulkSubmissionRun, run_id)
+                if not run or run.status != "RUNNING":
+                    return
+            
+            if moodle_guard.is_open:
+                await asyncio.sleep(settings.moodle_breaker_reset_seconds)
+                continue
+            
+            item_ids = await self.claim_chunk(run_id)
+            if not item_ids:
+                if await self._finish_if_done(run_id):
+                    return
+                # Items held elsewhere; poll until they finish or their lease expires
+                await asyncio.sleep(self.poll_seconds)
+                continue
+            
+            statuses = await asyncio.gather(*(guarded(item_id) for item_id in item_ids))
+            if "PENDING" in statuses:
+                # Moodle became unavailable mid-chunk; let the breaker settle
+                await asyncio.sleep(settings.moodle_breaker_reset_seconds)
+    
+    async def _release(self, item_id: int, error: Exception) -> str:
+        """Hand a crashed item back to the run (the lease covers a failed release)"""
+        try:
+            async with self.session_maker() as db:
+                await db.execute(
+                    update(BulkSubmissionItem)
+                    .where(BulkSubmissionItem.id == item_id, BulkSubmissionItem.status == "RUNNING")
+                    .values(status="PENDING", error=str(error))
+                )
+                await db.commit()
+            return "PENDING"
+        except Exception as e:
+            logger.error(f"Bulk item {item_id} could not be handed back: {e}")
+            return "ERROR"
+    
+    async def _finish_if_done(self, run_id: int) -> bool:
+        async with self.session_maker() as db:
+            result = await db.execute(
+                select(func.count(BulkSubmissionItem.id)).where(
+                    BulkSubmissionItem.run_id == run_id,
+                    BulkSubmissionItem.status.in_(["PENDING", "RUNNING"])
+                )
+            )
+            if result.scalar():
+                # Another process still holds some items
+                return False
+            await db.execute(
+                update(BulkSubmissionRun)
+                .where(BulkSubmissionRun.id == run_id, BulkSubmissionRun.status == "RUNNING")
+                .values(status="COMPLETED", finished_at=datetime.now(timezone.utc))
+            )
+            await db.commit()
+        logger.info(f"Bulk submission run {run_id} completed")
+        return True
+    
+    def active_runs(self) -> Set[int]:
+        return {run_id for run_id, task in self._tasks.items() if not task.done()}
+
+
+# Global instance
+bulk_submission_runner = BulkSubmissionRunner()
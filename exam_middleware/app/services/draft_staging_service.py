@@ -0,0 +1,185 @@
+"""
+Draft Staging Service
+Uploads pending papers to the student's Moodle draft area ahead of submit
+"""
+
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List, Set, Callable
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.orm.attributes import flag_modified
+
+from app.core.config import settings
+from app.db.database import async_session_maker
+from app.db.models import ExaminationArtifact, WorkflowStatus
+from app.services.moodle_client import MoodleClient
+from app.services.moodle_guard import moodle_guard
+from app.services.moodle_rate_limiter import background_priority
+
+logger = logging.getLogger(__name__)
+
+# Statuses a paper can be staged (and submitted) from
+STAGEABLE_STATUSES = [
+    WorkflowStatus.PENDING,
+    WorkflowStatus.PENDING_REVIEW,
+    WorkflowStatus.VALIDATED,
+    WorkflowStatus.READY_FOR_REVIEW,
+]
+
+
+def staged_draft_item(artifact: ExaminationArtifact, moodle_user_id: Optional[int]) -> Optional[int]:
+    """
+    Draft item id pre-staged for this user, if it can still be used
+    
+    Drafts live in the uploading user's draft area and Moodle's cron purges
+    old ones, so a staged draft is only reused by the same user and within
+    SUBMISSION_PRESTAGE_MAX_AGE_HOURS.
+    """
+    if not artifact.moodle_draft_item_id or moodle_user_id is None:
+        return None
+    
+    for entry in reversed(artifact.transaction_log or []):
+        if entry.get("action") != "draft_staged":
+            continue
+        details = entry.get("details", {})
+        staged_at = datetime.fromisoformat(entry["timestamp"])
+        if (
+            details.get("item_id") == artifact.moodle_draft_item_id
+            and details.get("moodle_user_id") == moodle_user_id
+            and datetime.utcnow() - staged_at < timedelta(hours=settings.submission_prestage_max_age_hours)
+        ):
+            return artifact.moodle_draft_item_id
+        return None
+    
+    return None
+
+
+class DraftStager:
+    """
+    Background pre-staging of draft uploads
+    
+    When a student opens the dashboard, their pending papers are uploaded
+    to their Moodle draft area in the background and the draft item id is
+    recorded on the artifact. Submitting then only needs save_submission
+    (and submit_for_grading), which takes well under a second.
+    
+    Staging is best effort: failures are logged and the submit falls back
+    to uploading the file itself.
+    """
+    
+    def __init__(
+        self,
+        concurrency: Optional[int] = None,
+        session_maker: Callable = async_session_maker
+    ):
+        self.concurrency = concurrency or settings.submission_prestage_concurrency
+        self.session_maker = session_maker
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._in_flight: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+    
+    def schedule(
+        self,
+        artifacts: List[ExaminationArtifact],
+        moodle_token: str,
+        moodle_user_id: int
+    ) -> int:
+        """
+        Start staging the given artifacts without waiting for it
+        
+        Returns:
+            Number of artifacts a staging task was started for
+        """
+        if not settings.submission_prestage_enabled or moodle_guard.is_open:
+            return 0
+        
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+            self._in_flight = set()
+        
+        started = 0
+        for artifact in artifacts:
+            if artifact.id in self._in_flight or staged_draft_item(artifact, moodle_user_id):
+                continue
+            self._in_flight.add(artifact.id)
+            task = asyncio.ensure_future(self._stage(artifact.id, moodle_token, moodle_user_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            started += 1
+        
+        return started
+    
+    async def _stage(self, artifact_id: int, moodle_token: str, moodle_user_id: int) -> None:
+        try:
+            async with self._semaphore:
+                await self.stage(artifact_id, moodle_token, moodle_user_id)
+        except Exception as e:
+            logger.warning(f"Pre-staging artifact {artifact_id} failed: {e}")
+        finally:
+            self._in_flight.discard(artifact_id)
+    
+    async def stage(self, artifact_id: int, moodle_token: str, moodle_user_id: int) -> Optional[int]:
+        """
+        Upload one artifact to the user's draft area and record the item id
+        
+        Returns:
+            The draft item id, or None if the artifact was not staged
+        """
+        async with self.session_maker() as db:
+            artifact = await db.get(ExaminationArtifact, artifact_id)
+            if not artifact or artifact.workflow_status not in STAGEABLE_STATUSES:
+                return None
+            if staged_draft_item(artifact, moodle_user_id):
+                return artifact.moodle_draft_item_id
+            file_path = artifact.file_blob_path
+            filename = artifact.original_filename
+            await db.rollback()  # don't hold a transaction open during the upload
+            
+            # Pre-staging must never slow down students who are submitting
+            with background_priority():
+                upload_result = await MoodleClient(token=moodle_token).upload_file(
+                    file_path=file_path,
+                    token=moodle_token,
+                    filename=filename
+                )
+            item_id = upload_result["itemid"]
+            
+            # Lock the row: if a submit started meanwhile it owns the draft id
+            result = await db.execute(
+                select(ExaminationArtifact)
+                .where(ExaminationArtifact.id == artifact_id)
+                .with_for_update()
+            )
+            artifact = result.scalar_one_or_none()
+            if not artifact or artifact.workflow_status not in STAGEABLE_STATUSES:
+                await db.rollback()
+                return None
+            
+            artifact.moodle_draft_item_id = item_id
+            artifact.add_log_entry("draft_staged", {
+                "item_id": item_id,
+                "moodle_user_id": moodle_user_id
+            })
+            flag_modified(artifact, "transaction_log")
+            await db.commit()
+        
+        logger.info(f"Pre-staged artifact {artifact_id} as draft item {item_id}")
+        return item_id
+    
+    async def stop(self) -> None:
+        """Cancel staging still in progress (the submit will upload instead)"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._in_flight)}
+
+
+# Global instance
+draft_stager = DraftStager()
@@ -5,10 +5,14 @@ Handles filename parsing, validation, and file operations
 
 import os
 import re
+import asyncio
+import shutil
+import tarfile
+import zipfile
 import uuid
 import hashlib
 import logging
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List, IO, Iterator, AsyncIterator
 from datetime import datetime
 import aiofiles
 import aiofiles.os
@@ -19,6 +23,21 @@ from app.core.security import sanitize_filename, compute_file_hash
 logger = logging.getLogger(__name__)
 
 
+class _IngestRejected(Exception):
+    """Raised internally when a streamed upload fails validation"""
+
+
+class _ArchiveMemberStream:
+    """Async read() adapter over a zipfile/tarfile member"""
+    
+    def __init__(self, fileobj: IO[bytes]):
+        self._fileobj = fileobj
+    
+    async def read(self, size: int = -1) -> bytes:
+        # Member reads decompress and hit disk - keep them off the event loop
+        return await asyncio.to_thread(self._fileobj.read, size)
+
+
 class FileProcessor:
     """
     Service for processing uploaded examination files
@@ -40,6 +59,12 @@ class FileProcessor:
         re.IGNORECASE
     )
     
+    # Content-addressed blob store (see blob_path)
+    BLOB_DIR = "blobs"
+    
+    # Archive formats accepted by ingest_archive
+    ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+    
     def __init__(self, upload_dir: Optional[str] = None):
         self.upload_dir = upload_dir or settings.upload_dir
         self._ensure_upload_dir()
@@ -49,7 +74,7 @@ class FileProcessor:
         os.makedirs(self.upload_dir, exist_ok=True)
         
         # Create subdirectories for organization
-        for subdir in ['pending', 'processed', 'failed', 'temp']:
+        for subdir in ['pending', 'processed', 'failed', 'temp', self.BLOB_DIR]:
             os.makedirs(os.path.join(self.upload_dir, subdir), exist_ok=True)
     
     def parse_filename(self, filename: str) -> Tuple[Optional[str], Optional[str], bool]:
@@ -137,6 +162,72 @@ class FileProcessor:
         
         return True, "File validated successfully", metadata
     
+    async def inspect_file(
+        self,
+        file_path: str,
+        filename: Optional[str] = None
+    ) -> Tuple[bool, str, Dict[str, Any]]:
+        """
+        Validate a file that is already on disk without loading it
+        
+        Applies the same checks as validate_file, but hashes the file in
+        chunks and only sniffs the first bytes, so scans written straight
+        to disk (e.g. by a scanner into a hot folder) need no extra copy.
+        
+        Args:
+            file_path: Path of the file to inspect
+            filename: Name to parse (defaults to the basename of file_path)
+            
+        Returns:
+            Tuple of (is_valid, message, metadata)
+        """
+        filename = filename or os.path.basename(file_path)
+        
+        def _hash_and_sniff() -> Tuple[int, str, bytes]:
+            hasher = hashlib.sha256()
+            size = 0
+            head = b""
+            with open(file_path, 'rb') as f:
+                while True:
+                    chunk = f.read(settings.upload_chunk_size_bytes)
+                    if not chunk:
+                        break
+                    if not size:
+                        head = chunk[:16]
+                    size += len(chunk)
+                    hasher.update(chunk)
+            return size, hasher.hexdigest(), head
+        
+        size, file_hash, head = await asyncio.to_thread(_hash_and_sniff)
+        metadata: Dict[str, Any] = {
+            "original_filename": filename,
+            "size_bytes": size,
+            "hash": file_hash
+        }
+        
+        if size > settings.max_file_size_bytes:
+            return False, f"File too large. Max size: {settings.max_file_size_mb}MB", metadata
+        
+        ext = os.path.splitext(filename)[1].lower()
+        if ext not in settings.allowed_extensions_list:
+            return False, f"Invalid file type. Allowed: {settings.allowed_extensions}", metadata
+        
+        mime_type = self._detect_mime_type(head)
+        if not mime_type:
+            return False, "Could not determine file type", metadata
+        
+        metadata["mime_type"] = mime_type
+        
+        register_no, subject_code, is_parsed = self.parse_filename(filename)
+        metadata["parsed_register_no"] = register_no
+        metadata["parsed_subject_code"] = subject_code
+        metadata["filename_valid"] = is_parsed
+        
+        if not is_parsed:
+            return False, "Invalid filename format. Expected: REGISTER_SUBJECT.pdf", metadata
+        
+        return True, "File validated successfully", metadata
+    
     def _detect_mime_type(self, content: bytes) -> Optional[str]:
         """Detect MIME type from file content magic bytes"""
         # PDF magic bytes
@@ -153,50 +244,337 @@ class FileProcessor:
         
         return None
     
+    def shard_path(self, subfolder: str, filename: str) -> str:
+        """
+        Two-level sharded location for a file inside a subfolder
+        
+        Files fan out by the first four characters of their (hash or uuid
+        hex) name, e.g. processed/3f/a2/3fa2...e1.pdf, which keeps every
+        directory small even with tens of thousands of scans per cycle.
+        """
+        return os.path.join(
+            self.upload_dir,
+            subfolder,
+            filename[:2],
+            filename[2:4],
+            filename
+        )
+    
+    def blob_path(self, file_hash: str, extension: str) -> str:
+        """
+        Location of a blob in the content-addressed store
+        
+        Blobs are sharded by their SHA-256 (see shard_path), e.g.
+        blobs/3f/a2/3fa2...e1.pdf, so identical uploads share one file.
+        """
+        return self.shard_path(self.BLOB_DIR, f"{file_hash}{extension.lower()}")
+    
+    async def _commit_file(
+        self,
+        temp_path: str,
+        file_hash: str,
+        extension: str,
+        subfolder: Optional[str] = None
+    ) -> Tuple[str, bool]:
+        """
+        Atomically move a fully written temp file to its final location
+        
+        Returns:
+            Tuple of (file_path, deduplicated). When the blob already exists
+            the temp file is discarded instead of being written again.
+        """
+        if subfolder:
+            file_path = self.shard_path(subfolder, f"{uuid.uuid4().hex}{extension}")
+        else:
+            file_path = self.blob_path(file_hash, extension)
+            if await aiofiles.os.path.exists(file_path):
+                await self.delete_file(temp_path)
+                return file_path, True
+        
+        await aiofiles.os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        await aiofiles.os.replace(temp_path, file_path)
+        return file_path, False
+    
     async def save_file(
         self,
         file_content: bytes,
         original_filename: str,
-        subfolder: str = "pending"
+        subfolder: Optional[str] = None
     ) -> Tuple[str, str]:
         """
         Save file to storage
         
+        By default the file goes to the content-addressed blob store and the
+        write is skipped entirely when a blob with the same hash exists.
+        
         Args:
             file_content: Raw file bytes
             original_filename: Original filename
-            subfolder: Subdirectory (pending, processed, etc.)
+            subfolder: Optional flat subdirectory (pending, processed, etc.)
+                instead of the blob store
             
         Returns:
             Tuple of (file_path, file_hash)
         """
-        # Generate unique filename
         file_hash = compute_file_hash(file_content)
         ext = os.path.splitext(original_filename)[1].lower()
-        unique_filename = f"{uuid.uuid4().hex}{ext}"
         
-        # Build path
-        file_path = os.path.join(self.upload_dir, subfolder, unique_filename)
+        # Fast path: identical content is already stored
+        if not subfolder:
+            file_path = self.blob_path(file_hash, ext)
+            if await aiofiles.os.path.exists(file_path):
+                logger.info(f"Blob already stored: {file_path}")
+                return file_path, file_hash
         
-        # Ensure directory exists
-        await aiofiles.os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Write to temp first so readers never see a partial file
+        temp_path = os.path.join(self.upload_dir, "temp", f"{uuid.uuid4().hex}.part")
+        await aiofiles.os.makedirs(os.path.dirname(temp_path), exist_ok=True)
         
-        # Write file
-        async with aiofiles.open(file_path, 'wb') as f:
+        async with aiofiles.open(temp_path, 'wb') as f:
             await f.write(file_content)
         
+        file_path, _ = await self._commit_file(temp_path, file_hash, ext, subfolder)
+        
         logger.info(f"Saved file: {file_path} (hash: {file_hash[:16]}...)")
         
         return file_path, file_hash
     
+    async def ingest_stream(
+        self,
+        stream: Any,
+        filename: str,
+        subfolder: Optional[str] = None,
+        chunk_size: Optional[int] = None
+    ) -> Tuple[bool, str, Dict[str, Any]]:
+        """
+        Validate and store an upload without buffering it in memory
+        
+        Reads the stream in chunks, sniffs magic bytes from the first chunk,
+        feeds a running SHA-256 and enforces the size limit as bytes arrive.
+        Data is written to temp/ and, once the whole stream has been accepted,
+        atomically renamed into the blob store (or discarded if that blob
+        already exists).
+        
+        Args:
+            stream: Object with an async read(size) method (e.g. UploadFile)
+            filename: Original filename
+            subfolder: Optional flat subdirectory instead of the blob store
+            chunk_size: Read size in bytes (defaults to settings)
+        
+        Returns:
+            Tuple of (is_valid, message, metadata). On success metadata
+            contains file_path, hash, size_bytes, mime_type and deduplicated.
+        """
+        chunk_size = chunk_size or settings.upload_chunk_size_bytes
+        metadata: Dict[str, Any] = {
+            "original_filename": filename,
+            "size_bytes": 0,
+        }
+        
+        # Cheap checks first - reject before reading a single byte
+        ext = os.path.splitext(filename)[1].lower()
+        if ext not in settings.allowed_extensions_list:
+            return False, f"Invalid file type. Allowed: {settings.allowed_extensions}", metadata
+        
+        register_no, subject_code, is_parsed = self.parse_filename(filename)
+        metadata["parsed_register_no"] = register_no
+        metadata["parsed_subject_code"] = subject_code
+        metadata["filename_valid"] = is_parsed
+        
+        if not is_parsed:
+            return False, "Invalid filename format. Expected: REGISTER_SUBJECT.pdf", metadata
+        
+        temp_path = os.path.join(self.upload_dir, "temp", f"{uuid.uuid4().hex}.part")
+        hasher = hashlib.sha256()
+        size = 0
+        
+        await aiofiles.os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+        
+        try:
+            async with aiofiles.open(temp_path, 'wb') as out:
+                while True:
+                    chunk = await stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    
+                    if size == 0:
+                        mime_type = self._detect_mime_type(chunk)
+                        if not mime_type:
+                            raise _IngestRejected("Could not determine file type")
+                        metadata["mime_type"] = mime_type
+                    
+                    size += len(chunk)
+                    if size > settings.max_file_size_bytes:
+                        raise _IngestRejected(
+                            f"File too large. Max size: {settings.max_file_size_mb}MB"
+                        )
+                    
+                    hasher.update(chunk)
+                    await out.write(chunk)
+            
+            metadata["size_bytes"] = size
+            if size == 0:
+                raise _IngestRejected("Could not determine file type")
+            
+            file_hash = hasher.hexdigest()
+            file_path, deduplicated = await self._commit_file(temp_path, file_hash, ext, subfolder)
+        
+        except _IngestRejected as e:
+            metadata["size_bytes"] = size
+            await self.delete_file(temp_path)
+            return False, str(e), metadata
+        except Exception:
+            await self.delete_file(temp_path)
+            raise
+        
+        metadata["hash"] = file_hash
+        metadata["file_path"] = file_path
+        metadata["deduplicated"] = deduplicated
+        
+        logger.info(
+            f"Streamed file: {file_path} ({size} bytes, hash: {file_hash[:16]}..."
+            f"{', deduplicated' if deduplicated else ''})"
+        )
+        return True, "File validated successfully", metadata
+    
+    async def ingest_many(
+        self,
+        uploads: List[Tuple[Any, str]],
+        subfolder: Optional[str] = None,
+        concurrency: Optional[int] = None
+    ) -> List[Tuple[bool, str, Dict[str, Any]]]:
+        """
+        Run ingest_stream over many uploads with bounded parallelism
+        
+        Args:
+            uploads: List of (stream, filename) pairs
+            subfolder: Optional flat subdirectory instead of the blob store
+            concurrency: Max uploads processed at once (defaults to settings)
+        
+        Returns:
+            One (is_valid, message, metadata) tuple per upload, in input order.
+            Unexpected errors are reported as failed results, not raised.
+        """
+        semaphore = asyncio.Semaphore(concurrency or settings.bulk_upload_concurrency)
+        
+        async def _ingest_one(stream: Any, filename: str) -> Tuple[bool, str, Dict[str, Any]]:
+            async with semaphore:
+                try:
+                    return await self.ingest_stream(stream, filename, subfolder=subfolder)
+                except Exception as e:
+                    logger.error(f"Failed to save file {filename}: {e}")
+                    return False, f"Failed to process: {str(e)}", {"original_filename": filename}
+        
+        return list(await asyncio.gather(
+            *(_ingest_one(stream, filename) for stream, filename in uploads)
+        ))
+    
+    def is_archive(self, filename: str) -> bool:
+        """Check whether a filename looks like a supported archive"""
+        return filename.lower().endswith(self.ARCHIVE_EXTENSIONS)
+    
+    def _iter_archive_members(self, fileobj: IO[bytes]) -> Iterator[Tuple[str, IO[bytes]]]:
+        """
+        Yield (member_name, file object) for each regular file in an archive
+        
+        ZIPs are read through their central directory; anything else is
+        opened as a tar stream (plain or compressed), so members are read
+        one after another and never extracted to disk.
+        """
+        if zipfile.is_zipfile(fileobj):
+            fileobj.seek(0)
+            with zipfile.ZipFile(fileobj) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    with archive.open(info) as member:
+                        yield info.filename, member
+            return
+        
+        fileobj.seek(0)
+        try:
+            archive = tarfile.open(fileobj=fileobj, mode="r|*")
+        except tarfile.TarError as e:
+            raise ValueError("Unsupported or corrupt archive") from e
+        
+        with archive:
+            for info in archive:
+                if not info.isfile():
+                    continue
+                member = archive.extractfile(info)
+                if member is not None:
+                    yield info.name, member
+    
+    async def ingest_archive(
+        self,
+        fileobj: IO[bytes],
+        batch_size: Optional[int] = None
+    ) -> AsyncIterator[List[Tuple[str, bool, str, Dict[str, Any]]]]:
+        """
+        Stream every member of a ZIP/TAR archive through ingest_stream
+        
+        Members are validated and stored one at a time straight from the
+        archive, so neither the archive nor its contents are unpacked to
+        disk or held in memory. Results are yielded in batches so the
+        caller can create artifacts batch by batch.
+        
+        Args:
+            fileobj: Seekable binary file holding the archive
+            batch_size: Members per yielded batch (defaults to settings)
+        
+        Yields:
+            Lists of (filename, is_valid, message, metadata) tuples
+        
+        Raises:
+            ValueError: If the file is not a readable ZIP or TAR archive
+        """
+        batch_size = batch_size or settings.archive_batch_size
+        members = self._iter_archive_members(fileobj)
+        batch: List[Tuple[str, bool, str, Dict[str, Any]]] = []
+        
+        try:
+            while True:
+                try:
+                    entry = await asyncio.to_thread(next, members, None)
+                except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+                    raise ValueError(f"Corrupt archive: {e}") from e
+                if entry is None:
+                    break
+                
+                member_name, member = entry
+                filename = os.path.basename(member_name)
+                # Skip folders and OS metadata (__MACOSX/, ._foo.pdf, .DS_Store)
+                if not filename or filename.startswith('.') or '__MACOSX' in member_name:
+                    continue
+                
+                try:
+                    is_valid, message, metadata = await self.ingest_stream(
+                        _ArchiveMemberStream(member), filename
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to save archive member {member_name}: {e}")
+                    is_valid, message, metadata = (
+                        False, f"Failed to process: {str(e)}", {"original_filename": filename}
+                    )
+                
+                batch.append((filename, is_valid, message, metadata))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            
+            if batch:
+                yield batch
+        finally:
+            members.close()
+    
     async def move_file(
         self,
         source_path: str,
         destination_subfolder: str
     ) -> str:
-        """Move file to different subfolder"""
+        """Move file to the sharded layout of a different subfolder"""
         filename = os.path.basename(source_path)
-        dest_path = os.path.join(self.upload_dir, destination_subfolder, filename)
+        dest_path = self.shard_path(destination_subfolder, filename)
         
         await aiofiles.os.makedirs(os.path.dirname(dest_path), exist_ok=True)
         await aiofiles.os.rename(source_path, dest_path)
@@ -204,6 +582,46 @@ class FileProcessor:
         logger.info(f"Moved file: {source_path} -> {dest_path}")
         return dest_path
     
+    async def relocate_to_store(self, source_path: str, file_hash: str) -> str:
+        """
+        Place an existing file at its blob store location without removing it
+        
+        Used by the storage layout migration. The file is hard-linked into
+        place (copied if linking is not possible) so the old path stays
+        readable until the database points at the new one; the caller
+        deletes the source afterwards.
+        
+        Args:
+            source_path: Current location of the file
+            file_hash: SHA-256 recorded for the file
+            
+        Returns:
+            Blob store path for the file
+        """
+        ext = os.path.splitext(source_path)[1].lower()
+        dest_path = self.blob_path(file_hash, ext)
+        
+        if os.path.abspath(source_path) == os.path.abspath(dest_path):
+            return dest_path
+        if await aiofiles.os.path.exists(dest_path):
+            return dest_path
+        
+        await aiofiles.os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        temp_path = os.path.join(self.upload_dir, "temp", f"{uuid.uuid4().hex}.part")
+        try:
+            try:
+                await aiofiles.os.link(source_path, temp_path)
+            except OSError:
+                # Cross-device or unsupported filesystem - fall back to a copy
+                await asyncio.to_thread(shutil.copyfile, source_path, temp_path)
+            await aiofiles.os.replace(temp_path, dest_path)
+        except OSError:
+            await self.delete_file(temp_path)
+            raise
+        
+        logger.info(f"Relocated file: {source_path} -> {dest_path}")
+        return dest_path
+    
     async def delete_file(self, file_path: str) -> bool:
         """Delete a file"""
         try:
@@ -0,0 +1,283 @@
+"""
+Hot Folder Ingest Service
+Picks up scanner output from a watched directory without going through HTTP
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List, Tuple, Callable
+
+import aiofiles.os
+from watchfiles import awatch, Change
+
+from app.core.config import settings
+from app.db.database import async_session_maker
+from app.services.file_processor import FileProcessor, file_processor
+from app.services.artifact_service import ArtifactService, AuditService
+
+logger = logging.getLogger(__name__)
+
+
+class HotFolderIngestor:
+    """
+    Ingest daemon for scanner hot folders
+    
+    Scanning stations drop files into a (network) directory. The ingestor:
+    1. Tracks new/changed files reported by inotify (via watchfiles)
+    2. Waits until a file has stopped changing for settle_seconds, so
+       half-written scans are never picked up
+    3. Validates it in place and hard-links it into the blob store
+    4. Creates artifacts for a whole batch in one transaction, then removes
+       the originals
+    
+    Files that fail validation are moved to <watch_dir>/rejected/.
+    """
+    
+    REJECTED_DIR = "rejected"
+    
+    # Temp names scanners use while a file is still being written
+    IGNORED_SUFFIXES = ('.tmp', '.part', '.crdownload', '~')
+    
+    def __init__(
+        self,
+        watch_dir: str,
+        settle_seconds: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        processor: Optional[FileProcessor] = None,
+        session_maker: Callable = async_session_maker
+    ):
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.rejected_dir = os.path.join(self.watch_dir, self.REJECTED_DIR)
+        self.settle_seconds = settings.hot_folder_settle_seconds if settle_seconds is None else settle_seconds
+        self.batch_size = batch_size or settings.hot_folder_batch_size
+        self.processor = processor or file_processor
+        self.session_maker = session_maker
+        
+        # path -> (size, mtime) from the last time the file was seen
+        self._pending: Dict[str, Tuple[int, float]] = {}
+        
+        os.makedirs(self.rejected_dir, exist_ok=True)
+    
+    def _is_candidate(self, path: str) -> bool:
+        """Skip the rejected folder, hidden files and scanner temp files"""
+        name = os.path.basename(path)
+        if not name or name.startswith('.') or name.lower().endswith(self.IGNORED_SUFFIXES):
+            return False
+        return not os.path.abspath(path).startswith(self.rejected_dir + os.sep)
+    
+    def track(self, path: str) -> None:
+        """Register a created/modified file; it is ingested once it settles"""
+        if not self._is_candidate(path):
+            return
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._pending.pop(path, None)
+            return
+        self._pending[path] = (stat.st_size, stat.st_mtime)
+    
+    def scan_existing(self) -> None:
+        """Pick up files written while the daemon was not running"""
+        for root, dirs, files in os.walk(self.watch_dir):
+            dirs[:] = [d for d in dirs if os.path.join(root, d) != self.rejected_dir]
+            for name in files:
+                self.track(os.path.join(root, name))
+    
+    def settled(self, now: Optional[float] = None) -> List[str]:
+        """
+        Files whose size and mtime are unchanged and older than settle_seconds
+        
+        Files that changed since they were last seen get their new size
+        recorded and are checked again on the next tick.
+        """
+        now = time.time() if now is None else now
+        ready = []
+        
+        for path, (size, mtime) in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self._pending[path] = (stat.st_size, stat.st_mtime)
+                continue
+            
+            if now - stat.st_mtime >= self.settle_seconds:
+                ready.append(path)
+        
+        return sorted(ready)
+    
+    async def _reject(self, path: str, message: str) -> None:
+        """
+        Move a file that cannot be ingested out of the watch folder
+        
+        Scanners reuse names, so the moved file gets a timestamp and a short
+        unique suffix to keep earlier rejects with the same name.
+        """
+        self._pending.pop(path, None)
+        stem, ext = os.path.splitext(os.path.basename(path))
+        suffix = f"{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        target = os.path.join(self.rejected_dir, f"{stem}_{suffix}{ext}")
+        try:
+            await aiofiles.os.replace(path, target)
+        except OSError as e:
+            logger.error(f"Could not move rejected file {path}: {e}")
+            return
+        logger.warning(f"Rejected hot folder file {path}: {message}")
+    
+    async def ingest_batch(self, paths: List[str]) -> Dict[str, int]:
+        """
+        Validate, store and register a batch of settled files
+        
+        Files are linked into the blob store first and only removed from the
+        hot folder after the artifact rows are committed; if the transaction
+        fails they stay in place and are retried on the next tick.
+        
+        Returns:
+            Counts of ingested, rejected and failed files
+        """
+        stats = {"ingested": 0, "rejected": 0, "failed": 0}
+        accepted: List[Tuple[str, Dict[str, Any]]] = []
+        
+        for path in paths:
+            try:
+                is_valid, message, metadata = await self.processor.inspect_file(path)
+                if not is_valid:
+                    await self._reject(path, message)
+                    stats["rejected"] += 1
+                    continue
+                
+                # Only blobs this ingest adds to the store are its to clean up
+                ext = os.path.splitext(path)[1].lower()
+                metadata["deduplicated"] = await aiofiles.os.path.exists(
+                    self.processor.blob_path(metadata["hash"], ext)
+                )
+                metadata["file_path"] = await self.processor.relocate_to_store(path, metadata["hash"])
+            except FileNotFoundError:
+                self._pending.pop(path, None)
+                continue
+            except OSError as e:
+                # Unreadable or not yet copied completely; stays put for the next tick
+                logger.error(f"Could not ingest hot folder file {path}: {e}")
+                stats["failed"] += 1
+                continue
+            
+            accepted.append((path, metadata))
+        
+        if not accepted:
+            return stats
+        
+        async with self.session_maker() as db:
+            artifact_service = ArtifactService(db)
+            try:
+                created = await artifact_service.create_artifacts_bulk([
+                    {
+                        "raw_filename": metadata["original_filename"],
+                        "original_filename": metadata["original_filename"],
+                        "file_blob_path": metadata["file_path"],
+                        "file_hash": metadata["hash"],
+                        "parsed_reg_no": metadata.get("parsed_register_no"),
+                        "parsed_subject_code": metadata.get("parsed_subject_code"),
+                        "file_size_bytes": metadata.get("size_bytes"),
+                        "mime_type": metadata.get("mime_type"),
+                    }
+                    for _, metadata in accepted
+                ])
+                
+                await AuditService(db).log_action(
+                    action="hot_folder_ingest",
+                    action_category="upload",
+                    actor_type="system",
+                    description=(
+                        f"Hot folder ingest: {len(created)} file(s) from {self.watch_dir}, "
+                        f"{sum(1 for _, duplicate in created if duplicate)} already uploaded"
+                    ),
+                    request_data={"files": [metadata["original_filename"] for _, metadata in accepted]}
+                )
+                
+                await db.commit()
+            except Exception as e:
+                logger.error(f"Failed to create artifacts for hot folder batch: {e}")
+                await db.rollback()
+                
+                # New blobs that nothing references are removed; originals stay for retry
+                try:
+                    created = [metadata for _, metadata in accepted if not metadata["deduplicated"]]
+                    hashes = [metadata["hash"] for metadata in created]
+                    await artifact_service.lock_blobs(hashes, exclusive=True)
+                    counts = await artifact_service.get_blob_reference_counts(hashes)
+                    for metadata in created:
+                        if counts.get(metadata["hash"], 0) == 0:
+                            await self.processor.delete_file(metadata["file_path"])
+                except Exception as cleanup_error:
+                    logger.error(f"Could not clean up hot folder blobs: {cleanup_error}")
+                
+                stats["failed"] += len(accepted)
+                return stats
+            
+            # Duplicates resolve to an existing artifact and leave new blobs unreferenced
+            try:
+                hashes = [metadata["hash"] for _, metadata in accepted if not metadata["deduplicated"]]
+                await artifact_service.lock_blobs(hashes, exclusive=True)
+                counts = await artifact_service.get_blob_reference_counts(hashes)
+            except Exception as e:
+                # Keeping an orphaned blob is harmless; the artifacts are committed
+                logger.error(f"Could not check hot folder blob references: {e}")
+                counts = None
+        
+        for path, metadata in accepted:
+            if counts is not None and counts.get(metadata["hash"], 1) == 0:
+                await self.processor.delete_file(metadata["file_path"])
+            await self.processor.delete_file(path)
+            self._pending.pop(path, None)
+        
+        stats["ingested"] += len(accepted)
+        logger.info(f"Hot folder batch: {stats}")
+        return stats
+    
+    async def process_settled(self) -> Dict[str, int]:
+        """Ingest everything that has settled, batch_size files per transaction"""
+        totals = {"ingested": 0, "rejected": 0, "failed": 0}
+        ready = self.settled()
+        
+        for start in range(0, len(ready), self.batch_size):
+            stats = await self.ingest_batch(ready[start:start + self.batch_size])
+            for key, value in stats.items():
+                totals[key] += value
+        
+        return totals
+    
+    async def run(self, stop_event: Optional[asyncio.Event] = None) -> None:
+        """
+        Watch the folder until stop_event is set
+        
+        Uses inotify through watchfiles; the watcher also wakes up every
+        settle interval so quiet files are ingested without a new event.
+        Network shares do not deliver inotify events for remote writes, so
+        HOT_FOLDER_FORCE_POLLING switches to polling.
+        """
+        logger.info(f"Watching hot folder: {self.watch_dir}")
+        self.scan_existing()
+        tick_ms = max(int(self.settle_seconds * 1000 / 2), 200)
+        
+        async for changes in awatch(
+            self.watch_dir,
+            stop_event=stop_event,
+            rust_timeout=tick_ms,
+            yield_on_timeout=True,
+            debounce=tick_ms,
+            force_polling=settings.hot_folder_force_polling,
+            poll_delay_ms=tick_ms
+        ):
+            for change, path in changes:
+                if change == Change.deleted:
+                    self._pending.pop(path, None)
+                else:
+                    self.track(path)
+            
+            await self.process_settled()
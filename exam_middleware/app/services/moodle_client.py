@@ -7,14 +7,20 @@ Implements the 3-step submission process from the design document
 import httpx
 import logging
 import base64
-from typing import Optional, Dict, Any, Tuple, List
-from dataclasses import dataclass
+import asyncio
+import json
+import uuid
+from typing import Optional, Dict, Any, Tuple, List, AsyncIterator
+from dataclasses import dataclass, field
 from datetime import datetime
+from functools import wraps
 import aiofiles
+import aiofiles.os
 import os
 
 from app.core.config import settings
 from app.core.security import token_encryption
+from app.core.cache import cache, SimpleCache, SingleFlight
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +43,149 @@ class MoodleAPIError(Exception):
         super().__init__(self.message)
 
 
+class MoodleUnavailableError(MoodleAPIError):
+    """Moodle could not be reached, or the backend guard is shedding load"""
+    def __init__(self, message: str):
+        super().__init__(
+            message,
+            error=MoodleError(exception="moodle_unavailable", errorcode="unavailable", message=message)
+        )
+
+
+@dataclass
+class MoodleCall:
+    """A web service function call to run as part of a batch"""
+    function: str
+    arguments: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class MoodleCallResult:
+    """Outcome of one call in a batch: either data or an error"""
+    function: str
+    data: Any = None
+    error: Optional[MoodleAPIError] = None
+    
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+    
+    def unwrap(self) -> Any:
+        """Return the data, raising the call's MoodleAPIError if it failed"""
+        if self.error is not None:
+            raise self.error
+        return self.data
+
+
+# =========================================
+# Shared Connection Pool
+# =========================================
+
+_shared_client: Optional[httpx.AsyncClient] = None
+_shared_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional h2 package (httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def get_shared_http_client() -> httpx.AsyncClient:
+    """
+    Process-wide HTTP client for all Moodle traffic
+    
+    Every MoodleClient uses this pool, so submissions, logins and discovery
+    reuse warm keep-alive (and, with h2 installed, multiplexed HTTP/2)
+    connections instead of paying a TCP/TLS handshake per call. Tokens are
+    sent per request in the form data and never stored on the pool.
+    
+    The pool is tied to the event loop that created it and is rebuilt if
+    used from a different loop (e.g. successive asyncio.run() calls in
+    scripts).
+    """
+    global _shared_client, _shared_client_loop
+    
+    # Imported here: the guard module depends on this one
+    from app.services.moodle_guard import GuardedTransport, moodle_guard
+    from app.services.moodle_rate_limiter import moodle_rate_limiter
+    
+    loop = asyncio.get_running_loop()
+    if _shared_client is None or _shared_client.is_closed or _shared_client_loop is not loop:
+        http2 = settings.moodle_http2 and _http2_available()
+        if settings.moodle_http2 and not http2:
+            logger.warning("MOODLE_HTTP2 is enabled but h2 is not installed - using HTTP/1.1")
+        
+        # Every request passes the rate limiter, circuit breaker and adaptive limiter
+        transport = GuardedTransport(
+            httpx.AsyncHTTPTransport(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=settings.moodle_max_connections,
+                    max_keepalive_connections=settings.moodle_max_keepalive_connections,
+                    keepalive_expiry=settings.moodle_keepalive_expiry_seconds
+                )
+            ),
+            moodle_guard,
+            moodle_rate_limiter
+        )
+        
+        _shared_client = httpx.AsyncClient(
+            timeout=settings.moodle_timeout_seconds,
+            follow_redirects=True,
+            transport=transport,
+            headers={
+                "User-Agent": "ExamMiddleware/1.0",
+                "Accept": "application/json",
+            }
+        )
+        _shared_client_loop = loop
+        logger.info(f"Created shared Moodle connection pool (http2={http2})")
+    
+    return _shared_client
+
+
+async def close_shared_http_client() -> None:
+    """Close the shared pool (called on application shutdown)"""
+    global _shared_client, _shared_client_loop
+    
+    if _shared_client is not None and not _shared_client.is_closed:
+        await _shared_client.aclose()
+        logger.info("Closed shared Moodle connection pool")
+    _shared_client = None
+    _shared_client_loop = None
+
+
+# =========================================
+# Read Coalescing
+# =========================================
+
+_read_flights = SingleFlight()
+
+# Whether the batch function is usable, per site and token. Refusals are
+# remembered for an hour so enabling it in Moodle takes effect eventually.
+_batch_support = SimpleCache(default_ttl=3600)
+
+
+def coalesce_read(func):
+    """
+    Share identical in-flight Moodle reads
+    
+    Concurrent calls of the same read method against the same site with the
+    same token and arguments are served by a single request. Only use this
+    for reads whose result does not depend on a write the caller just made.
+    """
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        token = kwargs.get("token") or self.token
+        key = f"{func.__name__}:{cache.cache_key(self.base_url, token, *args, **kwargs)}"
+        return await _read_flights.do(key, lambda: func(self, *args, **kwargs))
+    return wrapper
+
+
 class MoodleClient:
     """
     Async Moodle API Client
@@ -54,28 +203,27 @@ class MoodleClient:
         self,
         base_url: Optional[str] = None,
         token: Optional[str] = None,
-        timeout: float = 30.0
+        http_client: Optional[httpx.AsyncClient] = None
     ):
         self.base_url = (base_url or settings.moodle_base_url).rstrip('/')
         self.token = token
-        self.timeout = timeout
-        self._client: Optional[httpx.AsyncClient] = None
+        # A dedicated client is only used when passed in explicitly;
+        # otherwise requests go through the shared pool
+        self._client: Optional[httpx.AsyncClient] = http_client
     
     async def _get_client(self) -> httpx.AsyncClient:
-        """Get or create HTTP client"""
-        if self._client is None or self._client.is_closed:
-            self._client = httpx.AsyncClient(
-                timeout=self.timeout,
-                follow_redirects=True,
-                headers={
-                    "User-Agent": "ExamMiddleware/1.0",
-                    "Accept": "application/json",
-                }
-            )
-        return self._client
+        """Get the HTTP client (the shared pool unless one was passed in)"""
+        if self._client is not None and not self._client.is_closed:
+            return self._client
+        return get_shared_http_client()
     
     async def close(self):
-        """Close the HTTP client"""
+        """
+        Release the client
+        
+        The shared pool stays open for other requests; only a dedicated
+        client passed in via http_client is closed.
+        """
         if self._client and not self._client.is_closed:
             await self._client.aclose()
     
@@ -103,6 +251,200 @@ class MoodleClient:
                     response_data=data
                 )
     
+    @staticmethod
+    def _flatten_params(value: Any, prefix: str = "") -> Dict[str, str]:
+        """
+        Encode nested arguments the way Moodle's REST server expects
+        
+        {"plugindata": {"files_filemanager": 5}} -> {"plugindata[files_filemanager]": "5"}
+        """
+        if isinstance(value, dict):
+            items = value.items()
+        elif isinstance(value, (list, tuple)):
+            items = enumerate(value)
+        else:
+            if isinstance(value, bool):
+                value = int(value)
+            return {prefix: str(value)}
+        
+        params: Dict[str, str] = {}
+        for key, item in items:
+            params.update(MoodleClient._flatten_params(item, f"{prefix}[{key}]" if prefix else str(key)))
+        return params
+    
+    # =========================================
+    # Generic and Batched Calls
+    # =========================================
+    
+    BATCH_FUNCTION = "tool_mobile_call_external_functions"
+    
+    # Error codes Moodle returns when the batch function is not part of the
+    # token's web service (accessexception) or not installed (invalidrecord)
+    BATCH_UNAVAILABLE_ERRORCODES = ("accessexception", "invalidrecord")
+    
+    def _batch_support_key(self, token: Optional[str]) -> str:
+        # Tokens of one site can belong to different web services
+        return cache.cache_key(self.base_url, token)
+    
+    def _batch_unavailable(self, error: MoodleAPIError) -> bool:
+        """Whether an error from the batch function means it cannot be used"""
+        if error.error and error.error.errorcode in self.BATCH_UNAVAILABLE_ERRORCODES:
+            return True
+        return self.BATCH_FUNCTION in f"{error.message} {error.error.debuginfo if error.error else ''}"
+    
+    async def call_function(
+        self,
+        function: str,
+        arguments: Optional[Dict[str, Any]] = None,
+        token: Optional[str] = None
+    ) -> Any:
+        """
+        Call any web service function
+        
+        Args:
+            function: WS function name
+            arguments: Function arguments (nested dicts/lists allowed)
+            token: Web service token
+            
+        Returns:
+            Decoded JSON result
+        """
+        client = await self._get_client()
+        ws_token = token or self.token
+        
+        url = f"{self.base_url}/webservice/rest/server.php"
+        params = {
+            "wstoken": ws_token,
+            "wsfunction": function,
+            "moodlewsrestformat": "json",
+            **self._flatten_params(arguments or {})
+        }
+        
+        try:
+            response = await client.post(url, data=params)
+            response.raise_for_status()
+            result = response.json()
+            
+            self._check_error_response(result, function)
+            return result
+            
+        except httpx.HTTPStatusError as e:
+            raise MoodleAPIError(f"HTTP error: {e.response.status_code}")
+    
+    async def call_batch(
+        self,
+        calls: List[MoodleCall],
+        token: Optional[str] = None
+    ) -> List[MoodleCallResult]:
+        """
+        Run several web service functions in one round-trip
+        
+        Function: tool_mobile_call_external_functions
+        
+        Calls run in order on the Moodle side and stop at the first error,
+        so later calls may depend on the side effects of earlier ones (but
+        not on their results). Calls after a failure are reported as not
+        executed. If batching is disabled or not allowed by the web service,
+        the calls are made one by one with the same semantics.
+        
+        Args:
+            calls: Calls to execute, in order
+            token: Web service token
+            
+        Returns:
+            One MoodleCallResult per call, in order
+        """
+        ws_token = token or self.token
+        support_key = self._batch_support_key(ws_token)
+        
+        if (
+            len(calls) < 2
+            or not settings.moodle_batch_calls
+            or await _batch_support.get(support_key) is False
+        ):
+            return await self._call_sequential(calls, ws_token)
+        
+        requests = [
+            {"function": call.function, "arguments": json.dumps(call.arguments)}
+            for call in calls
+        ]
+        
+        try:
+            result = await self.call_function(
+                self.BATCH_FUNCTION, {"requests": requests}, token=ws_token
+            )
+        except MoodleAPIError as e:
+            if not self._batch_unavailable(e):
+                raise
+            logger.warning(f"{self.BATCH_FUNCTION} is not available - falling back to single calls")
+            await _batch_support.set(support_key, False)
+            return await self._call_sequential(calls, ws_token)
+        
+        await _batch_support.set(support_key, True)
+        responses = result.get("responses", []) if isinstance(result, dict) else []
+        
+        results: List[MoodleCallResult] = []
+        for i, call in enumerate(calls):
+            if i >= len(responses):
+                results.append(self._not_executed(call))
+                continue
+            
+            item = responses[i]
+            if item.get("error"):
+                exception = json.loads(item.get("exception") or "{}")
+                error = MoodleError(
+                    exception=exception.get("exception", ""),
+                    errorcode=exception.get("errorcode", ""),
+                    message=exception.get("message", "Unknown error"),
+                    debuginfo=exception.get("debuginfo")
+                )
+                logger.error(
+                    f"Moodle API error in {call.function} (batched): "
+                    f"{error.errorcode} - {error.message}"
+                )
+                results.append(MoodleCallResult(
+                    call.function,
+                    error=MoodleAPIError(
+                        f"Moodle API error: {error.message}",
+                        error=error,
+                        response_data=exception
+                    )
+                ))
+            else:
+                data = item.get("data")
+                results.append(MoodleCallResult(
+                    call.function,
+                    data=json.loads(data) if data else None
+                ))
+        
+        logger.info(f"Batched {len(calls)} Moodle calls: {[c.function for c in calls]}")
+        return results
+    
+    async def _call_sequential(
+        self,
+        calls: List[MoodleCall],
+        ws_token: Optional[str]
+    ) -> List[MoodleCallResult]:
+        """Fallback for call_batch: one request per call, stopping at the first error"""
+        results: List[MoodleCallResult] = []
+        for call in calls:
+            if results and not results[-1].ok:
+                results.append(self._not_executed(call))
+                continue
+            try:
+                data = await self.call_function(call.function, call.arguments, token=ws_token)
+                results.append(MoodleCallResult(call.function, data=data))
+            except MoodleAPIError as e:
+                results.append(MoodleCallResult(call.function, error=e))
+        return results
+    
+    @staticmethod
+    def _not_executed(call: MoodleCall) -> MoodleCallResult:
+        return MoodleCallResult(
+            call.function,
+            error=MoodleAPIError(f"{call.function} not executed: an earlier call in the batch failed")
+        )
+    
     # =========================================
     # Authentication
     # =========================================
@@ -172,6 +514,7 @@ class MoodleClient:
     # User Information
     # =========================================
     
+    @coalesce_read
     async def get_site_info(self, token: Optional[str] = None) -> Dict[str, Any]:
         """
         Get site and user information from token
@@ -214,6 +557,7 @@ class MoodleClient:
     # Course and Assignment Discovery
     # =========================================
     
+    @coalesce_read
     async def get_courses_by_field(
         self,
         field: str,
@@ -259,6 +603,7 @@ class MoodleClient:
         except httpx.HTTPStatusError as e:
             raise MoodleAPIError(f"HTTP error: {e.response.status_code}")
     
+    @coalesce_read
     async def get_courses(
         self,
         token: Optional[str] = None
@@ -297,6 +642,7 @@ class MoodleClient:
         except httpx.HTTPStatusError as e:
             raise MoodleAPIError(f"HTTP error: {e.response.status_code}")
     
+    @coalesce_read
     async def get_assignments(
         self,
         course_ids: List[int],
@@ -344,6 +690,60 @@ class MoodleClient:
     # File Upload (Step 1 of Submission)
     # =========================================
     
+    @staticmethod
+    def _multipart_file_body(
+        fields: Dict[str, str],
+        field_name: str,
+        filename: str,
+        mime_type: str,
+        file_path: str,
+        file_size: int
+    ) -> Tuple[AsyncIterator[bytes], Dict[str, str]]:
+        """
+        Build a multipart/form-data body that streams the file from disk
+        
+        Only the small part headers are held in memory; the file itself is
+        read chunk by chunk while httpx sends the request, so memory per
+        upload stays constant regardless of scan size. An exact
+        Content-Length is sent because PHP does not accept chunked bodies.
+        
+        Returns:
+            Tuple of (async body iterator, request headers)
+        """
+        boundary = uuid.uuid4().hex
+        safe_filename = filename.replace('"', '%22').replace('\r', '').replace('\n', '')
+        
+        head = b"".join(
+            (
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f'{value}\r\n'
+            ).encode()
+            for name, value in fields.items()
+        )
+        head += (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{safe_filename}"\r\n'
+            f'Content-Type: {mime_type}\r\n\r\n'
+        ).encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        
+        async def _body() -> AsyncIterator[bytes]:
+            yield head
+            async with aiofiles.open(file_path, 'rb') as f:
+                while True:
+                    chunk = await f.read(settings.upload_chunk_size_bytes)
+                    if not chunk:
+                        break
+                    yield chunk
+            yield tail
+        
+        headers = {
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            "Content-Length": str(len(head) + file_size + len(tail)),
+        }
+        return _body(), headers
+    
     async def upload_file(
         self,
         file_path: str,
@@ -372,7 +772,9 @@ class MoodleClient:
         if not ws_token:
             raise MoodleAPIError("No token provided for file upload")
         
-        if not os.path.exists(file_path):
+        try:
+            file_size = (await aiofiles.os.stat(file_path)).st_size
+        except FileNotFoundError:
             raise MoodleAPIError(f"File not found: {file_path}")
         
         upload_filename = filename or os.path.basename(file_path)
@@ -390,21 +792,19 @@ class MoodleClient:
         url = f"{self.base_url}/webservice/upload.php"
         
         try:
-            # Read file content
-            async with aiofiles.open(file_path, 'rb') as f:
-                file_content = await f.read()
-            
-            # Prepare multipart form data
-            files = {
-                'file_1': (upload_filename, file_content, mime_type)
-            }
-            data = {
-                'token': ws_token
-            }
+            # Stream the multipart body from disk instead of reading the file
+            body, headers = self._multipart_file_body(
+                fields={'token': ws_token},
+                field_name='file_1',
+                filename=upload_filename,
+                mime_type=mime_type,
+                file_path=file_path,
+                file_size=file_size
+            )
             
-            logger.info(f"Uploading file: {upload_filename} ({len(file_content)} bytes)")
+            logger.info(f"Uploading file: {upload_filename} ({file_size} bytes)")
             
-            response = await client.post(url, files=files, data=data)
+            response = await client.post(url, content=body, headers=headers)
             response.raise_for_status()
             result = response.json()
             
@@ -490,27 +890,32 @@ class MoodleClient:
             
             self._check_error_response(result, "mod_assign_save_submission")
             
-            # Log the raw response for debugging
-            logger.info(f"mod_assign_save_submission response: {result}")
-            
-            # Success is indicated by empty array or null
-            if result is None or (isinstance(result, list) and len(result) == 0):
-                logger.info(f"Submission saved successfully for assignment {assignment_id}")
-                return {"success": True, "warnings": []}
-            
-            # Check for warnings
-            if isinstance(result, dict) and "warnings" in result:
-                warnings = result.get("warnings", [])
-                if warnings:
-                    logger.warning(f"Submission saved with warnings: {warnings}")
-                return {"success": True, "warnings": warnings}
-            
-            logger.info(f"Unexpected save_submission response format: {result}")
-            return {"success": True, "data": result}
+            return self.parse_save_submission_result(result, assignment_id)
             
         except httpx.HTTPStatusError as e:
             raise MoodleAPIError(f"HTTP error: {e.response.status_code}")
     
+    @staticmethod
+    def parse_save_submission_result(result: Any, assignment_id: int) -> Dict[str, Any]:
+        """Normalise a mod_assign_save_submission response (direct or batched)"""
+        # Log the raw response for debugging
+        logger.info(f"mod_assign_save_submission response: {result}")
+        
+        # Success is indicated by empty array or null
+        if result is None or (isinstance(result, list) and len(result) == 0):
+            logger.info(f"Submission saved successfully for assignment {assignment_id}")
+            return {"success": True, "warnings": []}
+        
+        # Check for warnings
+        if isinstance(result, dict) and "warnings" in result:
+            warnings = result.get("warnings", [])
+            if warnings:
+                logger.warning(f"Submission saved with warnings: {warnings}")
+            return {"success": True, "warnings": warnings}
+        
+        logger.info(f"Unexpected save_submission response format: {result}")
+        return {"success": True, "data": result}
+    
     # =========================================
     # Submit for Grading (Step 3 of Submission)
     # =========================================
@@ -611,6 +1016,7 @@ class MoodleClient:
     # Get Submission Status
     # =========================================
     
+    @coalesce_read
     async def get_submissions(
         self,
         assignment_ids: List[int],
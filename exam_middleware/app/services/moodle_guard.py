@@ -0,0 +1,302 @@
+"""
+Moodle Backend Guard
+Circuit breaker and adaptive concurrency limit in front of all Moodle traffic
+"""
+
+import time
+import asyncio
+import logging
+from typing import Optional, Dict, Any, Callable
+
+import httpx
+
+from app.core.config import settings
+from app.services.moodle_client import MoodleUnavailableError
+from app.services.moodle_rate_limiter import MoodleRateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open circuit breaker
+    
+    - closed: requests flow; consecutive failures are counted
+    - open: after failure_threshold consecutive failures every request is
+      rejected immediately for reset_seconds
+    - half-open: once reset_seconds have passed a single probe request is let
+      through; success closes the circuit, failure opens it again
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(
+        self,
+        failure_threshold: Optional[int] = None,
+        reset_seconds: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.failure_threshold = failure_threshold or settings.moodle_breaker_failure_threshold
+        self.reset_seconds = settings.moodle_breaker_reset_seconds if reset_seconds is None else reset_seconds
+        self._clock = clock
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+    
+    @property
+    def is_open(self) -> bool:
+        """True while requests are rejected without being sent"""
+        return self.state == self.OPEN and self._clock() - self._opened_at < self.reset_seconds
+    
+    def before_request(self) -> None:
+        """
+        Admit or reject a request
+        
+        Raises:
+            MoodleUnavailableError: If the circuit is open, or half-open with
+                the probe already in flight
+        """
+        if self.state == self.OPEN:
+            if self.is_open:
+                raise MoodleUnavailableError("Moodle is unavailable (circuit open)")
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+            logger.info("Moodle circuit half-open - sending probe request")
+        
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                raise MoodleUnavailableError("Moodle is unavailable (circuit half-open)")
+            self._probe_in_flight = True
+    
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info("Moodle circuit closed - backend recovered")
+        self.state = self.CLOSED
+        self._failures = 0
+        self._probe_in_flight = False
+    
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(
+                    f"Moodle circuit opened after {self._failures} failure(s) - "
+                    f"failing fast for {self.reset_seconds}s"
+                )
+            self.state = self.OPEN
+            self._opened_at = self._clock()
+    
+    def abandon(self) -> None:
+        """A request ended without an outcome (e.g. cancelled); free the probe slot"""
+        self._probe_in_flight = False
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.OPEN if self.is_open else self.state,
+            "consecutive_failures": self._failures,
+        }
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit for Moodle requests
+    
+    The limit grows by about one slot per round of fast, successful
+    responses (additive increase) and is cut by backoff_ratio when a request
+    fails or is slower than latency_target (multiplicative decrease, at most
+    once per latency_target so one slow burst does not collapse it). Requests
+    over the limit wait up to wait_seconds for a slot before failing fast.
+    
+    File uploads take as long as their size needs, so their latency says
+    nothing about backend health; they only adjust the limit when they fail.
+    """
+    
+    def __init__(
+        self,
+        initial_limit: Optional[int] = None,
+        min_limit: Optional[int] = None,
+        max_limit: Optional[int] = None,
+        latency_target: Optional[float] = None,
+        wait_seconds: Optional[float] = None,
+        backoff_ratio: float = 0.7,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.min_limit = min_limit or settings.moodle_concurrency_min
+        self.max_limit = max_limit or settings.moodle_max_connections
+        self.limit = float(min(max(initial_limit or settings.moodle_concurrency_initial, self.min_limit), self.max_limit))
+        self.latency_target = latency_target or settings.moodle_latency_target_seconds
+        self.wait_seconds = settings.moodle_concurrency_wait_seconds if wait_seconds is None else wait_seconds
+        self.backoff_ratio = backoff_ratio
+        self._clock = clock
+        self.in_flight = 0
+        self._last_decrease = float("-inf")
+        self._condition: Optional[asyncio.Condition] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def _get_condition(self) -> asyncio.Condition:
+        # Rebuilt per event loop, like the shared connection pool
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+            self.in_flight = 0
+        return self._condition
+    
+    async def acquire(self) -> None:
+        """
+        Wait for a free slot
+        
+        Raises:
+            MoodleUnavailableError: If no slot frees up within wait_seconds
+        """
+        condition = self._get_condition()
+        async with condition:
+            try:
+                await asyncio.wait_for(
+                    condition.wait_for(lambda: self.in_flight < int(self.limit)),
+                    self.wait_seconds
+                )
+            except asyncio.TimeoutError:
+                raise MoodleUnavailableError(
+                    f"Moodle is overloaded ({self.in_flight} requests in flight, limit {int(self.limit)})"
+                )
+            self.in_flight += 1
+    
+    async def release(self, latency: Optional[float], ok: bool, timed: bool = True) -> None:
+        """
+        Free a slot and adjust the limit
+        
+        Args:
+            latency: Seconds the request took (None if it never completed)
+            ok: Whether the backend handled the request successfully
+            timed: Whether latency is compared against latency_target
+                (False for uploads, whose duration depends on their size)
+        """
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight = max(self.in_flight - 1, 0)
+            
+            if latency is not None and (timed or not ok):
+                now = self._clock()
+                if ok and latency <= self.latency_target:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                elif now - self._last_decrease >= self.latency_target:
+                    self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                    self._last_decrease = now
+                    logger.info(
+                        f"Moodle concurrency limit reduced to {int(self.limit)} "
+                        f"({'error' if not ok else f'latency {latency:.2f}s'})"
+                    )
+            
+            condition.notify_all()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"limit": int(self.limit), "in_flight": self.in_flight}
+
+
+class MoodleGuard:
+    """Breaker and limiter shared by every Moodle request in the process"""
+    
+    def __init__(
+        self,
+        breaker: Optional[CircuitBreaker] = None,
+        limiter: Optional[AdaptiveLimiter] = None
+    ):
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or AdaptiveLimiter()
+    
+    @property
+    def is_open(self) -> bool:
+        return self.breaker.is_open
+    
+    def stats(self) -> Dict[str, Any]:
+        return {**self.breaker.stats(), **self.limiter.stats()}
+
+
+class GuardedTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport that routes requests through a MoodleGuard
+    
+    Transport errors (timeouts, refused connections), 5xx and 429 responses
+    count as backend failures. Moodle-level errors come back as HTTP 200
+    and say nothing about backend health, so they count as successes here.
+    Transport errors are raised as MoodleUnavailableError so callers can
+    queue work for retry instead of treating it as an unexpected failure.
+    
+    With a rate limiter, each request first waits for a token from the
+    budget of its web service function.
+    """
+    
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        guard: MoodleGuard,
+        rate_limiter: Optional[MoodleRateLimiter] = None
+    ):
+        self._transport = transport
+        self.guard = guard
+        self.rate_limiter = rate_limiter
+    
+    @staticmethod
+    def _ws_function(request: httpx.Request) -> str:
+        """Name of the Moodle function a request calls, used to pick its rate budget"""
+        path = request.url.path
+        if path.endswith(settings.moodle_upload_endpoint):
+            return "core_files_upload"
+        if path.endswith(settings.moodle_token_endpoint):
+            return "login"
+        if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            try:
+                form = httpx.QueryParams(request.content.decode())
+            except httpx.RequestNotRead:
+                return "default"
+            return form.get("wsfunction", "default")
+        return request.url.params.get("wsfunction", "default")
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        function = self._ws_function(request)
+        if self.rate_limiter is not None:
+            if self.guard.is_open:
+                # Don't queue for a token just to be rejected afterwards
+                raise MoodleUnavailableError("Moodle is unavailable (circuit open)")
+            await self.rate_limiter.acquire(function)
+        
+        self.guard.breaker.before_request()
+        try:
+            await self.guard.limiter.acquire()
+        except MoodleUnavailableError:
+            self.guard.breaker.abandon()
+            raise
+        
+        started = time.monotonic()
+        latency: Optional[float] = None
+        ok = False
+        try:
+            response = await self._transport.handle_async_request(request)
+            latency = time.monotonic() - started
+            ok = response.status_code < 500 and response.status_code != 429
+        except httpx.TransportError as e:
+            latency = time.monotonic() - started
+            self.guard.breaker.record_failure()
+            raise MoodleUnavailableError(f"Moodle unreachable: {e.__class__.__name__}") from e
+        finally:
+            if latency is None:
+                self.guard.breaker.abandon()
+            await self.guard.limiter.release(latency, ok, timed=function != "core_files_upload")
+        
+        if ok:
+            self.guard.breaker.record_success()
+        else:
+            self.guard.breaker.record_failure()
+        return response
+    
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+# Global instance
+moodle_guard = MoodleGuard()
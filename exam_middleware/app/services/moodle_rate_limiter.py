@@ -0,0 +1,170 @@
+"""
+Moodle Rate Limiter
+Token-bucket shaping of outbound Moodle traffic with per-function budgets
+"""
+
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, Tuple, Deque, Callable, Iterator
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+_priority: ContextVar[str] = ContextVar("moodle_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def background_priority() -> Iterator[None]:
+    """
+    Mark Moodle calls made inside the block as background work
+    
+    Background calls (queue retries) share the same budgets as student
+    requests but only get every (interactive_share + 1)-th token while
+    students are waiting.
+    """
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Refills at rate tokens per second up to burst tokens"""
+    
+    def __init__(self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = max(burst, 1.0)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+        self.waiters: Dict[str, Deque[asyncio.Future]] = {INTERACTIVE: deque(), BACKGROUND: deque()}
+        self.interactive_streak = 0
+        self.dispatcher: Optional[asyncio.Task] = None
+    
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    
+    def delay(self) -> float:
+        """Seconds until the next token is available"""
+        self._refill()
+        return max((1 - self.tokens) / self.rate, 0.0)
+    
+    def has_waiters(self) -> bool:
+        for queue in self.waiters.values():
+            while queue and queue[0].done():
+                queue.popleft()
+        return any(self.waiters.values())
+
+
+class MoodleRateLimiter:
+    """
+    Per-wsfunction token buckets with fair queuing
+    
+    Each function listed in MOODLE_RATE_LIMITS gets its own bucket; all
+    other functions share the "default" bucket. Callers that find no token
+    queue up and are released in order as tokens refill, interactive
+    callers first but with every (interactive_share + 1)-th token going to
+    background work so queue retries are never starved.
+    
+    Limits are per process (per uvicorn worker).
+    """
+    
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Tuple[float, float]]] = None,
+        interactive_share: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.limits = settings.moodle_rate_limits_map if limits is None else limits
+        self.interactive_share = interactive_share or settings.moodle_rate_interactive_share
+        self._clock = clock
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def _bucket(self, function: str) -> Optional[TokenBucket]:
+        """Bucket for a function, or None if it is not rate limited"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Waiters and dispatchers belong to one event loop
+            self._buckets = {}
+            self._loop = loop
+        
+        key = function if function in self.limits else "default"
+        if key not in self._buckets:
+            rate, burst = self.limits.get(key, (0, 0))
+            if rate <= 0:
+                return None
+            self._buckets[key] = TokenBucket(rate, burst, self._clock)
+        return self._buckets[key]
+    
+    async def acquire(self, function: str, priority: Optional[str] = None) -> None:
+        """
+        Wait until a call to function fits its budget
+        
+        Args:
+            function: WS function name (or "core_files_upload" / "login")
+            priority: INTERACTIVE or BACKGROUND (defaults to the caller's context)
+        """
+        bucket = self._bucket(function)
+        if bucket is None:
+            return
+        
+        if not bucket.has_waiters() and bucket.try_take():
+            return
+        
+        priority = priority or _priority.get()
+        future = asyncio.get_running_loop().create_future()
+        bucket.waiters[priority].append(future)
+        
+        if bucket.dispatcher is None or bucket.dispatcher.done():
+            bucket.dispatcher = asyncio.ensure_future(self._dispatch(bucket))
+        
+        await future
+    
+    def _next_waiter(self, bucket: TokenBucket) -> asyncio.Future:
+        interactive = bucket.waiters[INTERACTIVE]
+        background = bucket.waiters[BACKGROUND]
+        
+        if interactive and (not background or bucket.interactive_streak < self.interactive_share):
+            bucket.interactive_streak += 1
+            return interactive.popleft()
+        
+        bucket.interactive_streak = 0
+        return background.popleft()
+    
+    async def _dispatch(self, bucket: TokenBucket) -> None:
+        """Hand out tokens to queued callers as the bucket refills"""
+        while bucket.has_waiters():
+            if not bucket.try_take():
+                await asyncio.sleep(bucket.delay())
+                continue
+            self._next_waiter(bucket).set_result(None)
+        bucket.interactive_streak = 0
+    
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            key: {priority: len(queue) for priority, queue in bucket.waiters.items()}
+            for key, bucket in self._buckets.items()
+        }
+
+
+# Global instance
+moodle_rate_limiter = MoodleRateLimiter()
@@ -0,0 +1,424 @@
+"""
+Subject Catalog Service
+In-memory subject code -> assignment index built from one Moodle crawl
+"""
+
+import asyncio
+import logging
+import re
+from collections import deque
+from typing import Optional, Dict, Any, List, Set, Callable, Iterable
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from app.core.cache import subject_negative_cache
+from app.core.config import settings
+from app.db.database import async_session_maker
+from app.db.models import ExaminationArtifact, SubjectMapping
+from app.services.moodle_client import MoodleClient
+from app.services.moodle_guard import moodle_guard
+from app.services.moodle_rate_limiter import background_priority
+
+logger = logging.getLogger(__name__)
+
+# Course ids per mod_assign_get_assignments call
+ASSIGNMENTS_PER_REQUEST = 100
+
+# Retry delay while no crawl has succeeded yet
+UNLOADED_RETRY_SECONDS = 60.0
+
+_TOKEN_PATTERN = re.compile(r"[A-Z0-9]+")
+
+
+def catalog_tokens(text: Optional[str]) -> Set[str]:
+    """Upper-case alphanumeric tokens of a course or assignment name"""
+    return set(_TOKEN_PATTERN.findall((text or "").upper()))
+
+
+def build_index(courses: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Build the subject code index from courses with their assignments
+    
+    Keys are the course shortname and idnumber, the tokens of the course
+    shortname, idnumber and fullname, and the tokens of each assignment
+    name. An assignment-name key points at that assignment; a course key
+    points at the course's first assignment, like live discovery does.
+    Assignment-name keys win over course keys as they are more specific,
+    and otherwise the first course in Moodle's order wins.
+    
+    Args:
+        courses: Courses as returned by mod_assign_get_assignments, with
+            shortname/idnumber/fullname and their assignments
+    
+    Returns:
+        Dictionary of key to assignment info
+    """
+    course_keys: Dict[str, Dict[str, Any]] = {}
+    assignment_keys: Dict[str, Dict[str, Any]] = {}
+    
+    for course in courses:
+        assignments = course.get("assignments") or []
+        if not assignments:
+            continue
+        
+        entries = [
+            {
+                "course_id": course.get("id"),
+                "assignment_id": assignment.get("id"),
+                "assignment_name": assignment.get("name"),
+                "source": "catalog"
+            }
+            for assignment in assignments
+        ]
+        for entry in entries:
+            for token in catalog_tokens(entry["assignment_name"]):
+                assignment_keys.setdefault(token, entry)
+        
+        keys = {
+            (course.get("shortname") or "").upper().strip(),
+            (course.get("idnumber") or "").upper().strip(),
+        }
+        keys |= catalog_tokens(course.get("shortname"))
+        keys |= catalog_tokens(course.get("idnumber"))
+        keys |= catalog_tokens(course.get("fullname"))
+        keys.discard("")
+        for key in keys:
+            course_keys.setdefault(key, entries[0])
+    
+    return {**course_keys, **assignment_keys}
+
+
+class SubjectCodeMatcher:
+    """
+    Aho-Corasick automaton over a set of subject codes
+    
+    Finds every code occurring as a substring of a text in one pass over
+    the text, however many codes there are. Used to remap all subjects
+    against one catalog crawl instead of scanning it once per code.
+    """
+    
+    def __init__(self, codes: Iterable[str]):
+        self.codes = sorted({code.upper().strip() for code in codes if code and code.strip()})
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[str]] = [[]]
+        
+        for code in self.codes:
+            self._add(code)
+        self._link()
+    
+    def _add(self, code: str) -> None:
+        """Add a code to the trie"""
+        node = 0
+        for char in code:
+            child = self._goto[node].get(char)
+            if child is None:
+                child = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][char] = child
+            node = child
+        self._out[node].append(code)
+    
+    def _link(self) -> None:
+        """Compute failure links breadth-first and merge outputs along them"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+    
+    def find(self, text: Optional[str]) -> Set[str]:
+        """
+        Codes contained in a text
+        
+        Args:
+            text: Course or assignment name (matched case-insensitively)
+            
+        Returns:
+            Set of matching codes
+        """
+        found: Set[str] = set()
+        node = 0
+        for char in (text or "").upper():
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            if self._out[node]:
+                found.update(self._out[node])
+        return found
+    
+    def resolve(self, courses: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """
+        Resolve every code against a crawled course list in one pass
+        
+        Follows the rules of live discovery for each code: courses whose
+        shortname, idnumber or fullname contain the code are searched
+        first, and their first assignment is taken when the shortname or
+        idnumber matches, otherwise the first assignment whose name
+        contains the code. Codes that match no course are looked up in
+        assignment names across all courses.
+        
+        Args:
+            courses: Courses with their assignments, as from SubjectCatalog.crawl
+            
+        Returns:
+            Dictionary of code to assignment info; unresolved codes are left out
+        """
+        matched_courses: Set[str] = set()
+        from_courses: Dict[str, Dict[str, Any]] = {}
+        from_names: Dict[str, Dict[str, Any]] = {}
+        
+        for course in courses:
+            course_codes = self.find(course.get("shortname")) | self.find(course.get("idnumber"))
+            course_matched = course_codes | self.find(course.get("fullname"))
+            matched_courses |= course_matched
+            
+            for assignment in course.get("assignments") or []:
+                entry = {
+                    "course_id": course.get("id"),
+                    "assignment_id": assignment.get("id"),
+                    "assignment_name": assignment.get("name"),
+                    "source": "moodle_discovery"
+                }
+                name_codes = self.find(assignment.get("name"))
+                for code in name_codes:
+                    from_names.setdefault(code, entry)
+                # A course matched through its fullname only counts with
+                # the code in the assignment name as well
+                for code in course_codes | (name_codes & course_matched):
+                    from_courses.setdefault(code, entry)
+        
+        resolved = {}
+        for code in self.codes:
+            entry = from_courses.get(code) if code in matched_courses else from_names.get(code)
+            if entry:
+                resolved[code] = dict(entry)
+        return resolved
+
+
+class SubjectCatalog:
+    """
+    Preloaded index of every course and assignment in Moodle
+    
+    All courses and their assignments are crawled once with the admin
+    token, at startup and then every SUBJECT_CATALOG_REFRESH_MINUTES.
+    Resolving a subject code is then a dict lookup, so subject discovery
+    no longer crawls Moodle on the request path. Subject codes of uploaded
+    papers that the catalog resolves are written to subject_mappings in
+    one statement; existing mappings are left as they are.
+    
+    The index lives in process memory, so each API process builds its own.
+    """
+    
+    def __init__(
+        self,
+        admin_token: Optional[str] = None,
+        refresh_minutes: Optional[float] = None,
+        session_maker: Callable = async_session_maker
+    ):
+        self.admin_token = admin_token or settings.moodle_admin_token
+        self.refresh_minutes = refresh_minutes or settings.subject_catalog_refresh_minutes
+        self.session_maker = session_maker
+        self._index: Dict[str, Dict[str, Any]] = {}
+        self._counts = {"courses": 0, "assignments": 0}
+        self.built_at: Optional[datetime] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def is_loaded(self) -> bool:
+        """Whether a crawl has completed and lookups are authoritative"""
+        return self.built_at is not None
+    
+    def lookup(self, subject_code: str) -> Optional[Dict[str, Any]]:
+        """
+        Resolve a subject code from the index
+        
+        Args:
+            subject_code: Subject code (e.g., "19AI405")
+        
+        Returns:
+            Assignment info or None if the catalog does not know the code
+        """
+        entry = self._index.get(subject_code.upper().strip())
+        return dict(entry) if entry else None
+    
+    async def crawl(
+        self,
+        token: Optional[str] = None,
+        progress: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Fetch all courses and their assignments
+        
+        Assignments are fetched in chunks of course ids, several chunks at
+        a time (SUBJECT_CATALOG_CRAWL_CONCURRENCY).
+        
+        Args:
+            token: Moodle token to crawl with (default: admin token)
+            progress: Optional dict updated with courses/chunks_total/chunks_done
+            
+        Returns:
+            Courses with shortname, idnumber, fullname and assignments
+        """
+        progress = progress if progress is not None else {}
+        client = MoodleClient(token=token or self.admin_token)
+        try:
+            with background_priority():
+                courses = (await client.get_courses())["courses"]
+                by_id = {course["id"]: course for course in courses if course.get("id")}
+                course_ids = list(by_id)
+                chunks = [
+                    course_ids[start:start + ASSIGNMENTS_PER_REQUEST]
+                    for start in range(0, len(course_ids), ASSIGNMENTS_PER_REQUEST)
+                ]
+                progress.update(courses=len(course_ids), chunks_total=len(chunks), chunks_done=0)
+                semaphore = asyncio.Semaphore(settings.subject_catalog_crawl_concurrency)
+                
+                async def fetch(chunk: List[int]) -> Dict[str, Any]:
+                    async with semaphore:
+                        result = await client.get_assignments(course_ids=chunk)
+                    progress["chunks_done"] += 1
+                    return result
+                
+                results = await asyncio.gather(*(fetch(chunk) for chunk in chunks))
+        finally:
+            await client.close()
+        
+        crawled = []
+        for result in results:
+            for course_data in result.get("courses", []):
+                # mod_assign_get_assignments does not return the idnumber
+                course = by_id.get(course_data.get("id"), {})
+                crawled.append({
+                    **course_data,
+                    "idnumber": course_data.get("idnumber") or course.get("idnumber")
+                })
+        return crawled
+    
+    async def refresh(self) -> Dict[str, Any]:
+        """
+        Crawl Moodle, swap in the new index and persist new mappings
+        
+        Returns:
+            Catalog stats plus the number of mappings created
+        """
+        courses = await self.crawl()
+        self._index = build_index(courses)
+        self._counts = {
+            "courses": len(courses),
+            "assignments": sum(len(course.get("assignments") or []) for course in courses)
+        }
+        self.built_at = datetime.utcnow()
+        # Codes missing from the old catalog may be in this one
+        await subject_negative_cache.clear()
+        
+        created = await self.persist()
+        logger.info(
+            f"Subject catalog built: {self._counts['assignments']} assignments in "
+            f"{self._counts['courses']} courses, {len(self._index)} keys, {created} new mappings"
+        )
+        return {**self.stats(), "created": created}
+    
+    async def persist(self) -> int:
+        """
+        Insert mappings for uploaded subject codes that have none yet
+        
+        Returns:
+            Number of mappings created
+        """
+        async with self.session_maker() as db:
+            result = await db.execute(
+                select(ExaminationArtifact.parsed_subject_code)
+                .where(ExaminationArtifact.parsed_subject_code.isnot(None))
+                .distinct()
+            )
+            codes = {code.upper().strip() for code in result.scalars().all() if code}
+            
+            result = await db.execute(select(SubjectMapping.subject_code))
+            codes -= set(result.scalars().all())
+            
+            now = datetime.utcnow()
+            rows = []
+            for code in sorted(codes):
+                entry = self._index.get(code)
+                if entry:
+                    rows.append({
+                        "subject_code": code,
+                        "moodle_course_id": entry["course_id"],
+                        "moodle_assignment_id": entry["assignment_id"],
+                        "moodle_assignment_name": entry["assignment_name"],
+                        "is_active": True,
+                        "last_verified_at": now
+                    })
+            
+            if not rows:
+                return 0
+            
+            # A mapping created meanwhile (admin or live discovery) wins
+            await db.execute(
+                insert(SubjectMapping)
+                .values(rows)
+                .on_conflict_do_nothing(index_elements=["subject_code"])
+            )
+            await db.commit()
+            return len(rows)
+    
+    async def run(self, stop_event: asyncio.Event) -> None:
+        """Rebuild the catalog on a schedule until stop_event is set"""
+        while not stop_event.is_set():
+            if moodle_guard.is_open:
+                logger.warning("Subject catalog refresh skipped - Moodle circuit open")
+            else:
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    # Keep serving the previous index
+                    logger.error(f"Subject catalog refresh failed: {e}")
+            
+            delay = self.refresh_minutes * 60 if self.is_loaded else UNLOADED_RETRY_SECONDS
+            try:
+                await asyncio.wait_for(stop_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def start(self) -> None:
+        """Build the catalog in the background and keep it fresh"""
+        if not self.admin_token:
+            logger.warning("MOODLE_ADMIN_TOKEN not set - subject catalog disabled")
+            return
+        self._stop_event = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run(self._stop_event))
+        logger.info("Subject catalog started")
+    
+    async def stop(self) -> None:
+        """Stop the refresh loop"""
+        if not self._task:
+            return
+        self._stop_event.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        logger.info("Subject catalog stopped")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Catalog size and age"""
+        return {
+            "loaded": self.is_loaded,
+            "built_at": self.built_at.isoformat() if self.built_at else None,
+            "courses": self._counts["courses"],
+            "assignments": self._counts["assignments"],
+            "keys": len(self._index)
+        }
+
+
+# Global instance
+subject_catalog = SubjectCatalog()
@@ -4,22 +4,27 @@ Dynamic Subject Discovery Service
 Implements a hybrid approach for resolving subject codes to Moodle assignment IDs:
 1. In-memory cache (fast, TTL-based)
 2. Database lookup (persistent)
-3. Dynamic Moodle API discovery (real-time)
+3. Preloaded subject catalog, or dynamic Moodle API discovery until it is built
 4. Hardcoded config fallback (last resort)
 
 This ensures maximum flexibility while maintaining performance and reliability.
 """
 
+import asyncio
 import logging
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable
 from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert
 
-from app.db.models import SubjectMapping
-from app.services.moodle_client import MoodleClient, MoodleAPIError
+from app.db.database import async_session_maker
+from app.db.models import ExaminationArtifact, SubjectMapping
+from app.services.moodle_client import MoodleClient, MoodleCall, MoodleAPIError
+from app.services.moodle_guard import moodle_guard
+from app.services.subject_catalog_service import SubjectCodeMatcher, subject_catalog
 from app.core.config import settings
-from app.core.cache import subject_cache
+from app.core.cache import subject_cache, subject_negative_cache, subject_flights
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +36,8 @@ class SubjectDiscoveryService:
     Resolution Order:
     1. In-memory cache (sub-millisecond)
     2. Database lookup (fast)
-    3. Dynamic Moodle API discovery (real-time search)
+    3. Preloaded subject catalog (dict lookup), or dynamic Moodle API
+       discovery while the catalog is not built yet
     4. Hardcoded config fallback (last resort)
     
     Successfully discovered mappings are automatically persisted to the database
@@ -72,40 +78,181 @@ class SubjectDiscoveryService:
             logger.debug(f"[Cache HIT] {subject_code} -> {cached.get('assignment_id')}")
             return cached
         
+        # Codes that just failed to resolve are not looked up again for a while
+        if await subject_negative_cache.get(self._negative_key(subject_code, user_token)):
+            logger.debug(f"[Negative cache HIT] {subject_code}")
+            return None
+        
         # Layer 2: Check database
         db_mapping = await self._get_from_database(subject_code)
         if db_mapping:
-            result = {
-                "assignment_id": db_mapping.moodle_assignment_id,
-                "course_id": db_mapping.moodle_course_id,
-                "assignment_name": db_mapping.moodle_assignment_name,
-                "subject_name": db_mapping.subject_name,
-                "source": "database"
-            }
-            await subject_cache.set(cache_key, result)
-            logger.debug(f"[Database HIT] {subject_code} -> {result.get('assignment_id')}")
-            return result
-        
-        # Layer 3: Dynamic Moodle discovery (if token available)
-        if user_token:
-            logger.info(f"[Layer 3] Attempting Moodle discovery for {subject_code} with token...")
-            discovered = await self._discover_from_moodle(subject_code, user_token)
-            if discovered:
-                # Persist to database for future lookups
-                await self._save_discovered_mapping(
-                    subject_code=subject_code,
-                    course_id=discovered["course_id"],
-                    assignment_id=discovered["assignment_id"],
-                    assignment_name=discovered.get("assignment_name"),
-                    source="moodle_discovery"
-                )
-                await subject_cache.set(cache_key, discovered)
-                logger.info(f"[Moodle DISCOVERY] {subject_code} -> {discovered.get('assignment_id')}")
-                return discovered
+            return await self._cache_mapping(db_mapping)
+        
+        # Layers 3-4: Moodle discovery, then config fallback
+        discovered = await self._discover_shared(subject_code, user_token)
+        resolved = await self._finish_resolution(subject_code, discovered)
+        if not resolved:
+            await self._remember_unresolved(subject_code, user_token)
+        return resolved
+    
+    async def get_assignment_infos(
+        self,
+        subject_codes: List[str],
+        user_token: Optional[str] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Get assignment information for several subject codes at once.
+        
+        Runs the same layers as get_assignment_info, but with one database
+        query for all cache misses and concurrent Moodle discovery for the
+        codes the database does not know.
+        
+        Args:
+            subject_codes: Subject codes to lookup
+            user_token: Optional Moodle token for dynamic discovery
+            
+        Returns:
+            Dictionary of normalized subject code to assignment info.
+            Codes not found in any layer are left out.
+        """
+        codes = sorted({code.upper().strip() for code in subject_codes if code})
+        results: Dict[str, Dict[str, Any]] = {}
+        
+        # Layer 1: In-memory cache, including codes known to be unresolvable
+        misses = []
+        for code in codes:
+            cached = await subject_cache.get(f"subject:{code}")
+            if cached:
+                results[code] = cached
+            elif not await subject_negative_cache.get(self._negative_key(code, user_token)):
+                misses.append(code)
+        
+        if not misses:
+            return results
+        
+        # Layer 2: One query for every missing code
+        db_result = await self.db.execute(
+            select(SubjectMapping)
+            .where(
+                SubjectMapping.subject_code.in_(misses),
+                SubjectMapping.is_active == True
+            )
+        )
+        for mapping in db_result.scalars().all():
+            results[mapping.subject_code] = await self._cache_mapping(mapping)
+        
+        unresolved = [code for code in misses if code not in results]
+        if not unresolved:
+            return results
+        
+        # Layer 3: Moodle discovery runs concurrently; it only talks to Moodle,
+        # so the shared session is not used from several tasks at once
+        discovered = await asyncio.gather(*(
+            self._discover_shared(code, user_token) for code in unresolved
+        ))
+        
+        # Persisting and the config fallback use the session, one code at a time
+        for code, info in zip(unresolved, discovered):
+            resolved = await self._finish_resolution(code, info)
+            if resolved:
+                results[code] = resolved
             else:
-                logger.warning(f"[Layer 3] Moodle discovery returned nothing for {subject_code}")
-        else:
+                await self._remember_unresolved(code, user_token)
+        
+        return results
+    
+    @staticmethod
+    def _negative_key(subject_code: str, user_token: Optional[str]) -> str:
+        """Key for a failed lookup; lookups without a token could not try Moodle."""
+        cache_key = f"subject:{subject_code}"
+        return cache_key if user_token else f"{cache_key}:no-token"
+    
+    async def _remember_unresolved(self, subject_code: str, user_token: Optional[str]) -> None:
+        """Cache that a subject code could not be resolved."""
+        await subject_negative_cache.set(
+            self._negative_key(subject_code, user_token),
+            True,
+            ttl=settings.subject_negative_cache_seconds
+        )
+    
+    async def _cache_mapping(self, mapping: SubjectMapping) -> Dict[str, Any]:
+        """Build and cache assignment info from a database mapping."""
+        result = {
+            "assignment_id": mapping.moodle_assignment_id,
+            "course_id": mapping.moodle_course_id,
+            "assignment_name": mapping.moodle_assignment_name,
+            "subject_name": mapping.subject_name,
+            "source": "database"
+        }
+        await subject_cache.set(f"subject:{mapping.subject_code}", result)
+        logger.debug(f"[Database HIT] {mapping.subject_code} -> {result.get('assignment_id')}")
+        return result
+    
+    async def _discover_shared(
+        self,
+        subject_code: str,
+        user_token: Optional[str]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Run layer 3 once for all concurrent misses of the same subject.
+        
+        Only the Moodle discovery is shared: it runs detached from the caller
+        that started it, so it must not touch any request's session. Each
+        caller persists the result in its own session. Lookups with and
+        without a token never share a result.
+        """
+        return await subject_flights.do(
+            f"{self._negative_key(subject_code, user_token)}:moodle",
+            lambda: self._discover_if_possible(subject_code, user_token)
+        )
+    
+    async def _discover_if_possible(
+        self,
+        subject_code: str,
+        user_token: Optional[str]
+    ) -> Optional[Dict[str, Any]]:
+        """Run Moodle discovery (layer 3) when a token is available and Moodle is up."""
+        # A loaded catalog already holds every course and assignment
+        if subject_catalog.is_loaded:
+            found = subject_catalog.lookup(subject_code)
+            if not found:
+                logger.warning(f"[Layer 3] {subject_code} not in subject catalog")
+            return found
+        
+        if user_token and moodle_guard.is_open:
+            # Dashboards fall back to DB/config data instead of waiting on Moodle
+            logger.warning(f"[Layer 3] SKIPPED - Moodle circuit open for {subject_code}")
+            return None
+        if not user_token:
             logger.warning(f"[Layer 3] SKIPPED - No user token available for {subject_code}")
+            return None
+        
+        logger.info(f"[Layer 3] Attempting Moodle discovery for {subject_code} with token...")
+        discovered = await self._discover_from_moodle(subject_code, user_token)
+        if not discovered:
+            logger.warning(f"[Layer 3] Moodle discovery returned nothing for {subject_code}")
+        return discovered
+    
+    async def _finish_resolution(
+        self,
+        subject_code: str,
+        discovered: Optional[Dict[str, Any]]
+    ) -> Optional[Dict[str, Any]]:
+        """Persist a Moodle discovery result, or fall back to config (layer 4)."""
+        cache_key = f"subject:{subject_code}"
+        
+        if discovered:
+            # Persist to database for future lookups
+            await self._save_discovered_mapping(
+                subject_code=subject_code,
+                course_id=discovered["course_id"],
+                assignment_id=discovered["assignment_id"],
+                assignment_name=discovered.get("assignment_name"),
+                source="moodle_discovery"
+            )
+            await subject_cache.set(cache_key, discovered)
+            logger.info(f"[Moodle DISCOVERY] {subject_code} -> {discovered.get('assignment_id')}")
+            return discovered
         
         # Layer 4: Fallback to config
         logger.info(f"[Layer 4] Checking config fallback for {subject_code}")
@@ -193,8 +340,12 @@ class SubjectDiscoveryService:
                 
                 logger.info(f"[Discovery] Starting Moodle discovery for subject: {subject_code}")
                 
-                # Get user info and courses
-                site_info = await client.get_site_info(token=token)
+                # Get user info and courses in one round-trip
+                site_info_result, courses_result = await client.call_batch([
+                    MoodleCall("core_webservice_get_site_info"),
+                    MoodleCall("core_course_get_courses"),
+                ], token=token)
+                site_info = site_info_result.unwrap() or {}
                 user_id = site_info.get("userid")
                 
                 logger.info(f"[Discovery] User ID: {user_id}, Username: {site_info.get('username')}")
@@ -203,8 +354,10 @@ class SubjectDiscoveryService:
                     logger.warning("[Discovery] Could not get user ID from Moodle")
                     return None
                 
-                # Get all courses (MoodleClient uses get_courses, not get_user_courses)
-                courses = await client.get_courses(token=token)
+                # core_course_get_courses returns a plain list of courses
+                courses = courses_result.unwrap()
+                if not isinstance(courses, list):
+                    courses = []
                 
                 logger.info(f"[Discovery] Found {len(courses) if courses else 0} courses for user")
                 
@@ -339,6 +492,9 @@ class SubjectDiscoveryService:
         """
         Persist discovered mapping to database.
         
+        Written as an upsert: callers that shared one discovery all persist
+        it from their own sessions, and must not fail on each other's row.
+        
         Args:
             subject_code: Subject code
             course_id: Moodle course ID
@@ -349,30 +505,21 @@ class SubjectDiscoveryService:
         Returns:
             Created or updated SubjectMapping
         """
-        existing = await self._get_from_database(subject_code)
-        
-        if existing:
-            # Update existing mapping
-            existing.moodle_course_id = course_id
-            existing.moodle_assignment_id = assignment_id
-            existing.moodle_assignment_name = assignment_name
-            existing.last_verified_at = datetime.utcnow()
-            logger.debug(f"Updated mapping for {subject_code} from {source}")
-            await self.db.flush()
-            return existing
-        else:
-            # Create new mapping
-            new_mapping = SubjectMapping(
-                subject_code=subject_code,
-                moodle_course_id=course_id,
-                moodle_assignment_id=assignment_id,
-                moodle_assignment_name=assignment_name,
-                is_active=True
-            )
-            self.db.add(new_mapping)
-            await self.db.flush()
-            logger.info(f"Created new mapping for {subject_code} from {source}")
-            return new_mapping
+        values = {
+            "moodle_course_id": course_id,
+            "moodle_assignment_id": assignment_id,
+            "moodle_assignment_name": assignment_name,
+            "last_verified_at": datetime.utcnow(),
+        }
+        result = await self.db.execute(
+            insert(SubjectMapping)
+            .values(subject_code=subject_code, is_active=True, **values)
+            .on_conflict_do_update(index_elements=["subject_code"], set_=values)
+            .returning(SubjectMapping)
+        )
+        mapping = result.scalar_one()
+        logger.info(f"Saved mapping for {subject_code} from {source}")
+        return mapping
     
     # ==========================================
     # Cache Management Methods
@@ -386,15 +533,30 @@ class SubjectDiscoveryService:
         Returns:
             Number of entries cleared
         """
-        count = await subject_cache.clear()
+        count = await subject_cache.clear() + await subject_negative_cache.clear()
         logger.info(f"Cleared {count} entries from subject cache")
         return count
     
+    @classmethod
+    async def clear_negative_cache(cls) -> int:
+        """
+        Forget all failed lookups, e.g. after mappings were added in bulk.
+        
+        Returns:
+            Number of entries cleared
+        """
+        count = await subject_negative_cache.clear()
+        logger.info(f"Cleared {count} unresolved subject codes from cache")
+        return count
+    
     @classmethod
     async def invalidate_subject(cls, subject_code: str) -> bool:
         """
         Invalidate cache for a specific subject.
         
+        Drops both a cached mapping and a cached failed lookup, so a new
+        or changed mapping is picked up by the next lookup.
+        
         Args:
             subject_code: Subject code to invalidate
             
@@ -404,6 +566,8 @@ class SubjectDiscoveryService:
         subject_code = subject_code.upper().strip()
         cache_key = f"subject:{subject_code}"
         result = await subject_cache.delete(cache_key)
+        for negative_key in (cache_key, f"{cache_key}:no-token"):
+            result = await subject_negative_cache.delete(negative_key) or result
         if result:
             logger.info(f"Invalidated cache for {subject_code}")
         return result
@@ -416,7 +580,10 @@ class SubjectDiscoveryService:
         Returns:
             Dictionary with cache stats
         """
-        return await subject_cache.stats()
+        return {
+            **await subject_cache.stats(),
+            "negative": await subject_negative_cache.stats()
+        }
     
     # ==========================================
     # Bulk Operations
@@ -424,19 +591,29 @@ class SubjectDiscoveryService:
     
     async def refresh_all_mappings(
         self,
-        user_token: str
+        user_token: str,
+        progress: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
         """
         Refresh all mappings by re-discovering from Moodle.
         
-        This is useful for syncing after Moodle course changes.
+        This is useful for syncing after Moodle course changes. Courses and
+        assignments are fetched once and all subject codes are matched in a
+        single pass over them. The new mapping set is diffed against
+        subject_mappings and only the differences are written: changed
+        assignments in one bulk UPDATE, and mappings for uploaded subject
+        codes that have none yet in one INSERT.
         
         Args:
             user_token: Moodle token with access to courses
+            progress: Optional dict updated with the current phase and counts
             
         Returns:
             Summary of refresh results
         """
+        progress = progress if progress is not None else {}
+        progress["phase"] = "loading"
+        
         # Get all active mappings
         result = await self.db.execute(
             select(SubjectMapping)
@@ -444,31 +621,52 @@ class SubjectDiscoveryService:
         )
         mappings = list(result.scalars().all())
         
+        # Uploaded subject codes with no mapping at all (inactive ones count)
+        result = await self.db.execute(
+            select(ExaminationArtifact.parsed_subject_code)
+            .where(ExaminationArtifact.parsed_subject_code.isnot(None))
+            .distinct()
+        )
+        unmapped = {code.upper().strip() for code in result.scalars().all() if code}
+        result = await self.db.execute(select(SubjectMapping.subject_code))
+        unmapped -= set(result.scalars().all())
+        
         results = {
             "total": len(mappings),
             "refreshed": 0,
             "unchanged": 0,
             "failed": 0,
+            "created": 0,
             "details": []
         }
+        progress["mappings"] = len(mappings)
         
+        # One crawl for all subjects, matched by one automaton
+        progress["phase"] = "crawling"
+        courses = await subject_catalog.crawl(token=user_token, progress=progress)
+        progress["phase"] = "matching"
+        resolved = SubjectCodeMatcher(
+            [m.subject_code for m in mappings] + sorted(unmapped)
+        ).resolve(courses)
+        
+        now = datetime.utcnow()
+        changes = []
+        verified_ids = []
         for mapping in mappings:
             subject_code = mapping.subject_code
             old_assignment_id = mapping.moodle_assignment_id
-            
-            # Invalidate cache first
-            await self.invalidate_subject(subject_code)
-            
-            # Try to discover
-            discovered = await self._discover_from_moodle(subject_code, user_token)
+            discovered = resolved.get(subject_code.upper().strip())
             
             if discovered:
                 new_assignment_id = discovered["assignment_id"]
                 if new_assignment_id != old_assignment_id:
-                    mapping.moodle_assignment_id = new_assignment_id
-                    mapping.moodle_course_id = discovered["course_id"]
-                    mapping.moodle_assignment_name = discovered.get("assignment_name")
-                    mapping.last_verified_at = datetime.utcnow()
+                    changes.append({
+                        "id": mapping.id,
+                        "moodle_assignment_id": new_assignment_id,
+                        "moodle_course_id": discovered["course_id"],
+                        "moodle_assignment_name": discovered.get("assignment_name"),
+                        "last_verified_at": now
+                    })
                     results["refreshed"] += 1
                     results["details"].append({
                         "subject_code": subject_code,
@@ -477,7 +675,7 @@ class SubjectDiscoveryService:
                         "new_id": new_assignment_id
                     })
                 else:
-                    mapping.last_verified_at = datetime.utcnow()
+                    verified_ids.append(mapping.id)
                     results["unchanged"] += 1
                     results["details"].append({
                         "subject_code": subject_code,
@@ -490,7 +688,122 @@ class SubjectDiscoveryService:
                     "status": "not_found"
                 })
         
+        new_rows = [
+            {
+                "subject_code": code,
+                "moodle_course_id": resolved[code]["course_id"],
+                "moodle_assignment_id": resolved[code]["assignment_id"],
+                "moodle_assignment_name": resolved[code].get("assignment_name"),
+                "is_active": True,
+                "last_verified_at": now
+            }
+            for code in sorted(unmapped) if code in resolved
+        ]
+        for row in new_rows:
+            results["details"].append({
+                "subject_code": row["subject_code"],
+                "status": "created",
+                "new_id": row["moodle_assignment_id"]
+            })
+        results["created"] = len(new_rows)
+        
+        progress["phase"] = "persisting"
+        if changes:
+            await self.db.execute(update(SubjectMapping), changes)
+        if verified_ids:
+            await self.db.execute(
+                update(SubjectMapping)
+                .where(SubjectMapping.id.in_(verified_ids))
+                .values(last_verified_at=now)
+            )
+        if new_rows:
+            await self.db.execute(
+                insert(SubjectMapping)
+                .values(new_rows)
+                .on_conflict_do_nothing(index_elements=["subject_code"])
+            )
         await self.db.flush()
-        logger.info(f"Mapping refresh complete: {results['refreshed']} updated, {results['unchanged']} unchanged, {results['failed']} failed")
+        
+        # Only changed subjects can have a stale cache entry
+        for change in results["details"]:
+            if change["status"] in ("updated", "created"):
+                await self.invalidate_subject(change["subject_code"])
+        
+        logger.info(
+            f"Mapping refresh complete: {results['refreshed']} updated, {results['unchanged']} unchanged, "
+            f"{results['failed']} failed, {results['created']} created"
+        )
         
         return results
+
+
+class MappingRefresher:
+    """
+    Runs refresh_all_mappings as a background task
+    
+    Only one refresh runs at a time. Progress (phase, crawl chunks done,
+    result) is kept in memory, so it is reported by the process that
+    started the refresh.
+    """
+    
+    def __init__(self, session_maker: Callable = async_session_maker):
+        self.session_maker = session_maker
+        self._task: Optional[asyncio.Task] = None
+        self.progress: Dict[str, Any] = {"status": "IDLE"}
+    
+    @property
+    def is_running(self) -> bool:
+        """Whether a refresh is in progress"""
+        return self._task is not None and not self._task.done()
+    
+    def start(self, token: str) -> Dict[str, Any]:
+        """
+        Start a refresh unless one is already running
+        
+        Args:
+            token: Moodle token to crawl with
+            
+        Returns:
+            Progress of the running refresh
+        """
+        if not self.is_running:
+            self.progress = {
+                "status": "RUNNING",
+                "phase": "starting",
+                "started_at": datetime.utcnow().isoformat(),
+                "finished_at": None
+            }
+            self._task = asyncio.ensure_future(self._run(token))
+        return self.status()
+    
+    async def _run(self, token: str) -> None:
+        """Refresh in its own session and record the outcome"""
+        try:
+            async with self.session_maker() as db:
+                summary = await SubjectDiscoveryService(db).refresh_all_mappings(
+                    token, progress=self.progress
+                )
+                await db.commit()
+            self.progress.update(status="COMPLETED", phase="done", result=summary)
+        except Exception as e:
+            logger.error(f"Mapping refresh failed: {e}")
+            self.progress.update(status="FAILED", error=str(e))
+        finally:
+            self.progress["finished_at"] = datetime.utcnow().isoformat()
+    
+    def status(self) -> Dict[str, Any]:
+        """Current or last refresh progress"""
+        return dict(self.progress)
+    
+    async def stop(self) -> None:
+        """Cancel a running refresh"""
+        if not self.is_running:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self.progress["status"] = "CANCELLED"
+
+
+# Global instance
+mapping_refresher = MappingRefresher()
@@ -0,0 +1,332 @@
+"""
+Submission Job Service
+Runs student submissions in background workers instead of inside the request
+"""
+
+import json
+import uuid
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List, Callable
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update, or_, and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.security import token_encryption
+from app.db.database import async_session_maker
+from app.db.models import SubmissionJob, ExaminationArtifact
+from app.services.submission_service import SubmissionService
+
+logger = logging.getLogger(__name__)
+
+
+class SubmissionJobService:
+    """
+    Database operations for submission jobs
+    
+    A job records everything needed to run SubmissionService.submit_artifact
+    later: the artifact, the student's identity and their (encrypted) Moodle
+    token. The token is wiped as soon as the job finishes.
+    """
+    
+    QUEUED = "QUEUED"
+    RUNNING = "RUNNING"
+    SUCCEEDED = "SUCCEEDED"
+    FAILED = "FAILED"
+    ACTIVE = (QUEUED, RUNNING)
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+    
+    async def enqueue(
+        self,
+        artifact: ExaminationArtifact,
+        moodle_token: str,
+        moodle_user_id: int,
+        moodle_username: str,
+        register_number: str,
+        actor_ip: Optional[str] = None,
+        lock_submission: bool = True
+    ) -> SubmissionJob:
+        """
+        Create a job for an artifact, or return the one already pending
+        
+        Repeated clicks on "Submit" while a job is queued or running do not
+        start a second Moodle submission.
+        """
+        jobs = await self.enqueue_many(
+            [artifact],
+            moodle_token=moodle_token,
+            moodle_user_id=moodle_user_id,
+            moodle_username=moodle_username,
+            register_number=register_number,
+            actor_ip=actor_ip,
+            lock_submission=lock_submission
+        )
+        return jobs[0]
+    
+    async def enqueue_many(
+        self,
+        artifacts: List[ExaminationArtifact],
+        moodle_token: str,
+        moodle_user_id: int,
+        moodle_username: str,
+        register_number: str,
+        actor_ip: Optional[str] = None,
+        lock_submission: bool = True
+    ) -> List[SubmissionJob]:
+        """
+        Create one job per artifact with a single INSERT
+        
+        Artifacts that already have a queued or running job keep it: the
+        insert conflicts on uq_submission_job_active_artifact and the no-op
+        DO UPDATE makes RETURNING hand back the existing job. This holds
+        against concurrent submits from other requests or processes too.
+        
+        Returns:
+            Jobs aligned with the de-duplicated artifacts, in input order
+        """
+        artifacts = list({artifact.id: artifact for artifact in artifacts}.values())
+        if not artifacts:
+            return []
+        
+        encrypted_token = token_encryption.encrypt(moodle_token)
+        statement = insert(SubmissionJob).values([
+            {
+                "job_uuid": uuid.uuid4(),
+                "artifact_id": artifact.id,
+                "moodle_user_id": moodle_user_id,
+                "moodle_username": moodle_username,
+                "register_number": register_number,
+                "encrypted_token": encrypted_token,
+                "actor_ip": actor_ip,
+                "lock_submission": lock_submission,
+                "status": self.QUEUED,
+            }
+            for artifact in artifacts
+        ])
+        result = await self.db.execute(
+            statement.on_conflict_do_update(
+                index_elements=["artifact_id"],
+                index_where=SubmissionJob.status.in_(self.ACTIVE),
+                set_={"artifact_id": statement.excluded.artifact_id}
+            )
+            .returning(SubmissionJob)
+        )
+        jobs = {job.artifact_id: job for job in result.scalars().all()}
+        
+        logger.info(f"Queued submission jobs for {len(artifacts)} artifact(s)")
+        return [jobs[artifact.id] for artifact in artifacts]
+    
+    async def get_by_uuid(self, job_uuid: str) -> Optional[SubmissionJob]:
+        try:
+            job_uuid = uuid.UUID(str(job_uuid))
+        except ValueError:
+            return None
+        result = await self.db.execute(
+            select(SubmissionJob).where(SubmissionJob.job_uuid == job_uuid)
+        )
+        return result.scalar_one_or_none()
+    
+    async def get_active_for_artifact(self, artifact_id: int) -> Optional[SubmissionJob]:
+        result = await self.db.execute(
+            select(SubmissionJob)
+            .where(
+                SubmissionJob.artifact_id == artifact_id,
+                SubmissionJob.status.in_(self.ACTIVE)
+            )
+            .order_by(SubmissionJob.created_at.desc())
+            .limit(1)
+        )
+        return result.scalar_one_or_none()
+    
+    async def claim_next(self) -> Optional[SubmissionJob]:
+        """
+        Mark the oldest queued job as running and return it
+        
+        FOR UPDATE SKIP LOCKED lets any number of workers (in this process
+        or others) claim jobs concurrently without taking the same one.
+        The claim holds a lease that the worker renews while the job runs;
+        RUNNING jobs whose lease expired were orphaned by a dead worker and
+        are claimed again. The caller must commit to release the row lock.
+        """
+        now = datetime.now(timezone.utc)
+        result = await self.db.execute(
+            select(SubmissionJob)
+            .where(or_(
+                SubmissionJob.status == self.QUEUED,
+                and_(
+                    SubmissionJob.status == self.RUNNING,
+                    SubmissionJob.lease_expires_at < now
+                )
+            ))
+            .order_by(SubmissionJob.created_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        job = result.scalar_one_or_none()
+        if job:
+            if job.status == self.RUNNING:
+                logger.warning(f"Reclaiming submission job {job.job_uuid} after its lease expired")
+            job.status = self.RUNNING
+            job.started_at = now
+            job.lease_expires_at = now + timedelta(seconds=settings.submission_job_lease_seconds)
+            await self.db.flush()
+        return job
+    
+    async def renew_lease(self, job_id: int) -> bool:
+        """Extend the lease of a running job; False if it is no longer running"""
+        result = await self.db.execute(
+            update(SubmissionJob)
+            .where(SubmissionJob.id == job_id, SubmissionJob.status == self.RUNNING)
+            .values(lease_expires_at=datetime.now(timezone.utc) + timedelta(
+                seconds=settings.submission_job_lease_seconds
+            ))
+        )
+        return bool(result.rowcount)
+
+
+class SubmissionWorker:
+    """
+    Pool of asyncio workers that execute submission jobs
+    
+    Each worker claims one job at a time, runs the full Moodle workflow
+    through SubmissionService with its own database session, and records
+    the outcome on the job. Workers poll for queued jobs and are woken
+    immediately by notify() when a job is enqueued in the same process.
+    """
+    
+    def __init__(
+        self,
+        concurrency: Optional[int] = None,
+        poll_seconds: Optional[float] = None,
+        session_maker: Callable = async_session_maker
+    ):
+        self.concurrency = concurrency or settings.submission_worker_concurrency
+        self.poll_seconds = poll_seconds or settings.submission_worker_poll_seconds
+        self.session_maker = session_maker
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+    
+    def notify(self) -> None:
+        """Wake idle workers (no-op if the pool is not running here)"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    async def _claim(self) -> Optional[int]:
+        async with self.session_maker() as db:
+            job = await SubmissionJobService(db).claim_next()
+            await db.commit()
+            return job.id if job else None
+    
+    async def _heartbeat(self, job_id: int) -> None:
+        """Renew the lease of a running job until cancelled"""
+        interval = settings.submission_job_lease_seconds / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with self.session_maker() as db:
+                    await SubmissionJobService(db).renew_lease(job_id)
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Could not renew lease of submission job {job_id}: {e}")
+    
+    async def run_job(self, job_id: int) -> None:
+        """Execute one claimed job, renewing its lease, and store its outcome"""
+        heartbeat = asyncio.ensure_future(self._heartbeat(job_id))
+        try:
+            await self._run_job(job_id)
+        finally:
+            heartbeat.cancel()
+    
+    async def _run_job(self, job_id: int) -> None:
+        async with self.session_maker() as db:
+            job = await db.get(SubmissionJob, job_id)
+            artifact = await db.get(ExaminationArtifact, job.artifact_id)
+            
+            try:
+                success, message, result = await SubmissionService(db).submit_artifact(
+                    artifact_uuid=str(artifact.artifact_uuid),
+                    moodle_token=token_encryption.decrypt(job.encrypted_token),
+                    moodle_user_id=job.moodle_user_id,
+                    moodle_username=job.moodle_username,
+                    register_number=job.register_number,
+                    actor_ip=job.actor_ip,
+                    lock_submission=job.lock_submission
+                )
+            except Exception as e:
+                logger.error(f"Submission job {job.job_uuid} crashed: {e}")
+                await db.rollback()
+                job = await db.get(SubmissionJob, job_id)
+                success, message, result = False, f"Unexpected error: {e}", None
+            
+            job.status = SubmissionJobService.SUCCEEDED if success else SubmissionJobService.FAILED
+            job.message = message
+            job.result = json.loads(json.dumps(result, default=str)) if result else None
+            job.encrypted_token = None
+            job.finished_at = datetime.now(timezone.utc)
+            job.lease_expires_at = None
+            await db.commit()
+            
+            logger.info(f"Submission job {job.job_uuid} finished: {job.status} - {message}")
+    
+    async def _worker(self, index: int) -> None:
+        while not self._stop_event.is_set():
+            try:
+                job_id = await self._claim()
+            except Exception as e:
+                logger.error(f"Submission worker {index} could not claim a job: {e}")
+                job_id = None
+            
+            if job_id is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            try:
+                await self.run_job(job_id)
+            except Exception as e:
+                logger.error(f"Submission worker {index} failed on job {job_id}: {e}")
+    
+    async def start(self) -> None:
+        """Start the worker tasks"""
+        self._wakeup = asyncio.Event()
+        self._stop_event = asyncio.Event()
+        
+        self._tasks = [
+            asyncio.ensure_future(self._worker(index)) for index in range(self.concurrency)
+        ]
+        logger.info(f"Started {self.concurrency} submission worker(s)")
+    
+    async def stop(self) -> None:
+        """Let running jobs finish, then stop the workers"""
+        if not self._tasks:
+            return
+        self._stop_event.set()
+        self._wakeup.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._wakeup = None
+        logger.info("Submission workers stopped")
+    
+    async def run(self, stop_event: asyncio.Event) -> None:
+        """Run the pool until stop_event is set (standalone worker process)"""
+        await self.start()
+        try:
+            await stop_event.wait()
+        finally:
+            await self.stop()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"workers": len(self._tasks), "running": bool(self._tasks)}
+
+
+# Global instance
+submission_worker = SubmissionWorker()
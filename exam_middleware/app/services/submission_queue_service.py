@@ -0,0 +1,180 @@
+"""
+Submission Queue Processor
+Continuously retries submissions parked in the submission queue
+"""
+
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List, Callable
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update, or_
+
+from app.core.config import settings
+from app.db.database import async_session_maker
+from app.db.models import SubmissionQueue
+from app.services.moodle_guard import moodle_guard
+from app.services.submission_service import SubmissionService
+
+logger = logging.getLogger(__name__)
+
+
+class SubmissionQueueProcessor:
+    """
+    Queue consumer for submissions that failed while Moodle was unavailable
+    
+    Rows are claimed in short transactions with FOR UPDATE SKIP LOCKED and
+    flipped to PROCESSING, so any number of processes and replicas can
+    drain the queue together without two of them submitting the same row.
+    While a row is PROCESSING its next_retry_at holds the claim's lease
+    expiry; rows whose lease ran out (worker crashed) are put back.
+    
+    Claimed rows are processed concurrently, each with its own session.
+    """
+    
+    def __init__(
+        self,
+        admin_token: Optional[str] = None,
+        concurrency: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        poll_seconds: Optional[float] = None,
+        session_maker: Callable = async_session_maker
+    ):
+        self.admin_token = admin_token or settings.moodle_admin_token
+        self.concurrency = concurrency or settings.submission_queue_concurrency
+        self.batch_size = batch_size or settings.submission_queue_batch_size
+        self.poll_seconds = poll_seconds or settings.submission_queue_poll_seconds
+        self.session_maker = session_maker
+        self._stop_event: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    async def claim_batch(self) -> List[int]:
+        """Claim due QUEUED rows and return their ids"""
+        now = datetime.now(timezone.utc)
+        lease_until = now + timedelta(seconds=settings.submission_queue_lease_seconds)
+        
+        async with self.session_maker() as db:
+            # Put back rows whose claim expired
+            await db.execute(
+                update(SubmissionQueue)
+                .where(
+                    SubmissionQueue.status == "PROCESSING",
+                    SubmissionQueue.next_retry_at < now
+                )
+                .values(status="QUEUED", next_retry_at=now)
+            )
+            
+            result = await db.execute(
+                select(SubmissionQueue)
+                .where(
+                    SubmissionQueue.status == "QUEUED",
+                    or_(
+                        SubmissionQueue.next_retry_at.is_(None),
+                        SubmissionQueue.next_retry_at <= now
+                    )
+                )
+                .order_by(SubmissionQueue.priority, SubmissionQueue.queued_at)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            items = result.scalars().all()
+            for item in items:
+                item.status = "PROCESSING"
+                item.next_retry_at = lease_until
+            
+            await db.commit()
+            return [item.id for item in items]
+    
+    async def process_item(self, item_id: int) -> Dict[str, Any]:
+        """Run one claimed row in its own session"""
+        async with self.session_maker() as db:
+            item = await db.get(SubmissionQueue, item_id)
+            try:
+                detail = await SubmissionService(db).process_queue_item(item, self.admin_token)
+                await db.commit()
+            except Exception as e:
+                # Leave the row PROCESSING; the lease expiry brings it back
+                logger.error(f"Queue item {item_id} could not be processed: {e}")
+                await db.rollback()
+                detail = {"artifact_uuid": None, "status": "failed", "error": str(e)}
+        
+        return detail
+    
+    async def drain_once(self) -> Dict[str, Any]:
+        """
+        Claim one batch and process it
+        
+        Returns:
+            Dict with processed / successful / failed counts and details
+        """
+        result = {
+            "processed": 0,
+            "successful": 0,
+            "failed": 0,
+            "details": []
+        }
+        
+        if moodle_guard.is_open:
+            logger.warning("Moodle circuit open - not processing the submission queue")
+            return result
+        
+        item_ids = await self.claim_batch()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def run(item_id: int) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.process_item(item_id)
+        
+        for detail in await asyncio.gather(*(run(item_id) for item_id in item_ids)):
+            result["processed"] += 1
+            if detail["status"] in ("success", "already_submitted"):
+                result["successful"] += 1
+            elif detail["status"] == "failed":
+                result["failed"] += 1
+            result["details"].append(detail)
+        
+        return result
+    
+    async def run(self, stop_event: asyncio.Event) -> None:
+        """Drain the queue until stop_event is set"""
+        while not stop_event.is_set():
+            try:
+                result = await self.drain_once()
+            except Exception as e:
+                logger.error(f"Submission queue processing failed: {e}")
+                result = {"processed": 0}
+            
+            if result["processed"]:
+                logger.info(
+                    f"Submission queue: {result['successful']} submitted, "
+                    f"{result['failed']} failed of {result['processed']}"
+                )
+            
+            if result["processed"] < self.batch_size:
+                # Caught up - wait for more rows to become due
+                try:
+                    await asyncio.wait_for(stop_event.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def start(self) -> None:
+        """Start the consumer as a background task"""
+        if not self.admin_token:
+            logger.warning("MOODLE_ADMIN_TOKEN not set - submission queue processor disabled")
+            return
+        self._stop_event = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run(self._stop_event))
+        logger.info("Submission queue processor started")
+    
+    async def stop(self) -> None:
+        """Finish the current batch and stop"""
+        if not self._task:
+            return
+        self._stop_event.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        logger.info("Submission queue processor stopped")
+
+
+# Global instance
+submission_queue_processor = SubmissionQueueProcessor()
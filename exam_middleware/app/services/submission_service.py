@@ -3,13 +3,17 @@ Submission Service
 Orchestrates the complete submission workflow to Moodle
 """
 
+import random
 import logging
-from typing import Optional, Dict, Any, Tuple
-from datetime import datetime
+from typing import Optional, Dict, Any, Tuple, Union
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.db.models import ExaminationArtifact, WorkflowStatus
-from app.services.moodle_client import MoodleClient, MoodleAPIError
+from app.services.moodle_client import MoodleClient, MoodleCall, MoodleAPIError, MoodleUnavailableError
+from app.services.moodle_guard import moodle_guard
+from app.services.moodle_rate_limiter import background_priority
+from app.services.draft_staging_service import staged_draft_item
 from app.services.artifact_service import ArtifactService, SubjectMappingService, AuditService
 from app.services.subject_discovery_service import SubjectDiscoveryService
 from app.core.security import token_encryption
@@ -67,6 +71,43 @@ class SubmissionService:
         if not artifact:
             return False, "Artifact not found", None
         
+        rejection = await self._check_submittable(
+            artifact, register_number, moodle_user_id, moodle_username, actor_ip
+        )
+        if rejection:
+            return rejection
+        
+        # Get assignment ID (uses hybrid discovery with dynamic Moodle lookup)
+        assignment_id = await self._resolve_assignment_id(artifact, moodle_token=moodle_token)
+        if not assignment_id:
+            return False, f"No assignment mapping found for subject code: {artifact.parsed_subject_code}", None
+        
+        if not await self.artifact_service.claim_for_submission(artifact):
+            # Submitted (or still being submitted) by someone else meanwhile
+            await self.db.refresh(artifact)
+            rejection = await self._check_submittable(
+                artifact, register_number, moodle_user_id, moodle_username, actor_ip
+            )
+            return rejection or (False, "This paper is already being submitted", {"in_progress": True})
+        await self.db.commit()
+        
+        await self._start_submission(artifact, assignment_id, moodle_user_id, moodle_username, actor_ip)
+        outcome = await self._run_submission(
+            artifact, assignment_id, moodle_token, lock_submission, moodle_user_id
+        )
+        return await self._finish_submission(
+            artifact, outcome, moodle_user_id, moodle_username, actor_ip
+        )
+    
+    async def _check_submittable(
+        self,
+        artifact: ExaminationArtifact,
+        register_number: str,
+        moodle_user_id: int,
+        moodle_username: str,
+        actor_ip: Optional[str]
+    ) -> Optional[Tuple[bool, str, Optional[Dict[str, Any]]]]:
+        """Ownership and already-submitted checks; returns the failure, if any"""
         # Security check: Verify the artifact belongs to this user (compare register numbers)
         if artifact.parsed_reg_no != register_number:
             logger.warning(
@@ -92,11 +133,16 @@ class SubmissionService:
                 "submitted_at": artifact.submit_timestamp.isoformat() if artifact.submit_timestamp else None
             }
         
-        # Get assignment ID (uses hybrid discovery with dynamic Moodle lookup)
-        assignment_id = await self._resolve_assignment_id(artifact, moodle_token=moodle_token)
-        if not assignment_id:
-            return False, f"No assignment mapping found for subject code: {artifact.parsed_subject_code}", None
-        
+        return None
+    
+    async def _start_submission(
+        self,
+        artifact: ExaminationArtifact,
+        assignment_id: int,
+        moodle_user_id: int,
+        moodle_username: str,
+        actor_ip: Optional[str]
+    ) -> None:
         # Update artifact with Moodle info
         artifact.moodle_user_id = moodle_user_id
         artifact.moodle_username = moodle_username
@@ -113,43 +159,43 @@ class SubmissionService:
             artifact_id=artifact.id,
             description=f"Starting submission for assignment {assignment_id}"
         )
-        
-        # Execute the 3-step submission process
+    
+    async def _run_submission(
+        self,
+        artifact: ExaminationArtifact,
+        assignment_id: int,
+        moodle_token: str,
+        lock_submission: bool,
+        moodle_user_id: int
+    ) -> Union[Dict[str, Any], Exception]:
+        """Execute the 3-step submission process, returning the result or the error"""
         try:
-            result = await self._execute_submission(
+            if moodle_guard.is_open:
+                # Moodle is known to be down - queue straight away instead of
+                # holding the request open
+                raise MoodleUnavailableError("Moodle is unavailable (circuit open)")
+            
+            return await self._execute_submission(
                 artifact=artifact,
                 assignment_id=assignment_id,
                 moodle_token=moodle_token,
-                lock_submission=lock_submission
+                lock_submission=lock_submission,
+                draft_owner_id=moodle_user_id
             )
-            
-            # Log the complete result for debugging
-            logger.info(f"Submission result: {result}")
-            logger.info(f"Steps completed: {result.get('steps_completed', [])}")
-            
-            # Mark as completed (only after all verification and submit steps)
-            await self.artifact_service.mark_submitted(
-                artifact_id=artifact.id,
-                moodle_submission_id=result.get("submission_id"),
-                lms_transaction_id=result.get("transaction_id")
-            )
-            
-            # Log success
-            await self.audit_service.log_action(
-                action="submission_completed",
-                action_category="submit",
-                actor_type="student",
-                actor_id=str(moodle_user_id),
-                actor_username=moodle_username,
-                actor_ip=actor_ip,
-                artifact_id=artifact.id,
-                response_data=result,
-                description="Submission completed successfully"
-            )
-            
-            return True, "Submission completed successfully", result
-            
-        except MoodleAPIError as e:
+        except Exception as e:
+            return e
+    
+    async def _finish_submission(
+        self,
+        artifact: ExaminationArtifact,
+        outcome: Union[Dict[str, Any], Exception],
+        moodle_user_id: int,
+        moodle_username: str,
+        actor_ip: Optional[str]
+    ) -> Tuple[bool, str, Optional[Dict[str, Any]]]:
+        """Record the outcome of _run_submission on the artifact and audit log"""
+        if isinstance(outcome, MoodleAPIError):
+            e = outcome
             logger.error(f"Moodle API error during submission: {e}")
             
             # Check if this is a transient error that should be queued
@@ -183,8 +229,9 @@ class SubmissionService:
                 }
             
             return False, f"Submission failed: {e.message}", {"error": str(e)}
-            
-        except Exception as e:
+        
+        if isinstance(outcome, Exception):
+            e = outcome
             logger.error(f"Unexpected error during submission: {e}")
             
             await self.artifact_service.mark_failed(
@@ -194,6 +241,34 @@ class SubmissionService:
             )
             
             return False, f"Unexpected error: {str(e)}", None
+        
+        result = outcome
+        
+        # Log the complete result for debugging
+        logger.info(f"Submission result: {result}")
+        logger.info(f"Steps completed: {result.get('steps_completed', [])}")
+        
+        # Mark as completed (only after all verification and submit steps)
+        await self.artifact_service.mark_submitted(
+            artifact_id=artifact.id,
+            moodle_submission_id=result.get("submission_id"),
+            lms_transaction_id=result.get("transaction_id")
+        )
+        
+        # Log success
+        await self.audit_service.log_action(
+            action="submission_completed",
+            action_category="submit",
+            actor_type="student",
+            actor_id=str(moodle_user_id),
+            actor_username=moodle_username,
+            actor_ip=actor_ip,
+            artifact_id=artifact.id,
+            response_data=result,
+            description="Submission completed successfully"
+        )
+        
+        return True, "Submission completed successfully", result
     
     async def _resolve_assignment_id(
         self, 
@@ -226,14 +301,18 @@ class SubmissionService:
         artifact: ExaminationArtifact,
         assignment_id: int,
         moodle_token: str,
-        lock_submission: bool
+        lock_submission: bool,
+        draft_owner_id: Optional[int] = None
     ) -> Dict[str, Any]:
         """
         Execute the 3-step submission process
         
-        Step 1: Upload file to draft area
+        Step 1: Upload file to draft area (skipped if pre-staged)
         Step 2: Link draft to assignment
         Step 3: Finalize submission (optional)
+        
+        draft_owner_id is the Moodle user whose token is used; a draft
+        pre-staged by that user is reused instead of uploading again.
         """
         client = MoodleClient(token=moodle_token)
         result = {
@@ -242,11 +321,18 @@ class SubmissionService:
         }
         
         try:
+            staged_item_id = staged_draft_item(artifact, draft_owner_id)
+            
             # Check if we have a previous draft that failed
             if artifact.moodle_draft_item_id and artifact.workflow_status == WorkflowStatus.UPLOADING:
                 logger.info(f"Reusing existing draft item: {artifact.moodle_draft_item_id}")
                 item_id = artifact.moodle_draft_item_id
                 result["steps_completed"].append("upload_skipped_reuse")
+            elif staged_item_id:
+                logger.info(f"Using pre-staged draft item: {staged_item_id}")
+                item_id = staged_item_id
+                result["item_id"] = item_id
+                result["steps_completed"].append("upload_skipped_staged")
             else:
                 # Step 1: Upload to draft area
                 logger.info(f"Step 1/3: Uploading file to draft area")
@@ -266,16 +352,25 @@ class SubmissionService:
                 result["item_id"] = item_id
                 result["steps_completed"].append("upload")
             
-            # Step 2: Verify assignment exists and is accessible BEFORE saving
-            logger.info(f"Verifying assignment {assignment_id} exists and is accessible...")
-            try:
-                # Try to get submission status - this will fail if assignment doesn't exist
-                verify_status = await client.get_submission_status(
-                    assignment_id=assignment_id,
-                    token=moodle_token
-                )
-                logger.info(f"Assignment {assignment_id} verified and accessible")
-            except MoodleAPIError as verify_error:
+            # Step 2: Verify the assignment, save the submission and read back
+            # its status. Moodle runs these in order in a single batched request
+            # and stops at the first error, so a missing assignment never
+            # reaches save_submission.
+            logger.info(f"Step 2/3: Verifying assignment {assignment_id} and linking draft")
+            artifact.workflow_status = WorkflowStatus.SUBMITTING
+            await self.db.flush()
+            
+            verify, save, status = await client.call_batch([
+                MoodleCall("mod_assign_get_submission_status", {"assignid": assignment_id}),
+                MoodleCall("mod_assign_save_submission", {
+                    "assignmentid": assignment_id,
+                    "plugindata": {"files_filemanager": item_id},
+                }),
+                MoodleCall("mod_assign_get_submission_status", {"assignid": assignment_id}),
+            ], token=moodle_token)
+            
+            if not verify.ok:
+                verify_error = verify.error
                 logger.error(
                     f"Assignment {assignment_id} verification failed: {verify_error.message}. "
                     f"This usually means the assignment ID is incorrect or the student doesn't have access."
@@ -285,27 +380,15 @@ class SubmissionService:
                     f"Please verify the assignment ID in your subject mapping matches the Moodle assignment instance ID (not the course module ID).",
                     response_data={"assignment_id": assignment_id, "error": str(verify_error)}
                 )
+            logger.info(f"Assignment {assignment_id} verified and accessible")
             
-            # Step 2: Save submission
-            logger.info(f"Step 2/3: Linking draft to assignment")
-            artifact.workflow_status = WorkflowStatus.SUBMITTING
-            await self.db.flush()
-            
-            save_result = await client.save_submission(
-                assignment_id=assignment_id,
-                item_id=item_id,
-                token=moodle_token
-            )
+            save_result = MoodleClient.parse_save_submission_result(save.unwrap(), assignment_id)
             
             result["save_result"] = save_result
             result["steps_completed"].append("save")
             
             # Verify the submission was actually saved by checking status
-            logger.info(f"Verifying submission status after save...")
-            status_result = await client.get_submission_status(
-                assignment_id=assignment_id,
-                token=moodle_token
-            )
+            status_result = status.unwrap() or {}
             
             # Log the full status for debugging
             logger.info(f"Full submission status response: {status_result}")
@@ -369,6 +452,9 @@ class SubmissionService:
                     "No files found in submission after save. "
                     "Aborting submission and returning error to caller."
                 )
+                if staged_item_id:
+                    # Moodle probably purged the staged draft; upload afresh next time
+                    artifact.moodle_draft_item_id = None
                 raise MoodleAPIError(
                     "Moodle did not attach any files to the submission. "
                     "Please retry or contact the administrator.",
@@ -412,6 +498,9 @@ class SubmissionService:
     
     def _should_queue_for_retry(self, error: MoodleAPIError) -> bool:
         """Determine if an error should trigger a retry queue"""
+        if isinstance(error, MoodleUnavailableError):
+            return True
+        
         # Queue for transient errors (Moodle maintenance, timeouts, etc.)
         if error.error:
             transient_errors = [
@@ -458,89 +547,104 @@ class SubmissionService:
         finally:
             await client.close()
     
-    async def retry_queued_submissions(self, admin_token: str) -> Dict[str, Any]:
+    async def process_queue_item(self, item, admin_token: str) -> Dict[str, Any]:
         """
-        Retry all queued submissions (for background worker)
+        Retry one claimed SubmissionQueue row (see SubmissionQueueProcessor)
+        
+        The row must already be claimed (status PROCESSING) so no other
+        worker or replica can run it at the same time. On failure the row
+        goes back to QUEUED with next_retry_at pushed out by exponential
+        backoff with jitter, or to FAILED once max_retries is reached.
         
         This implements the buffer pattern from Section 6.4
+        
+        Args:
+            item: Claimed SubmissionQueue row
+            admin_token: Moodle token used for queued submissions
+            
+        Returns:
+            Detail dict with artifact_uuid and status
         """
-        from app.db.models import SubmissionQueue
-        from sqlalchemy import select
+        now = datetime.now(timezone.utc)
         
-        result = {
-            "processed": 0,
-            "successful": 0,
-            "failed": 0,
-            "details": []
-        }
+        artifact = await self.artifact_service.get_by_id(item.artifact_id)
+        if not artifact:
+            item.status = "FAILED"
+            item.last_error = "Artifact not found"
+            return {"artifact_uuid": None, "status": "failed", "error": item.last_error}
         
-        # Get queued items
-        query = await self.db.execute(
-            select(SubmissionQueue)
-            .where(SubmissionQueue.status == "QUEUED")
-            .order_by(SubmissionQueue.priority, SubmissionQueue.queued_at)
-            .limit(50)
-        )
+        detail = {"artifact_uuid": str(artifact.artifact_uuid)}
         
-        queue_items = query.scalars().all()
+        # Another row (or the student) may have got it through already
+        if artifact.workflow_status in [WorkflowStatus.COMPLETED, WorkflowStatus.SUBMITTED_TO_LMS]:
+            item.status = "COMPLETED"
+            item.processed_at = now
+            return {**detail, "status": "already_submitted"}
         
-        for item in queue_items:
-            result["processed"] += 1
-            
-            artifact = await self.artifact_service.get_by_id(item.artifact_id)
-            if not artifact:
-                item.status = "FAILED"
-                item.last_error = "Artifact not found"
-                result["failed"] += 1
-                continue
-            
-            # For queued items, we use the admin token
-            # In production, you'd need to handle this differently
-            try:
-                client = MoodleClient(token=admin_token)
-                
+        if moodle_guard.is_open:
+            # Leave it queued without spending a retry
+            item.status = "QUEUED"
+            item.next_retry_at = now + timedelta(seconds=settings.moodle_breaker_reset_seconds)
+            return {**detail, "status": "deferred"}
+        
+        if not await self.artifact_service.claim_for_submission(artifact):
+            # Being submitted elsewhere; look again once that has finished
+            item.status = "QUEUED"
+            item.next_retry_at = now + timedelta(seconds=self.retry_backoff(item.retry_count or 1))
+            return {**detail, "status": "deferred"}
+        await self.db.commit()
+        
+        try:
+            # Queue retries yield to student requests in the Moodle rate limiter
+            with background_priority():
                 submit_result = await self._execute_submission(
                     artifact=artifact,
                     assignment_id=artifact.moodle_assignment_id,
                     moodle_token=admin_token,
                     lock_submission=True
                 )
-                
-                item.status = "COMPLETED"
-                item.processed_at = datetime.utcnow()
-                
-                await self.artifact_service.mark_submitted(
+            
+            item.status = "COMPLETED"
+            item.processed_at = now
+            item.next_retry_at = None
+            
+            await self.artifact_service.mark_submitted(
+                artifact_id=artifact.id,
+                moodle_submission_id=submit_result.get("submission_id")
+            )
+            
+            return {**detail, "status": "success"}
+            
+        except Exception as e:
+            item.retry_count = (item.retry_count or 0) + 1
+            item.last_error = str(e)
+            
+            if item.retry_count >= (item.max_retries or 5):
+                item.status = "FAILED"
+                item.next_retry_at = None
+                await self.artifact_service.mark_failed(
                     artifact_id=artifact.id,
-                    moodle_submission_id=submit_result.get("submission_id")
+                    error_message=f"Max retries exceeded: {e}",
+                    queue_for_retry=False
                 )
-                
-                result["successful"] += 1
-                result["details"].append({
-                    "artifact_uuid": str(artifact.artifact_uuid),
-                    "status": "success"
-                })
-                
-            except Exception as e:
-                item.retry_count += 1
-                item.last_error = str(e)
-                
-                if item.retry_count >= item.max_retries:
-                    item.status = "FAILED"
-                    await self.artifact_service.mark_failed(
-                        artifact_id=artifact.id,
-                        error_message=f"Max retries exceeded: {e}",
-                        queue_for_retry=False
-                    )
-                
-                result["failed"] += 1
-                result["details"].append({
-                    "artifact_uuid": str(artifact.artifact_uuid),
-                    "status": "failed",
-                    "error": str(e)
-                })
+            else:
+                item.status = "QUEUED"
+                item.next_retry_at = now + timedelta(seconds=self.retry_backoff(item.retry_count))
+                await self.artifact_service.release_submission_claim(artifact.id, WorkflowStatus.QUEUED)
             
-            finally:
-                await client.close()
+            return {**detail, "status": "failed", "error": str(e)}
+    
+    @staticmethod
+    def retry_backoff(retry_count: int) -> float:
+        """
+        Seconds to wait before retry number retry_count + 1
         
-        await self.db.commit()
-        return result
+        Exponential backoff capped at SUBMISSION_QUEUE_BACKOFF_MAX_SECONDS,
+        with the upper half randomised so rows that failed together during
+        an outage do not all come back at the same moment.
+        """
+        delay = min(
+            settings.submission_queue_backoff_base_seconds * 2 ** max(retry_count - 1, 0),
+            settings.submission_queue_backoff_max_seconds
+        )
+        return delay / 2 + random.uniform(0, delay / 2)
@@ -0,0 +1,453 @@
+"""
+Upload Session Service
+Resumable chunked uploads for large scan batches
+"""
+
+import io
+import os
+import re
+import json
+import uuid
+import shutil
+import asyncio
+import hashlib
+import logging
+from typing import Optional, Dict, Any, AsyncIterator, List, Tuple
+from datetime import datetime, timedelta
+import aiofiles
+import aiofiles.os
+
+from app.core.config import settings
+from app.core.security import sanitize_filename
+
+logger = logging.getLogger(__name__)
+
+
+class UploadSessionError(Exception):
+    """Raised when an upload session operation cannot be performed"""
+    def __init__(self, message: str, status_code: int = 400):
+        self.message = message
+        self.status_code = status_code
+        super().__init__(self.message)
+
+
+class _AssembledFile(io.RawIOBase):
+    """
+    Seekable read-only view over the chunk files of a session
+    
+    Presents the chunks as one file without copying them, so archives can be
+    opened with zipfile/tarfile and scans streamed straight into the store.
+    """
+    
+    def __init__(self, paths: List[str], chunk_size: int, total_size: int):
+        super().__init__()
+        self._paths = paths
+        self._chunk_size = chunk_size
+        self._size = total_size
+        self._pos = 0
+        self._index = -1
+        self._chunk: Optional[io.BufferedReader] = None
+    
+    def readable(self) -> bool:
+        return True
+    
+    def seekable(self) -> bool:
+        return True
+    
+    def tell(self) -> int:
+        return self._pos
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+    
+    def readinto(self, buffer) -> int:
+        if self._pos >= self._size:
+            return 0
+        
+        index, offset = divmod(self._pos, self._chunk_size)
+        if index != self._index:
+            if self._chunk:
+                self._chunk.close()
+            self._chunk = open(self._paths[index], 'rb')
+            self._index = index
+        
+        # Reads stop at chunk boundaries; callers loop until EOF anyway
+        self._chunk.seek(offset)
+        read = self._chunk.readinto(memoryview(buffer)[:self._chunk_size - offset])
+        self._pos += read
+        return read
+    
+    def close(self) -> None:
+        if self._chunk:
+            self._chunk.close()
+            self._chunk = None
+        super().close()
+
+
+class _AssembledStream:
+    """Async read() adapter over an _AssembledFile for ingest_stream"""
+    
+    def __init__(self, fileobj: _AssembledFile):
+        self._fileobj = fileobj
+    
+    async def read(self, size: int = -1) -> bytes:
+        return await asyncio.to_thread(self._fileobj.read, size)
+    
+    def close(self) -> None:
+        self._fileobj.close()
+
+
+class UploadSessionService:
+    """
+    File-backed state for resumable chunked uploads
+    
+    Each session lives in uploads/temp/sessions/<session_id>/ with a
+    write-once session.json manifest and one file per verified chunk. Chunks
+    can arrive in any order and be retried; a chunk only counts as received
+    once its size and SHA-256 match and it has been renamed into place, so
+    the received set is read from the directory itself. That keeps parallel
+    chunk PUTs safe across workers and replicas sharing the upload dir, and
+    an interrupted transfer (or a server restart) resumes from the chunks
+    already stored.
+    
+    Finalizing renames the manifest to session.claimed.json first; the
+    rename is atomic, so only one finalize call can assemble a session.
+    """
+    
+    SESSION_DIR = "sessions"
+    MANIFEST = "session.json"
+    CLAIMED_MANIFEST = "session.claimed.json"
+    SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+    CHUNK_PATTERN = re.compile(r'^(\d{6})\.chunk$')
+    
+    def __init__(self, upload_dir: Optional[str] = None):
+        self.root = os.path.join(upload_dir or settings.upload_dir, "temp", self.SESSION_DIR)
+        os.makedirs(self.root, exist_ok=True)
+    
+    def _session_dir(self, session_id: str) -> str:
+        """Directory for a session, rejecting anything that is not a session id"""
+        if not self.SESSION_ID_PATTERN.match(session_id or ""):
+            raise UploadSessionError("Upload session not found", 404)
+        return os.path.join(self.root, session_id)
+    
+    def _chunk_path(self, session_id: str, index: int) -> str:
+        return os.path.join(self._session_dir(session_id), f"{index:06d}.chunk")
+    
+    def _expected_chunk_size(self, session: Dict[str, Any], index: int) -> int:
+        if index == session["total_chunks"] - 1:
+            return session["total_size"] - session["chunk_size"] * index
+        return session["chunk_size"]
+    
+    async def _save(self, session: Dict[str, Any], name: Optional[str] = None) -> None:
+        """Write the manifest atomically"""
+        name = name or self.MANIFEST
+        session_dir = self._session_dir(session["session_id"])
+        temp_path = os.path.join(session_dir, f"{name}.{uuid.uuid4().hex}")
+        async with aiofiles.open(temp_path, 'w') as f:
+            await f.write(json.dumps(session))
+        await aiofiles.os.replace(temp_path, os.path.join(session_dir, name))
+    
+    async def _load(self, session_id: str, staff_id: Optional[int]) -> Dict[str, Any]:
+        """
+        Load a manifest; sessions are only visible to the staff member who created them
+        
+        Sessions claimed by finalize load from the claimed manifest and carry
+        claimed=True.
+        """
+        session_dir = self._session_dir(session_id)
+        session = None
+        for name, claimed in ((self.MANIFEST, False), (self.CLAIMED_MANIFEST, True)):
+            try:
+                async with aiofiles.open(os.path.join(session_dir, name), 'r') as f:
+                    session = json.loads(await f.read())
+            except FileNotFoundError:
+                continue
+            session["claimed"] = claimed
+            break
+        
+        if session is None:
+            raise UploadSessionError("Upload session not found", 404)
+        if staff_id is not None and session["staff_id"] != staff_id:
+            raise UploadSessionError("Upload session not found", 404)
+        return session
+    
+    async def _received(self, session_id: str) -> Tuple[List[int], Optional[datetime]]:
+        """Indices of the verified chunk files on disk and when the newest arrived"""
+        session_dir = self._session_dir(session_id)
+        
+        def _scan() -> Tuple[List[int], Optional[datetime]]:
+            received = []
+            newest = None
+            with os.scandir(session_dir) as entries:
+                for entry in entries:
+                    match = self.CHUNK_PATTERN.match(entry.name)
+                    if not match:
+                        continue
+                    received.append(int(match.group(1)))
+                    modified = entry.stat().st_mtime
+                    newest = modified if newest is None else max(newest, modified)
+            return sorted(received), newest and datetime.utcfromtimestamp(newest)
+        
+        try:
+            return await asyncio.to_thread(_scan)
+        except FileNotFoundError:
+            raise UploadSessionError("Upload session not found", 404)
+    
+    async def _describe(self, session: Dict[str, Any]) -> Dict[str, Any]:
+        received, newest = await self._received(session["session_id"])
+        return self.describe(session, received, newest)
+    
+    def describe(
+        self,
+        session: Dict[str, Any],
+        received: List[int],
+        last_chunk_at: Optional[datetime] = None
+    ) -> Dict[str, Any]:
+        """Public view of a session including what is still missing"""
+        received = [i for i in received if i < session["total_chunks"]]
+        received_set = set(received)
+        missing = [i for i in range(session["total_chunks"]) if i not in received_set]
+        received_bytes = sum(self._expected_chunk_size(session, i) for i in received)
+        updated_at = datetime.fromisoformat(session["updated_at"])
+        if last_chunk_at and last_chunk_at > updated_at:
+            updated_at = last_chunk_at
+        
+        return {
+            "session_id": session["session_id"],
+            "filename": session["filename"],
+            "total_size": session["total_size"],
+            "chunk_size": session["chunk_size"],
+            "total_chunks": session["total_chunks"],
+            "received_chunks": received,
+            "missing_chunks": missing,
+            "received_bytes": received_bytes,
+            "complete": not missing,
+            "expires_at": updated_at + timedelta(hours=settings.upload_session_ttl_hours),
+        }
+    
+    async def create_session(
+        self,
+        filename: str,
+        total_size: int,
+        staff_id: int,
+        chunk_size: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Start a new upload session
+        
+        Args:
+            filename: Name of the file being uploaded (scan or archive)
+            total_size: Size of the whole file in bytes
+            staff_id: Staff member that owns the session
+            chunk_size: Requested chunk size, capped by settings
+        
+        Returns:
+            Session description (see describe)
+        """
+        await self.purge_expired()
+        
+        filename = sanitize_filename(filename)
+        if total_size <= 0:
+            raise UploadSessionError("total_size must be positive")
+        if total_size > settings.upload_session_max_size_bytes:
+            raise UploadSessionError(
+                f"Upload too large. Max size: {settings.upload_session_max_size_mb}MB", 413
+            )
+        
+        chunk_size = min(
+            chunk_size or settings.upload_session_chunk_size_bytes,
+            settings.upload_session_chunk_size_bytes
+        )
+        if chunk_size <= 0:
+            raise UploadSessionError("chunk_size must be positive")
+        
+        now = datetime.utcnow().isoformat()
+        session = {
+            "session_id": uuid.uuid4().hex,
+            "filename": filename,
+            "total_size": total_size,
+            "chunk_size": chunk_size,
+            "total_chunks": -(-total_size // chunk_size),
+            "staff_id": staff_id,
+            "created_at": now,
+            "updated_at": now,
+        }
+        
+        await aiofiles.os.makedirs(self._session_dir(session["session_id"]), exist_ok=True)
+        await self._save(session)
+        
+        logger.info(
+            f"Created upload session {session['session_id']} for {filename} "
+            f"({total_size} bytes, {session['total_chunks']} chunks)"
+        )
+        return self.describe(session, [])
+    
+    async def get_session(self, session_id: str, staff_id: Optional[int] = None) -> Dict[str, Any]:
+        """Describe a session so a client can resume from the missing chunks"""
+        return await self._describe(await self._load(session_id, staff_id))
+    
+    async def write_chunk(
+        self,
+        session_id: str,
+        index: int,
+        body: AsyncIterator[bytes],
+        checksum: str,
+        staff_id: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Store one chunk after verifying its size and SHA-256
+        
+        The body is streamed to a temp file and only renamed into place when
+        it verifies, so a corrupt retransmission never replaces a good chunk.
+        Re-sending an already received chunk is accepted.
+        
+        Args:
+            session_id: Upload session id
+            index: Zero-based chunk number
+            body: Async iterator over the request body
+            checksum: Expected hex SHA-256 of the chunk
+            staff_id: Owner check (None skips it)
+        
+        Returns:
+            Updated session description
+        """
+        session = await self._load(session_id, staff_id)
+        if session["claimed"]:
+            raise UploadSessionError("Upload session is being finalized", 409)
+        if not 0 <= index < session["total_chunks"]:
+            raise UploadSessionError(
+                f"Chunk index out of range (0-{session['total_chunks'] - 1})"
+            )
+        
+        expected_size = self._expected_chunk_size(session, index)
+        chunk_path = self._chunk_path(session_id, index)
+        temp_path = f"{chunk_path}.{uuid.uuid4().hex}.part"
+        hasher = hashlib.sha256()
+        size = 0
+        
+        try:
+            async with aiofiles.open(temp_path, 'wb') as out:
+                async for data in body:
+                    size += len(data)
+                    if size > expected_size:
+                        raise UploadSessionError(
+                            f"Chunk {index} larger than expected {expected_size} bytes"
+                        )
+                    hasher.update(data)
+                    await out.write(data)
+            
+            if size != expected_size:
+                raise UploadSessionError(
+                    f"Chunk {index} is {size} bytes, expected {expected_size}"
+                )
+            if hasher.hexdigest() != checksum.strip().lower():
+                raise UploadSessionError(f"Checksum mismatch for chunk {index}", 422)
+            
+            await aiofiles.os.replace(temp_path, chunk_path)
+        except BaseException:
+            if await aiofiles.os.path.exists(temp_path):
+                await aiofiles.os.remove(temp_path)
+            raise
+        
+        return await self._describe(session)
+    
+    async def claim(self, session_id: str, staff_id: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Claim a complete session for finalizing
+        
+        Returns:
+            Session description
+        
+        Raises:
+            UploadSessionError: 409 if chunks are still missing or another
+                request already claimed the session
+        """
+        session = await self._load(session_id, staff_id)
+        described = await self._describe(session)
+        if described["missing_chunks"]:
+            missing = described["missing_chunks"]
+            raise UploadSessionError(
+                f"{len(missing)} chunk(s) still missing, first missing: {missing[0]}", 409
+            )
+        
+        session_dir = self._session_dir(session_id)
+        try:
+            await aiofiles.os.rename(
+                os.path.join(session_dir, self.MANIFEST),
+                os.path.join(session_dir, self.CLAIMED_MANIFEST)
+            )
+        except FileNotFoundError:
+            raise UploadSessionError("Upload session is already being finalized", 409)
+        
+        # Only the claimer writes from here on; restart the TTL for the finalize
+        session["updated_at"] = datetime.utcnow().isoformat()
+        await self._save(session, self.CLAIMED_MANIFEST)
+        return described
+    
+    async def release(self, session_id: str) -> None:
+        """Hand a claimed session back, e.g. after finalizing failed"""
+        session_dir = self._session_dir(session_id)
+        try:
+            await aiofiles.os.rename(
+                os.path.join(session_dir, self.CLAIMED_MANIFEST),
+                os.path.join(session_dir, self.MANIFEST)
+            )
+        except FileNotFoundError:
+            pass
+    
+    async def open_assembled(self, session_id: str, staff_id: Optional[int] = None) -> _AssembledFile:
+        """
+        Open the chunks of a complete session as one seekable file
+        
+        Nothing is copied; reads go straight to the chunk files.
+        
+        Raises:
+            UploadSessionError: 409 if chunks are still missing
+        """
+        session = await self._load(session_id, staff_id)
+        missing = (await self._describe(session))["missing_chunks"]
+        if missing:
+            raise UploadSessionError(
+                f"{len(missing)} chunk(s) still missing, first missing: {missing[0]}", 409
+            )
+        
+        return _AssembledFile(
+            [self._chunk_path(session_id, i) for i in range(session["total_chunks"])],
+            session["chunk_size"],
+            session["total_size"]
+        )
+    
+    async def stream_assembled(self, session_id: str, staff_id: Optional[int] = None) -> _AssembledStream:
+        """Like open_assembled, with an async read() for FileProcessor.ingest_stream"""
+        return _AssembledStream(await self.open_assembled(session_id, staff_id))
+    
+    async def discard_session(self, session_id: str, staff_id: Optional[int] = None) -> None:
+        """Delete a session and all of its chunks"""
+        await self._load(session_id, staff_id)
+        await asyncio.to_thread(shutil.rmtree, self._session_dir(session_id), True)
+        logger.info(f"Discarded upload session {session_id}")
+    
+    async def purge_expired(self) -> int:
+        """Remove sessions that have not received a chunk within the TTL"""
+        now = datetime.utcnow()
+        purged = 0
+        
+        for session_id in await aiofiles.os.listdir(self.root):
+            try:
+                expires_at = (await self.get_session(session_id))["expires_at"]
+            except (UploadSessionError, ValueError):
+                continue
+            # Claimed sessions are purged too, in case finalize died mid-way
+            if expires_at < now:
+                await self.discard_session(session_id)
+                purged += 1
+        
+        if purged:
+            logger.info(f"Purged {purged} expired upload session(s)")
+        return purged
+
+
+# Global instance
+upload_session_service = UploadSessionService()
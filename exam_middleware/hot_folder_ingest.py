@@ -0,0 +1,64 @@
+"""
+Hot folder ingest daemon
+
+Watches the scanner output directory and turns settled files into
+examination artifacts without going through the web workers.
+
+Usage:
+    python hot_folder_ingest.py [--dir ./hot_folder] [--settle 5] [--batch-size 100]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.core.config import settings
+from app.db.database import close_db
+from app.services.hot_folder_service import HotFolderIngestor
+
+
+async def main(watch_dir: str, settle_seconds: float, batch_size: int) -> None:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    ingestor = HotFolderIngestor(
+        watch_dir,
+        settle_seconds=settle_seconds,
+        batch_size=batch_size
+    )
+    
+    print("=" * 60)
+    print("Hot Folder Ingest")
+    print("=" * 60)
+    print(f"Watching:   {ingestor.watch_dir}")
+    print(f"Rejected:   {ingestor.rejected_dir}")
+    print(f"Settle:     {ingestor.settle_seconds}s, batch size {ingestor.batch_size}")
+    print()
+    
+    try:
+        await ingestor.run(stop_event)
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest scanner output from a hot folder")
+    parser.add_argument("--dir", default=settings.hot_folder_dir)
+    parser.add_argument("--settle", type=float, default=settings.hot_folder_settle_seconds)
+    parser.add_argument("--batch-size", type=int, default=settings.hot_folder_batch_size)
+    args = parser.parse_args()
+    
+    logging.basicConfig(
+        level=getattr(logging, settings.log_level.upper(), logging.INFO),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    
+    asyncio.run(main(args.dir, args.settle, args.batch_size))
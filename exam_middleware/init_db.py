@@ -11,7 +11,7 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from sqlalchemy import text
-from app.db.database import engine, Base, async_session_maker
+from app.db.database import engine, async_session_maker, init_db
 from app.db.models import (
     StaffUser,
     SubjectMapping,
@@ -23,8 +23,7 @@ from app.core.security import get_password_hash
 async def create_tables():
     """Create all database tables."""
     print("Creating database tables...")
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    await init_db()
     print("✓ Database tables created successfully!")
 
 
@@ -0,0 +1,153 @@
+"""
+Online migration of uploaded files into the sharded blob store.
+
+Older releases stored every scan flat in uploads/pending (and processed/
+failed). This script moves existing files to uploads/blobs/<aa>/<bb>/ and
+rewrites examination_artifacts.file_blob_path in batches. It is safe to run
+while the application is serving traffic:
+
+1. Each file is hard-linked (or copied) to its new location first
+2. file_blob_path is updated for the whole batch and committed
+3. Only then are the old paths removed
+
+Before moving any files it also creates ix_artifacts_file_hash, which
+create_all does not add to an existing examination_artifacts table. The
+index is built CONCURRENTLY so writes are not blocked.
+
+Re-running the script skips artifacts and indexes that are already migrated.
+
+Usage:
+    python migrate_storage_layout.py [--batch-size 200] [--dry-run]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import select, update, bindparam, text
+
+from app.db.database import async_session_maker, engine
+from app.db.models import ExaminationArtifact
+from app.services.file_processor import file_processor
+
+
+async def ensure_indexes(dry_run: bool = False) -> None:
+    """Create indexes that create_all skips on tables that already exist."""
+    statement = (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_artifacts_file_hash "
+        "ON examination_artifacts (file_hash)"
+    )
+    if dry_run:
+        print(f"Would run: {statement}")
+        return
+    
+    # CONCURRENTLY cannot run inside a transaction block
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text(statement))
+    print("✓ Index ix_artifacts_file_hash present")
+
+
+async def migrate_batch(db, rows, dry_run: bool = False) -> dict:
+    """Relocate one batch of artifacts and rewrite their paths."""
+    stats = {"migrated": 0, "skipped": 0, "missing": 0}
+    updates = []
+    
+    for artifact_id, old_path, file_hash in rows:
+        ext = os.path.splitext(old_path)[1].lower()
+        new_path = file_processor.blob_path(file_hash, ext)
+        
+        if os.path.abspath(old_path) == os.path.abspath(new_path):
+            stats["skipped"] += 1
+            continue
+        
+        if not os.path.exists(old_path) and not os.path.exists(new_path):
+            print(f"  ! Missing file for artifact {artifact_id}: {old_path}")
+            stats["missing"] += 1
+            continue
+        
+        if not dry_run and os.path.exists(old_path):
+            new_path = await file_processor.relocate_to_store(old_path, file_hash)
+        
+        updates.append({"artifact_id": artifact_id, "new_path": new_path, "old_path": old_path})
+        stats["migrated"] += 1
+    
+    if dry_run or not updates:
+        return stats
+    
+    # One executemany UPDATE for the whole batch
+    await db.execute(
+        update(ExaminationArtifact.__table__)
+        .where(ExaminationArtifact.__table__.c.id == bindparam("artifact_id"))
+        .values(file_blob_path=bindparam("new_path")),
+        updates
+    )
+    await db.commit()
+    
+    # Old paths are only removed once nothing references them any more
+    old_paths = [u["old_path"] for u in updates]
+    result = await db.execute(
+        select(ExaminationArtifact.file_blob_path)
+        .where(ExaminationArtifact.file_blob_path.in_(old_paths))
+    )
+    still_referenced = set(result.scalars().all())
+    for old_path in old_paths:
+        if old_path not in still_referenced:
+            await file_processor.delete_file(old_path)
+    
+    return stats
+
+
+async def migrate(batch_size: int, dry_run: bool) -> None:
+    """Walk all artifacts in id order, one batch per transaction."""
+    print("=" * 60)
+    print("Storage Layout Migration")
+    print("=" * 60)
+    print(f"Upload dir: {os.path.abspath(file_processor.upload_dir)}")
+    print(f"Batch size: {batch_size}{' (dry run)' if dry_run else ''}")
+    print()
+    
+    await ensure_indexes(dry_run=dry_run)
+    
+    totals = {"migrated": 0, "skipped": 0, "missing": 0}
+    last_id = 0
+    
+    while True:
+        async with async_session_maker() as db:
+            result = await db.execute(
+                select(
+                    ExaminationArtifact.id,
+                    ExaminationArtifact.file_blob_path,
+                    ExaminationArtifact.file_hash
+                )
+                .where(ExaminationArtifact.id > last_id)
+                .order_by(ExaminationArtifact.id)
+                .limit(batch_size)
+            )
+            rows = result.all()
+            if not rows:
+                break
+            
+            stats = await migrate_batch(db, rows, dry_run=dry_run)
+            last_id = rows[-1][0]
+        
+        for key, value in stats.items():
+            totals[key] += value
+        print(f"✓ Batch up to id {last_id}: {stats}")
+    
+    print()
+    print(f"Done: {totals['migrated']} migrated, {totals['skipped']} already in place, "
+          f"{totals['missing']} missing")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate uploads into the sharded blob store")
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    
+    asyncio.run(migrate(args.batch_size, args.dry_run))
@@ -0,0 +1,72 @@
+"""
+Submission worker
+
+Runs queued student submission jobs and retries the submission queue
+against Moodle outside the web workers. Start with
+SUBMISSION_WORKER_EMBEDDED=false on the API so jobs are only executed
+here; several worker processes can run side by side.
+
+Usage:
+    python submission_worker.py [--concurrency 8] [--poll 1.0]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.core.config import settings
+from app.db.database import close_db
+from app.services.moodle_client import close_shared_http_client
+from app.services.submission_job_service import SubmissionWorker
+from app.services.submission_queue_service import SubmissionQueueProcessor
+from app.services.bulk_submission_service import BulkSubmissionRunner
+
+
+async def main(concurrency: int, poll_seconds: float) -> None:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    worker = SubmissionWorker(concurrency=concurrency, poll_seconds=poll_seconds)
+    queue_processor = SubmissionQueueProcessor()
+    bulk_runner = BulkSubmissionRunner()
+    
+    print("=" * 60)
+    print("Submission Worker")
+    print("=" * 60)
+    print(f"Moodle:      {settings.moodle_base_url}")
+    print(f"Concurrency: {worker.concurrency}, poll every {worker.poll_seconds}s")
+    print(f"Retry queue: {'enabled' if queue_processor.admin_token else 'disabled (no MOODLE_ADMIN_TOKEN)'}")
+    print()
+    
+    try:
+        await queue_processor.start()
+        bulk_watch = asyncio.ensure_future(bulk_runner.watch(stop_event))
+        await worker.run(stop_event)
+        await bulk_watch
+    finally:
+        await bulk_runner.stop()
+        await queue_processor.stop()
+        await close_shared_http_client()
+        await close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run queued student submissions")
+    parser.add_argument("--concurrency", type=int, default=settings.submission_worker_concurrency)
+    parser.add_argument("--poll", type=float, default=settings.submission_worker_poll_seconds)
+    args = parser.parse_args()
+    
+    logging.basicConfig(
+        level=getattr(logging, settings.log_level.upper(), logging.INFO),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    
+    asyncio.run(main(args.concurrency, args.poll))
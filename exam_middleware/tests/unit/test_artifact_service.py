@@ -10,7 +10,9 @@ Tests the artifact management service including:
 
 import pytest
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 from unittest.mock import AsyncMock, MagicMock, patch
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.db.models import ExaminationArtifact, WorkflowStatus, SubjectMapping
@@ -96,6 +98,88 @@ class TestArtifactCreation:
         assert before <= artifact.uploaded_at <= after
 
 
+    @pytest.mark.asyncio
+    async def test_bulk_create_reuses_rows_inserted_concurrently(self):
+        """Test that a conflicting row is re-selected instead of failing the batch."""
+        raced = SimpleNamespace(transaction_id="txn-222222222222", parsed_reg_no="222222222222", parsed_subject_code="19AI405")
+        items = [
+            {
+                "raw_filename": f"{reg_no}_19AI405.pdf", "original_filename": f"{reg_no}_19AI405.pdf",
+                "file_blob_path": "blobs/ab", "file_hash": "ab",
+                "parsed_reg_no": reg_no, "parsed_subject_code": "19AI405"
+            }
+            for reg_no in ("111111111111", "222222222222")
+        ]
+        
+        async def execute(statement, params=None):
+            result = MagicMock()
+            if db.execute.await_count in (1, 2):
+                result.scalars.return_value.all.return_value = []
+            elif db.execute.await_count == 3:
+                # Only the first row made it in; the second hit uq_paper_submission
+                result.scalars.return_value.all.return_value = [SimpleNamespace(artifact_uuid=params[0]["artifact_uuid"])]
+            else:
+                result.scalars.return_value.all.return_value = [raced]
+            return result
+        
+        db = AsyncMock()
+        db.execute = AsyncMock(side_effect=execute)
+        
+        with patch("app.services.artifact_service.generate_transaction_id", side_effect=lambda r, s, p: f"txn-{r}"):
+            artifacts = await ArtifactService(db).create_artifacts_bulk(items)
+        
+        lock_statement = db.execute.call_args_list[1].args[0]
+        assert "pg_advisory_xact_lock_shared" in str(lock_statement)
+        insert_statement = db.execute.call_args_list[2].args[0]
+        assert "ON CONFLICT DO NOTHING" in str(insert_statement.compile(dialect=postgresql.dialect()))
+        assert db.execute.await_count == 4
+        assert artifacts[0][0] is not raced and artifacts[0][1] is False
+        assert artifacts[1] == (raced, True)
+    
+    @pytest.mark.asyncio
+    async def test_single_and_bulk_report_an_uploaded_paper_as_duplicate(self):
+        """Test that both paths keep the existing artifact for the same paper."""
+        existing = SimpleNamespace(transaction_id="txn-older-period", parsed_reg_no="111111111111", parsed_subject_code="19AI405")
+        item = {
+            "raw_filename": "111111111111_19AI405.pdf", "original_filename": "111111111111_19AI405.pdf",
+            "file_blob_path": "blobs/cd", "file_hash": "cd",
+            "parsed_reg_no": "111111111111", "parsed_subject_code": "19AI405"
+        }
+        db = AsyncMock()
+        result = MagicMock()
+        result.scalars.return_value.all.return_value = [existing]
+        db.execute = AsyncMock(return_value=result)
+        service = ArtifactService(db)
+        
+        single = await service.create_artifact(**item)
+        bulk = await service.create_artifacts_bulk([item])
+        
+        assert single == (existing, True)
+        assert bulk == [(existing, True)]
+        # Only the duplicate lookups ran, nothing was inserted
+        assert db.execute.await_count == 2
+
+
+class TestSubmissionClaim:
+    """Tests for claiming a paper before it is sent to Moodle."""
+    
+    @pytest.mark.asyncio
+    async def test_claim_is_a_conditional_update(self):
+        """Test that the claim only succeeds from a submittable or abandoned status."""
+        db = AsyncMock()
+        result = MagicMock()
+        result.scalar_one_or_none.return_value = None
+        db.execute = AsyncMock(return_value=result)
+        
+        claimed = await ArtifactService(db).claim_for_submission(SimpleNamespace(id=7))
+        
+        sql = str(db.execute.call_args.args[0].compile(dialect=postgresql.dialect()))
+        assert claimed is False
+        assert sql.startswith("UPDATE examination_artifacts SET workflow_status=")
+        assert "workflow_status IN" in sql and "submission_claimed_at <" in sql
+        assert "RETURNING examination_artifacts.id" in sql
+
+
 class TestArtifactRetrieval:
     """Tests for artifact retrieval methods."""
     
@@ -169,6 +253,34 @@ class TestArtifactRetrieval:
         
         assert len(result) == 1
         assert result[0].workflow_status == WorkflowStatus.SUBMITTED_TO_LMS
+    
+    @pytest.mark.asyncio
+    async def test_get_dashboard_artifacts_splits_by_status(self):
+        """Test that one query returns pending and submitted papers separately."""
+        pending = SimpleNamespace(parsed_reg_no="111111111111", workflow_status=WorkflowStatus.PENDING_REVIEW)
+        older = SimpleNamespace(
+            parsed_reg_no="111111111111", workflow_status=WorkflowStatus.COMPLETED,
+            submit_timestamp=datetime.utcnow() - timedelta(days=1)
+        )
+        newer = SimpleNamespace(
+            parsed_reg_no="111111111111", workflow_status=WorkflowStatus.SUBMITTED_TO_LMS,
+            submit_timestamp=datetime.utcnow()
+        )
+        # Matched through the Moodle username only, which counts for pending papers only
+        by_username = SimpleNamespace(
+            parsed_reg_no="222222222222", workflow_status=WorkflowStatus.SUBMITTED_TO_LMS,
+            submit_timestamp=datetime.utcnow()
+        )
+        db = AsyncMock()
+        result = MagicMock()
+        result.scalars.return_value.all.return_value = [pending, older, newer, by_username]
+        db.execute = AsyncMock(return_value=result)
+        
+        pending_list, submitted_list = await ArtifactService(db).get_dashboard_artifacts("111111111111")
+        
+        db.execute.assert_awaited_once()
+        assert pending_list == [pending]
+        assert submitted_list == [newer, older]
 
 
 class TestArtifactStatusUpdates:
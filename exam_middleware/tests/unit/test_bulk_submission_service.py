@@ -0,0 +1,257 @@
+"""
+Unit Tests for Bulk Submission
+
+Tests the staff bulk submission pipeline including:
+- Per-item checkpoints and run counters
+- Handing items back while Moodle is unavailable
+- Claiming papers so they are not submitted twice
+- Bounded concurrency and handing crashed items back
+- Throughput and ETA reporting
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest.mock import MagicMock, AsyncMock, patch
+
+from app.db.models import BulkSubmissionItem, BulkSubmissionRun, WorkflowStatus
+from app.services.bulk_submission_service import BulkSubmissionService, BulkSubmissionRunner
+from app.services.moodle_client import MoodleUnavailableError
+
+
+def _session_maker(db):
+    @asynccontextmanager
+    async def _maker():
+        yield db
+    return _maker
+
+
+def _item_db(item, artifact, active_job=None):
+    db = AsyncMock()
+    db.get = AsyncMock(side_effect=lambda model, key: item if model is BulkSubmissionItem else artifact)
+    
+    async def execute(statement):
+        result = MagicMock()
+        result.scalar_one_or_none.return_value = active_job
+        return result
+    
+    db.execute = AsyncMock(side_effect=execute)
+    return db
+
+
+def _counter_updates(db):
+    return [call.args[0] for call in db.execute.call_args_list if "bulk_submission_runs" in str(call.args[0])]
+
+
+def _item():
+    return SimpleNamespace(id=1, run_id=3, artifact_id=7, assignment_id=4, status="RUNNING", error=None, finished_at=None)
+
+
+def _artifact(status=WorkflowStatus.PENDING):
+    return SimpleNamespace(id=7, workflow_status=status)
+
+
+def _patched_service(execute, claimed=True):
+    patcher = patch("app.services.bulk_submission_service.SubmissionService")
+    service_cls = patcher.start()
+    service = service_cls.return_value
+    service._execute_submission = execute
+    service.artifact_service.claim_for_submission = AsyncMock(return_value=claimed)
+    service.artifact_service.release_submission_claim = AsyncMock()
+    service.artifact_service.mark_submitted = AsyncMock()
+    service.artifact_service.mark_failed = AsyncMock()
+    service.audit_service.log_action = AsyncMock()
+    return patcher, service
+
+
+class TestProcessItem:
+    """Tests for submitting and checkpointing one item."""
+    
+    async def test_success_is_checkpointed_with_counter(self):
+        """Test that a submitted item is marked DONE together with the run counter."""
+        item = _item()
+        db = _item_db(item, _artifact())
+        runner = BulkSubmissionRunner(admin_token="admin", session_maker=_session_maker(db))
+        patcher, service = _patched_service(AsyncMock(return_value={"submission_id": "9"}))
+        try:
+            status = await runner.process_item(item.id)
+        finally:
+            patcher.stop()
+        
+        assert status == "DONE"
+        assert service._execute_submission.call_args.kwargs["moodle_token"] == "admin"
+        service.artifact_service.mark_submitted.assert_awaited_once()
+        counter_update = db.execute.call_args.args[0]
+        assert "succeeded" in str(counter_update)
+        # The claim is committed before Moodle is called, then the checkpoint
+        assert db.commit.await_count == 2
+    
+    async def test_outage_hands_item_back(self):
+        """Test that Moodle being down leaves the item PENDING without failing the paper."""
+        item = _item()
+        db = _item_db(item, _artifact())
+        runner = BulkSubmissionRunner(admin_token="admin", session_maker=_session_maker(db))
+        patcher, service = _patched_service(AsyncMock(side_effect=MoodleUnavailableError("down")))
+        try:
+            status = await runner.process_item(item.id)
+        finally:
+            patcher.stop()
+        
+        assert status == "PENDING"
+        service.artifact_service.mark_failed.assert_not_awaited()
+        service.artifact_service.release_submission_claim.assert_awaited_once_with(7, WorkflowStatus.PENDING)
+        assert _counter_updates(db) == []
+    
+    async def test_already_submitted_paper_is_not_resubmitted(self):
+        """Test that resuming after a crash does not submit a paper twice."""
+        item = _item()
+        db = _item_db(item, _artifact(WorkflowStatus.SUBMITTED_TO_LMS))
+        runner = BulkSubmissionRunner(admin_token="admin", session_maker=_session_maker(db))
+        patcher, service = _patched_service(AsyncMock())
+        try:
+            status = await runner.process_item(item.id)
+        finally:
+            patcher.stop()
+        
+        assert status == "DONE"
+        service._execute_submission.assert_not_awaited()
+    
+    async def test_paper_claimed_elsewhere_is_handed_back(self):
+        """Test that a paper another submitter claimed is not submitted again."""
+        item = _item()
+        db = _item_db(item, _artifact(WorkflowStatus.SUBMITTING))
+        runner = BulkSubmissionRunner(admin_token="admin", session_maker=_session_maker(db))
+        patcher, service = _patched_service(AsyncMock(), claimed=False)
+        try:
+            status = await runner.process_item(item.id)
+        finally:
+            patcher.stop()
+        
+        assert status == "PENDING"
+        service._execute_submission.assert_not_awaited()
+        assert _counter_updates(db) == []
+        db.commit.assert_awaited_once()
+    
+    async def test_queued_paper_is_skipped(self):
+        """Test that a paper waiting in the retry queue is left to the queue."""
+        item = _item()
+        db = _item_db(item, _artifact(WorkflowStatus.QUEUED))
+        runner = BulkSubmissionRunner(admin_token="admin", session_maker=_session_maker(db))
+        patcher, service = _patched_service(AsyncMock())
+        try:
+            status = await runner.process_item(item.id)
+        finally:
+            patcher.stop()
+        
+        assert status == "SKIPPED"
+        service.artifact_service.claim_for_submission.assert_not_awaited()
+        assert "skipped" in str(_counter_updates(db)[0])
+    
+    async def test_paper_with_active_job_is_skipped(self):
+        """Test that a paper the student already queued is left to their job."""
+        item = _item()
+        db = _item_db(item, _artifact(), active_job=SimpleNamespace(id=5))
+        runner = BulkSubmissionRunner(admin_token="admin", session_maker=_session_maker(db))
+        patcher, service = _patched_service(AsyncMock())
+        try:
+            status = await runner.process_item(item.id)
+        finally:
+            patcher.stop()
+        
+        assert status == "SKIPPED"
+        service._execute_submission.assert_not_awaited()
+
+
+class TestRunner:
+    """Tests for the concurrent pipeline."""
+    
+    async def test_chunks_are_processed_with_bounded_concurrency(self):
+        """Test that claimed items run in parallel up to the limit until none are left."""
+        db = AsyncMock()
+        db.get = AsyncMock(return_value=SimpleNamespace(status="RUNNING"))
+        runner = BulkSubmissionRunner(admin_token="admin", concurrency=2, session_maker=_session_maker(db))
+        runner.claim_chunk = AsyncMock(side_effect=[[1, 2, 3, 4, 5], []])
+        runner._finish_if_done = AsyncMock()
+        running = []
+        peak = []
+        
+        async def process_item(item_id):
+            running.append(item_id)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(item_id)
+            return "DONE"
+        
+        runner.process_item = process_item
+        await runner.run(3)
+        
+        assert max(peak) == 2
+        assert runner.claim_chunk.await_count == 2
+        runner._finish_if_done.assert_awaited_once_with(3)
+    
+    async def test_cancelled_run_stops(self):
+        """Test that a cancelled run claims nothing more."""
+        db = AsyncMock()
+        db.get = AsyncMock(return_value=SimpleNamespace(status="CANCELLED"))
+        runner = BulkSubmissionRunner(admin_token="admin", session_maker=_session_maker(db))
+        runner.claim_chunk = AsyncMock()
+        
+        await runner.run(3)
+        
+        runner.claim_chunk.assert_not_awaited()
+    
+    async def test_crashed_item_is_handed_back(self):
+        """Test that an item whose processing raised goes back to PENDING."""
+        db = AsyncMock()
+        db.get = AsyncMock(return_value=SimpleNamespace(status="RUNNING"))
+        runner = BulkSubmissionRunner(admin_token="admin", session_maker=_session_maker(db))
+        runner.claim_chunk = AsyncMock(side_effect=[[1], []])
+        runner._finish_if_done = AsyncMock(return_value=True)
+        runner.process_item = AsyncMock(side_effect=RuntimeError("connection reset"))
+        
+        with patch("app.services.bulk_submission_service.settings.moodle_breaker_reset_seconds", 0):
+            await runner.run(3)
+        
+        release = db.execute.call_args_list[0].args[0]
+        assert "bulk_submission_items" in str(release)
+        assert release.compile().params["status"] == "PENDING"
+        db.commit.assert_awaited()
+    
+    async def test_waits_for_items_held_elsewhere(self):
+        """Test that the run keeps polling while other workers still hold items."""
+        db = AsyncMock()
+        db.get = AsyncMock(return_value=SimpleNamespace(status="RUNNING"))
+        runner = BulkSubmissionRunner(admin_token="admin", session_maker=_session_maker(db), poll_seconds=0)
+        runner.claim_chunk = AsyncMock(side_effect=[[], [], []])
+        runner._finish_if_done = AsyncMock(side_effect=[False, False, True])
+        
+        await runner.run(3)
+        
+        assert runner.claim_chunk.await_count == 3
+
+
+class TestProgress:
+    """Tests for the admin progress report."""
+    
+    async def test_throughput_and_eta(self):
+        """Test that throughput is items per minute and ETA covers the remaining items."""
+        run = BulkSubmissionRun(
+            id=3,
+            status="RUNNING",
+            total_items=160,
+            succeeded=40,
+            failed=10,
+            skipped=10,
+            started_at=datetime.now(timezone.utc) - timedelta(minutes=10)
+        )
+        db = AsyncMock()
+        counts = MagicMock()
+        counts.all.return_value = [("DONE", 40), ("FAILED", 10), ("SKIPPED", 10), ("PENDING", 95), ("RUNNING", 5)]
+        db.execute = AsyncMock(return_value=counts)
+        
+        progress = await BulkSubmissionService(db).get_progress(run)
+        
+        assert progress["remaining"] == 100
+        assert 4.9 < progress["throughput_per_minute"] <= 5.0
+        assert 1190 <= progress["eta_seconds"] <= 1230
@@ -0,0 +1,143 @@
+"""
+Unit Tests for Draft Pre-Staging
+
+Tests staging pending papers in the Moodle draft area including:
+- Deciding whether a staged draft can be reused
+- Skipping the upload step on submit
+- Upload and row update during staging
+"""
+
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import MagicMock, AsyncMock, patch
+
+from app.db.models import ExaminationArtifact, WorkflowStatus
+from app.services.draft_staging_service import DraftStager, staged_draft_item
+from app.services.moodle_client import MoodleClient, MoodleCallResult
+from app.services.submission_service import SubmissionService
+
+
+def _staged_artifact(item_id=555, staged_by=42, age_hours=0.5, status=WorkflowStatus.PENDING):
+    artifact = ExaminationArtifact(
+        id=7,
+        raw_filename="212222240047_19AI405.pdf",
+        original_filename="212222240047_19AI405.pdf",
+        file_blob_path="/tmp/paper.pdf",
+        file_hash="0" * 64,
+        workflow_status=status,
+        moodle_draft_item_id=item_id,
+        transaction_log=[{
+            "timestamp": (datetime.utcnow() - timedelta(hours=age_hours)).isoformat(),
+            "action": "draft_staged",
+            "details": {"item_id": item_id, "moodle_user_id": staged_by}
+        }]
+    )
+    return artifact
+
+
+def _session_maker(db):
+    @asynccontextmanager
+    async def _maker():
+        yield db
+    return _maker
+
+
+class TestStagedDraftItem:
+    """Tests for reusing a staged draft."""
+    
+    def test_fresh_draft_is_reused_by_its_owner_only(self):
+        """Test that only the user who staged a draft may submit it."""
+        artifact = _staged_artifact()
+        
+        assert staged_draft_item(artifact, 42) == 555
+        assert staged_draft_item(artifact, 99) is None
+        assert staged_draft_item(artifact, None) is None
+    
+    def test_old_or_replaced_drafts_are_not_reused(self):
+        """Test that expired drafts and drafts replaced by a later upload are ignored."""
+        assert staged_draft_item(_staged_artifact(age_hours=48), 42) is None
+        
+        artifact = _staged_artifact()
+        artifact.moodle_draft_item_id = 777  # a submit uploaded its own draft since
+        assert staged_draft_item(artifact, 42) is None
+
+
+class TestSubmitWithStagedDraft:
+    """Tests for the submit path."""
+    
+    async def test_upload_is_skipped(self):
+        """Test that a staged draft goes straight to save_submission."""
+        artifact = _staged_artifact()
+        service = SubmissionService(AsyncMock())
+        status = {"lastattempt": {
+            "cansubmit": False,
+            "submission": {"id": 3, "status": "submitted", "plugins": [{
+                "type": "file",
+                "fileareas": [{"area": "submission_files", "files": [{"filename": "paper.pdf"}]}]
+            }]}
+        }}
+        
+        with patch.object(MoodleClient, "upload_file", new=AsyncMock()) as upload, \
+             patch.object(MoodleClient, "call_batch", new=AsyncMock(return_value=[
+                 MoodleCallResult("mod_assign_get_submission_status", data=status),
+                 MoodleCallResult("mod_assign_save_submission", data=[]),
+                 MoodleCallResult("mod_assign_get_submission_status", data=status),
+             ])) as call_batch:
+            result = await service._execute_submission(
+                artifact, assignment_id=4, moodle_token="t", lock_submission=True, draft_owner_id=42
+            )
+        
+        upload.assert_not_awaited()
+        save_call = call_batch.call_args.args[0][1]
+        assert save_call.arguments["plugindata"]["files_filemanager"] == 555
+        assert "upload_skipped_staged" in result["steps_completed"]
+        assert result["submission_id"] == "3"
+
+
+class TestDraftStager:
+    """Tests for the background staging task."""
+    
+    async def test_stage_uploads_and_records_item(self):
+        """Test that staging uploads the file and marks the draft as staged."""
+        artifact = ExaminationArtifact(
+            id=7,
+            original_filename="paper.pdf",
+            file_blob_path="/tmp/paper.pdf",
+            workflow_status=WorkflowStatus.PENDING,
+            transaction_log=[]
+        )
+        db = AsyncMock()
+        db.get = AsyncMock(return_value=artifact)
+        locked = MagicMock()
+        locked.scalar_one_or_none.return_value = artifact
+        db.execute = AsyncMock(return_value=locked)
+        stager = DraftStager(concurrency=1, session_maker=_session_maker(db))
+        
+        with patch.object(MoodleClient, "upload_file", new=AsyncMock(return_value={"itemid": 555})), \
+             patch("app.services.draft_staging_service.flag_modified"):
+            item_id = await stager.stage(7, "t", 42)
+        
+        assert item_id == 555
+        assert staged_draft_item(artifact, 42) == 555
+        db.commit.assert_awaited()
+    
+    async def test_submit_in_progress_wins(self):
+        """Test that a draft is not recorded if the paper started submitting meanwhile."""
+        artifact = SimpleNamespace(
+            id=7, original_filename="paper.pdf", file_blob_path="/tmp/paper.pdf",
+            workflow_status=WorkflowStatus.PENDING, moodle_draft_item_id=None, transaction_log=[]
+        )
+        submitting = SimpleNamespace(**{**vars(artifact), "workflow_status": WorkflowStatus.UPLOADING})
+        db = AsyncMock()
+        db.get = AsyncMock(return_value=artifact)
+        locked = MagicMock()
+        locked.scalar_one_or_none.return_value = submitting
+        db.execute = AsyncMock(return_value=locked)
+        stager = DraftStager(concurrency=1, session_maker=_session_maker(db))
+        
+        with patch.object(MoodleClient, "upload_file", new=AsyncMock(return_value={"itemid": 555})):
+            assert await stager.stage(7, "t", 42) is None
+        
+        assert submitting.moodle_draft_item_id is None
+        db.commit.assert_not_awaited()
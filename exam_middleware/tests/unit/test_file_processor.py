@@ -13,9 +13,12 @@ from unittest.mock import MagicMock, patch, AsyncMock
 from io import BytesIO
 import tempfile
 import os
+import tarfile
+import zipfile
 
 # Import the module under test
 from app.services.file_processor import FileProcessor
+from app.core.security import compute_file_hash
 
 
 class TestFilenameParsing:
@@ -349,3 +352,271 @@ class TestHashGeneration:
         hashes = [processor.generate_hash(content) for _ in range(5)]
         
         assert all(h == hashes[0] for h in hashes)
+
+
+class _ChunkedStream:
+    """Minimal async stream mimicking UploadFile.read(size)."""
+    
+    def __init__(self, content: bytes):
+        self._buffer = BytesIO(content)
+        self.read_sizes = []
+    
+    async def read(self, size: int = -1) -> bytes:
+        self.read_sizes.append(size)
+        return self._buffer.read(size)
+
+
+class TestStreamingIngest:
+    """Tests for chunked upload ingestion."""
+    
+    async def test_ingest_stores_file_and_hashes_incrementally(self, temp_upload_dir):
+        """Test that a streamed upload lands in the blob store with the right hash."""
+        import hashlib
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        content = b"%PDF-1.4\n" + b"x" * 5000
+        stream = _ChunkedStream(content)
+        
+        is_valid, message, metadata = await processor.ingest_stream(
+            stream, "123456789012_19AI405.pdf", chunk_size=1024
+        )
+        
+        assert is_valid, message
+        assert metadata["hash"] == hashlib.sha256(content).hexdigest()
+        assert metadata["size_bytes"] == len(content)
+        assert metadata["mime_type"] == "application/pdf"
+        assert metadata["file_path"] == processor.blob_path(metadata["hash"], ".pdf")
+        assert metadata["deduplicated"] is False
+        with open(metadata["file_path"], "rb") as f:
+            assert f.read() == content
+        # Never read more than one chunk at a time
+        assert all(size == 1024 for size in stream.read_sizes)
+        assert os.listdir(os.path.join(temp_upload_dir, "temp")) == []
+    
+    async def test_ingest_rejects_bad_magic_without_leaving_files(self, temp_upload_dir):
+        """Test that content sniffing on the first chunk rejects disguised files."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        stream = _ChunkedStream(b"MZ\x90\x00" + b"\x00" * 100)
+        
+        is_valid, message, _ = await processor.ingest_stream(
+            stream, "123456789012_19AI405.pdf"
+        )
+        
+        assert not is_valid
+        assert message == "Could not determine file type"
+        assert os.listdir(os.path.join(temp_upload_dir, "blobs")) == []
+        assert os.listdir(os.path.join(temp_upload_dir, "temp")) == []
+    
+    async def test_ingest_enforces_size_limit_early(self, temp_upload_dir):
+        """Test that oversize uploads are cut off once the limit is crossed."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        stream = _ChunkedStream(b"%PDF" + b"x" * 4096)
+        
+        with patch("app.services.file_processor.settings") as mock_settings:
+            mock_settings.allowed_extensions_list = [".pdf"]
+            mock_settings.max_file_size_bytes = 2048
+            mock_settings.max_file_size_mb = 0
+            is_valid, message, _ = await processor.ingest_stream(
+                stream, "123456789012_19AI405.pdf", chunk_size=1024
+            )
+        
+        assert not is_valid
+        assert "too large" in message
+        assert len(stream.read_sizes) == 3
+        assert os.listdir(os.path.join(temp_upload_dir, "temp")) == []
+    
+    async def test_ingest_rejects_bad_filename_before_reading(self, temp_upload_dir):
+        """Test that unparseable filenames are rejected without consuming the stream."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        stream = _ChunkedStream(b"%PDF-1.4")
+        
+        is_valid, _, _ = await processor.ingest_stream(stream, "random.pdf")
+        
+        assert not is_valid
+        assert stream.read_sizes == []
+    
+    async def test_ingest_many_bounds_concurrency_and_keeps_order(self, temp_upload_dir):
+        """Test that bulk ingestion respects the semaphore and input ordering."""
+        import asyncio
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        active = 0
+        peak = 0
+        
+        class _SlowStream(_ChunkedStream):
+            async def read(self, size: int = -1) -> bytes:
+                nonlocal active, peak
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+                return await super().read(size)
+        
+        uploads = [
+            (_SlowStream(b"%PDF-1.4 paper " + bytes([48 + i])), f"12345678901{i}_19AI405.pdf")
+            for i in range(6)
+        ]
+        uploads.insert(3, (_SlowStream(b"not a pdf"), "123456789012_19AI405.pdf"))
+        
+        results = await processor.ingest_many(uploads, concurrency=2)
+        
+        assert peak <= 2
+        assert [ok for ok, _, _ in results] == [True, True, True, False, True, True, True]
+        assert results[0][2]["parsed_register_no"] == "123456789010"
+        assert results[6][2]["parsed_register_no"] == "123456789015"
+
+
+class TestContentAddressedStore:
+    """Tests for hash-keyed blob storage and deduplication."""
+    
+    def test_blob_path_fans_out_by_hash(self, temp_upload_dir):
+        """Test that blobs are sharded by the leading hash characters."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        file_hash = "ab" + "cd" + "0" * 60
+        
+        path = processor.blob_path(file_hash, ".PDF")
+        
+        assert path == os.path.join(temp_upload_dir, "blobs", "ab", "cd", f"{file_hash}.pdf")
+    
+    async def test_identical_uploads_share_one_blob(self, temp_upload_dir):
+        """Test that re-uploading the same scan reuses the stored blob."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        content = b"%PDF-1.4 same scan"
+        
+        _, _, first = await processor.ingest_stream(
+            _ChunkedStream(content), "123456789012_19AI405.pdf"
+        )
+        _, _, second = await processor.ingest_stream(
+            _ChunkedStream(content), "123456789012_19AI405.pdf"
+        )
+        
+        assert first["file_path"] == second["file_path"]
+        assert first["deduplicated"] is False
+        assert second["deduplicated"] is True
+        assert os.listdir(os.path.join(temp_upload_dir, "temp")) == []
+    
+    async def test_save_file_skips_write_for_existing_blob(self, temp_upload_dir):
+        """Test the save_file fast path when the blob already exists."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        content = b"%PDF-1.4 stored once"
+        
+        path, file_hash = await processor.save_file(content, "123456789012_19AI405.pdf")
+        
+        with patch("app.services.file_processor.aiofiles.open") as mock_open:
+            again, again_hash = await processor.save_file(content, "123456789012_19AI405.pdf")
+        
+        assert (again, again_hash) == (path, file_hash)
+        mock_open.assert_not_called()
+    
+    async def test_save_file_subfolder_bypasses_blob_store(self, temp_upload_dir):
+        """Test that an explicit subfolder bypasses the blob store."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        
+        path, _ = await processor.save_file(b"%PDF-1.4", "a.pdf", subfolder="failed")
+        name = os.path.basename(path)
+        
+        assert path == os.path.join(temp_upload_dir, "failed", name[:2], name[2:4], name)
+
+
+class TestShardedLayout:
+    """Tests for the sharded uploads tree and the layout migration helpers."""
+    
+    def test_shard_path_uses_two_levels(self, temp_upload_dir):
+        """Test that files fan out by their first four characters."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        
+        path = processor.shard_path("processed", "3fa2e1.pdf")
+        
+        assert path == os.path.join(temp_upload_dir, "processed", "3f", "a2", "3fa2e1.pdf")
+    
+    async def test_move_file_keeps_sharding(self, temp_upload_dir):
+        """Test that moving between subfolders lands in the sharded layout."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        path, _ = await processor.save_file(b"%PDF-1.4", "a.pdf", subfolder="pending")
+        
+        moved = await processor.move_file(path, "processed")
+        
+        assert moved == processor.shard_path("processed", os.path.basename(path))
+        assert os.path.exists(moved)
+        assert not os.path.exists(path)
+    
+    async def test_relocate_to_store_keeps_source_until_caller_deletes(self, temp_upload_dir):
+        """Test that legacy flat files are linked into the blob store."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        content = b"%PDF-1.4 legacy scan"
+        legacy = os.path.join(temp_upload_dir, "pending", "legacy.pdf")
+        with open(legacy, "wb") as f:
+            f.write(content)
+        file_hash = compute_file_hash(content)
+        
+        new_path = await processor.relocate_to_store(legacy, file_hash)
+        
+        assert new_path == processor.blob_path(file_hash, ".pdf")
+        assert os.path.exists(legacy)
+        with open(new_path, "rb") as f:
+            assert f.read() == content
+        assert os.listdir(os.path.join(temp_upload_dir, "temp")) == []
+        
+        # Running again is a no-op
+        assert await processor.relocate_to_store(legacy, file_hash) == new_path
+
+
+class TestArchiveIngest:
+    """Tests for streaming ZIP/TAR archives into the blob store."""
+    
+    @staticmethod
+    def _zip(members):
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for name, content in members:
+                archive.writestr(name, content)
+        buffer.seek(0)
+        return buffer
+    
+    @staticmethod
+    def _tar_gz(members):
+        buffer = BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+            for name, content in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, BytesIO(content))
+        buffer.seek(0)
+        return buffer
+    
+    async def test_zip_members_are_streamed_in_batches(self, temp_upload_dir):
+        """Test that ZIP members are ingested and yielded in batches."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        archive = self._zip([
+            (f"hall-a/12345678901{i}_19AI405.pdf", b"%PDF-1.4 scan " + bytes([i]))
+            for i in range(5)
+        ] + [("__MACOSX/._123456789010_19AI405.pdf", b"junk")])
+        
+        batches = [batch async for batch in processor.ingest_archive(archive, batch_size=2)]
+        
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        results = [entry for batch in batches for entry in batch]
+        assert [filename for filename, _, _, _ in results][0] == "123456789010_19AI405.pdf"
+        assert all(is_valid for _, is_valid, _, _ in results)
+        assert all(os.path.exists(metadata["file_path"]) for _, _, _, metadata in results)
+    
+    async def test_tar_members_report_invalid_entries(self, temp_upload_dir):
+        """Test that a bad member fails on its own without stopping the archive."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        archive = self._tar_gz([
+            ("123456789012_19AI405.pdf", b"%PDF-1.4 good"),
+            ("notes.txt", b"not a scan"),
+        ])
+        
+        results = [entry async for batch in processor.ingest_archive(archive) for entry in batch]
+        
+        assert [(filename, is_valid) for filename, is_valid, _, _ in results] == [
+            ("123456789012_19AI405.pdf", True),
+            ("notes.txt", False),
+        ]
+    
+    async def test_non_archive_is_rejected(self, temp_upload_dir):
+        """Test that arbitrary bytes raise ValueError."""
+        processor = FileProcessor(upload_dir=temp_upload_dir)
+        
+        with pytest.raises(ValueError):
+            async for _ in processor.ingest_archive(BytesIO(b"%PDF-1.4 not an archive")):
+                pass
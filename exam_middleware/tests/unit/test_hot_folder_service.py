@@ -0,0 +1,204 @@
+"""
+Unit Tests for Hot Folder Ingest Service
+
+Tests the hot folder daemon including:
+- Debouncing of partially written files
+- Validation and rejection
+- Batched artifact creation and cleanup
+"""
+
+import pytest
+import os
+import time
+from contextlib import asynccontextmanager
+from unittest.mock import MagicMock, patch, AsyncMock
+
+from app.services.file_processor import FileProcessor
+from app.services.hot_folder_service import HotFolderIngestor
+
+
+def _write(path: str, content: bytes, age: float = 60) -> None:
+    with open(path, "wb") as f:
+        f.write(content)
+    past = time.time() - age
+    os.utime(path, (past, past))
+
+
+def _session_maker(db):
+    @asynccontextmanager
+    async def _maker():
+        yield db
+    return _maker
+
+
+@pytest.fixture
+def hot_folder(temp_upload_dir):
+    """Watch folder and upload store in one temp directory."""
+    watch_dir = os.path.join(temp_upload_dir, "hot")
+    os.makedirs(watch_dir)
+    processor = FileProcessor(upload_dir=os.path.join(temp_upload_dir, "uploads"))
+    return watch_dir, processor
+
+
+class TestSettling:
+    """Tests for debouncing files that are still being written."""
+    
+    def test_file_is_ready_only_after_it_stops_changing(self, hot_folder):
+        """Test that a growing file is held back until it settles."""
+        watch_dir, processor = hot_folder
+        ingestor = HotFolderIngestor(watch_dir, settle_seconds=5, processor=processor)
+        path = os.path.join(watch_dir, "123456789012_19AI405.pdf")
+        
+        _write(path, b"%PDF-1.4 part", age=0)
+        ingestor.track(path)
+        assert ingestor.settled() == []
+        
+        _write(path, b"%PDF-1.4 part and the rest", age=60)
+        assert ingestor.settled() == []  # size changed since last seen
+        assert ingestor.settled() == [path]
+    
+    def test_temp_and_rejected_files_are_ignored(self, hot_folder):
+        """Test that scanner temp files and the rejected folder are skipped."""
+        watch_dir, processor = hot_folder
+        ingestor = HotFolderIngestor(watch_dir, settle_seconds=0, processor=processor)
+        _write(os.path.join(watch_dir, "scan.pdf.tmp"), b"%PDF")
+        _write(os.path.join(watch_dir, ".hidden.pdf"), b"%PDF")
+        _write(os.path.join(ingestor.rejected_dir, "old.pdf"), b"%PDF")
+        _write(os.path.join(watch_dir, "123456789012_19AI405.pdf"), b"%PDF")
+        
+        ingestor.scan_existing()
+        
+        assert ingestor.settled() == [os.path.join(watch_dir, "123456789012_19AI405.pdf")]
+
+
+class TestBatchIngest:
+    """Tests for storing settled files and creating their artifacts."""
+    
+    async def test_batch_links_into_store_and_rejects_invalid(self, hot_folder):
+        """Test that valid scans become artifacts and invalid ones are moved aside."""
+        watch_dir, processor = hot_folder
+        db = AsyncMock()
+        good = os.path.join(watch_dir, "123456789012_19AI405.pdf")
+        bad = os.path.join(watch_dir, "holiday.pdf")
+        _write(good, b"%PDF-1.4 scan")
+        _write(bad, b"%PDF-1.4 unnamed")
+        ingestor = HotFolderIngestor(
+            watch_dir, settle_seconds=0, processor=processor, session_maker=_session_maker(db)
+        )
+        
+        with patch("app.services.hot_folder_service.ArtifactService") as service_cls, \
+             patch("app.services.hot_folder_service.AuditService") as audit_cls:
+            service = service_cls.return_value
+            service.create_artifacts_bulk = AsyncMock(return_value=[(MagicMock(), False)])
+            service.lock_blobs = AsyncMock()
+            service.get_blob_reference_counts = AsyncMock(side_effect=lambda hashes: {h: 1 for h in hashes})
+            audit_cls.return_value.log_action = AsyncMock()
+            
+            stats = await ingestor.ingest_batch([good, bad])
+        
+        assert stats == {"ingested": 1, "rejected": 1, "failed": 0}
+        items = service.create_artifacts_bulk.call_args[0][0]
+        assert items[0]["parsed_reg_no"] == "123456789012"
+        assert os.path.exists(items[0]["file_blob_path"])
+        assert not os.path.exists(good)
+        rejected = os.listdir(ingestor.rejected_dir)
+        assert len(rejected) == 1 and rejected[0].startswith("holiday_") and rejected[0].endswith(".pdf")
+        db.commit.assert_awaited_once()
+    
+    async def test_rejects_with_the_same_name_are_kept(self, hot_folder):
+        """Test that a second reject with the same name does not overwrite the first."""
+        watch_dir, processor = hot_folder
+        ingestor = HotFolderIngestor(watch_dir, settle_seconds=0, processor=processor)
+        bad = os.path.join(watch_dir, "holiday.pdf")
+        
+        for content in (b"first", b"second"):
+            _write(bad, content)
+            await ingestor._reject(bad, "Invalid filename")
+        
+        contents = set()
+        for name in os.listdir(ingestor.rejected_dir):
+            with open(os.path.join(ingestor.rejected_dir, name), "rb") as f:
+                contents.add(f.read())
+        assert contents == {b"first", b"second"}
+    
+    async def test_failed_transaction_keeps_originals(self, hot_folder):
+        """Test that a database error leaves files in the hot folder for retry."""
+        watch_dir, processor = hot_folder
+        db = AsyncMock()
+        good = os.path.join(watch_dir, "123456789012_19AI405.pdf")
+        _write(good, b"%PDF-1.4 scan")
+        ingestor = HotFolderIngestor(
+            watch_dir, settle_seconds=0, processor=processor, session_maker=_session_maker(db)
+        )
+        
+        with patch("app.services.hot_folder_service.ArtifactService") as service_cls:
+            service = service_cls.return_value
+            service.create_artifacts_bulk = AsyncMock(side_effect=RuntimeError("db down"))
+            service.lock_blobs = AsyncMock()
+            service.get_blob_reference_counts = AsyncMock(return_value={})
+            
+            stats = await ingestor.ingest_batch([good])
+        
+        assert stats["failed"] == 1
+        assert os.path.exists(good)
+        assert not any(files for _, _, files in os.walk(os.path.join(processor.upload_dir, "blobs")))
+        db.rollback.assert_awaited_once()
+    
+    async def test_unreadable_file_is_left_for_next_tick(self, hot_folder):
+        """Test that an OS error on one file does not stop the rest of the batch."""
+        watch_dir, processor = hot_folder
+        db = AsyncMock()
+        locked = os.path.join(watch_dir, "123456789012_19AI405.pdf")
+        good = os.path.join(watch_dir, "123456789013_19AI405.pdf")
+        _write(locked, b"%PDF-1.4 still copying")
+        _write(good, b"%PDF-1.4 scan")
+        ingestor = HotFolderIngestor(
+            watch_dir, settle_seconds=0, processor=processor, session_maker=_session_maker(db)
+        )
+        ingestor.scan_existing()
+        relocate = processor.relocate_to_store
+        
+        async def relocate_to_store(path, file_hash):
+            if path == locked:
+                raise PermissionError(13, "Permission denied", path)
+            return await relocate(path, file_hash)
+        
+        with patch.object(processor, "relocate_to_store", side_effect=relocate_to_store), \
+             patch("app.services.hot_folder_service.ArtifactService") as service_cls, \
+             patch("app.services.hot_folder_service.AuditService") as audit_cls:
+            service = service_cls.return_value
+            service.create_artifacts_bulk = AsyncMock(return_value=[(MagicMock(), False)])
+            service.lock_blobs = AsyncMock()
+            service.get_blob_reference_counts = AsyncMock(side_effect=lambda hashes: {h: 1 for h in hashes})
+            audit_cls.return_value.log_action = AsyncMock()
+            
+            stats = await ingestor.ingest_batch([locked, good])
+        
+        assert stats == {"ingested": 1, "rejected": 0, "failed": 1}
+        assert os.path.exists(locked)
+        assert not os.path.exists(good)
+        assert ingestor.settled() == [locked]
+    
+    async def test_failed_transaction_keeps_blobs_it_did_not_write(self, hot_folder):
+        """Test that a blob another artifact may be about to use survives a rollback."""
+        watch_dir, processor = hot_folder
+        db = AsyncMock()
+        good = os.path.join(watch_dir, "123456789012_19AI405.pdf")
+        _write(good, b"%PDF-1.4 scan")
+        _, _, metadata = await processor.inspect_file(good)
+        existing = await processor.relocate_to_store(good, metadata["hash"])
+        ingestor = HotFolderIngestor(
+            watch_dir, settle_seconds=0, processor=processor, session_maker=_session_maker(db)
+        )
+        
+        with patch("app.services.hot_folder_service.ArtifactService") as service_cls:
+            service = service_cls.return_value
+            service.create_artifacts_bulk = AsyncMock(side_effect=RuntimeError("db down"))
+            service.lock_blobs = AsyncMock()
+            service.get_blob_reference_counts = AsyncMock(return_value={})
+            
+            stats = await ingestor.ingest_batch([good])
+        
+        assert stats["failed"] == 1
+        assert os.path.exists(existing)
+        service.lock_blobs.assert_awaited_once_with([], exclusive=True)
@@ -0,0 +1,283 @@
+"""
+Unit Tests for Moodle Client
+
+Tests the Moodle web service client including:
+- Streamed draft-area uploads
+- Shared connection pool
+- Batched web service calls
+- Coalescing of identical reads
+"""
+
+import pytest
+import os
+import asyncio
+import json
+from email import message_from_bytes
+
+import httpx
+
+from app.services.moodle_client import (
+    MoodleClient,
+    MoodleCall,
+    MoodleAPIError,
+    get_shared_http_client,
+    close_shared_http_client,
+    _batch_support,
+)
+
+
+def _mock_client(handler) -> MoodleClient:
+    """MoodleClient whose HTTP traffic goes to an in-process handler."""
+    return MoodleClient(
+        base_url="http://moodle.test",
+        token="ws-token",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+
+
+class TestStreamedUpload:
+    """Tests for uploading scans without buffering them in memory."""
+    
+    async def test_upload_streams_valid_multipart(self, temp_upload_dir):
+        """Test that the streamed body is a well-formed multipart request."""
+        path = os.path.join(temp_upload_dir, "scan.pdf")
+        content = b"%PDF-1.4 " + os.urandom(200_000)
+        with open(path, "wb") as f:
+            f.write(content)
+        seen = {}
+        
+        async def handler(request: httpx.Request) -> httpx.Response:
+            body = await request.aread()
+            seen["length"] = int(request.headers["content-length"])
+            seen["chunked"] = "transfer-encoding" in request.headers
+            message = message_from_bytes(
+                f"Content-Type: {request.headers['content-type']}\r\n\r\n".encode() + body
+            )
+            seen["form"] = {
+                part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                for part in message.get_payload()
+            }
+            seen["body_size"] = len(body)
+            return httpx.Response(200, json=[{"itemid": 42, "filename": "x.pdf"}])
+        
+        client = _mock_client(handler)
+        result = await client.upload_file(path, filename="123456789012_19AI405.pdf")
+        await client.close()
+        
+        assert result["itemid"] == 42
+        assert seen["length"] == seen["body_size"]
+        assert not seen["chunked"]
+        assert seen["form"]["token"] == b"ws-token"
+        assert seen["form"]["file_1"] == content
+    
+    async def test_upload_body_is_read_in_chunks(self, temp_upload_dir):
+        """Test that the file is never handed to httpx as a single buffer."""
+        path = os.path.join(temp_upload_dir, "scan.pdf")
+        with open(path, "wb") as f:
+            f.write(b"%PDF" * 1000)
+        
+        body, headers = MoodleClient._multipart_file_body(
+            {"token": "t"}, "file_1", "a.pdf", "application/pdf", path, 4000
+        )
+        parts = [part async for part in body]
+        
+        assert len(parts) >= 3  # head, file chunk(s), tail
+        assert int(headers["Content-Length"]) == sum(len(p) for p in parts)
+    
+    async def test_missing_file_raises(self, temp_upload_dir):
+        """Test that a missing file is reported before any request is made."""
+        client = _mock_client(lambda request: httpx.Response(500))
+        
+        with pytest.raises(MoodleAPIError):
+            await client.upload_file(os.path.join(temp_upload_dir, "missing.pdf"))
+        await client.close()
+
+
+class TestSharedPool:
+    """Tests for the process-wide Moodle connection pool."""
+    
+    async def test_clients_share_one_pool(self):
+        """Test that separate MoodleClient instances reuse the same transport."""
+        first = MoodleClient(token="student-a")
+        second = MoodleClient(token="student-b")
+        
+        pool = await first._get_client()
+        
+        assert await second._get_client() is pool
+        assert "wstoken" not in pool.headers and "token" not in pool.headers
+        
+        # Closing a client must not tear down the pool for everyone else
+        await first.close()
+        assert not pool.is_closed
+        
+        await close_shared_http_client()
+        assert pool.is_closed
+        assert get_shared_http_client() is not pool
+        await close_shared_http_client()
+
+
+@pytest.fixture
+async def batching_state():
+    """Reset the learned batch support flags around each test."""
+    await _batch_support.clear()
+    yield _batch_support
+    await _batch_support.clear()
+
+
+class TestBatchedCalls:
+    """Tests for packing several WS functions into one request."""
+    
+    async def test_batch_is_one_request_split_per_call(self, batching_state):
+        """Test that results and errors are mapped back to their calls."""
+        requests = []
+        
+        async def handler(request: httpx.Request) -> httpx.Response:
+            form = dict(httpx.QueryParams((await request.aread()).decode()))
+            requests.append(form)
+            return httpx.Response(200, json={"responses": [
+                {"error": False, "data": json.dumps({"lastattempt": {}})},
+                {"error": True, "exception": json.dumps({
+                    "exception": "moodle_exception", "errorcode": "nopermission", "message": "No permission"
+                })},
+            ]})
+        
+        client = _mock_client(handler)
+        results = await client.call_batch([
+            MoodleCall("mod_assign_get_submission_status", {"assignid": 7}),
+            MoodleCall("mod_assign_save_submission", {"assignmentid": 7, "plugindata": {"files_filemanager": 9}}),
+            MoodleCall("mod_assign_get_submission_status", {"assignid": 7}),
+        ])
+        await client.close()
+        
+        assert len(requests) == 1
+        form = requests[0]
+        assert form["wsfunction"] == "tool_mobile_call_external_functions"
+        assert form["requests[1][function]"] == "mod_assign_save_submission"
+        assert json.loads(form["requests[1][arguments]"])["plugindata"] == {"files_filemanager": 9}
+        
+        assert results[0].unwrap() == {"lastattempt": {}}
+        assert results[1].error.error.errorcode == "nopermission"
+        assert not results[2].ok  # Moodle stops at the first error
+        with pytest.raises(MoodleAPIError):
+            results[2].unwrap()
+    
+    @pytest.mark.parametrize("refusal", [
+        {
+            "exception": "webservice_access_exception",
+            "errorcode": "accessexception",
+            "message": "Access control exception",
+            "debuginfo": "Access to the function tool_mobile_call_external_functions() is not allowed."
+        },
+        {
+            "exception": "dml_missing_record_exception",
+            "errorcode": "invalidrecord",
+            "message": "Can't find data record in database table external_functions."
+        },
+    ])
+    async def test_falls_back_when_batch_function_is_not_allowed(self, batching_state, refusal):
+        """Test that calls are made one by one if the service lacks the batch function."""
+        functions = []
+        
+        async def handler(request: httpx.Request) -> httpx.Response:
+            form = dict(httpx.QueryParams((await request.aread()).decode()))
+            functions.append(form["wsfunction"])
+            if form["wsfunction"] == "tool_mobile_call_external_functions":
+                return httpx.Response(200, json=refusal)
+            if form["wsfunction"] == "mod_assign_save_submission":
+                assert form["plugindata[files_filemanager]"] == "9"
+                return httpx.Response(200, json=[])
+            return httpx.Response(200, json={"userid": 5})
+        
+        client = _mock_client(handler)
+        calls = [
+            MoodleCall("core_webservice_get_site_info"),
+            MoodleCall("mod_assign_save_submission", {"assignmentid": 7, "plugindata": {"files_filemanager": 9}}),
+        ]
+        results = await client.call_batch(calls)
+        await client.call_batch(calls)
+        await client.close()
+        
+        assert [r.data for r in results] == [{"userid": 5}, []]
+        # The refusal is remembered, so the second batch goes straight to single calls
+        assert functions.count("tool_mobile_call_external_functions") == 1
+        assert len(functions) == 5
+    
+    async def test_refusal_is_remembered_per_token(self, batching_state):
+        """Test that one token lacking the batch function does not disable it for others."""
+        async def handler(request: httpx.Request) -> httpx.Response:
+            form = dict(httpx.QueryParams((await request.aread()).decode()))
+            if form["wstoken"] == "limited-token" and form["wsfunction"] == "tool_mobile_call_external_functions":
+                return httpx.Response(200, json={
+                    "exception": "webservice_access_exception", "errorcode": "accessexception", "message": "Access control exception"
+                })
+            if form["wsfunction"] == "tool_mobile_call_external_functions":
+                return httpx.Response(200, json={"responses": [{"error": False, "data": "1"}, {"error": False, "data": "2"}]})
+            return httpx.Response(200, json=0)
+        
+        client = _mock_client(handler)
+        await client.call_batch([MoodleCall("a"), MoodleCall("b")], token="limited-token")
+        results = await client.call_batch([MoodleCall("a"), MoodleCall("b")])
+        await client.close()
+        
+        assert [r.data for r in results] == [1, 2]
+        assert await batching_state.get(client._batch_support_key("limited-token")) is False
+        assert await batching_state.get(client._batch_support_key("ws-token")) is True
+    
+    async def test_other_batch_errors_are_raised(self, batching_state):
+        """Test that an invalid token is not mistaken for missing batch support."""
+        client = _mock_client(lambda request: httpx.Response(200, json={
+            "exception": "moodle_exception", "errorcode": "invalidtoken", "message": "Invalid token"
+        }))
+        
+        with pytest.raises(MoodleAPIError):
+            await client.call_batch([MoodleCall("a"), MoodleCall("b")])
+        await client.close()
+        
+        assert await batching_state.get(client._batch_support_key("ws-token")) is None
+
+
+class TestReadCoalescing:
+    """Tests for sharing identical in-flight reads."""
+    
+    async def test_identical_reads_share_one_request(self):
+        """Test that concurrent reads with the same token hit Moodle once."""
+        tokens = []
+        
+        async def handler(request: httpx.Request) -> httpx.Response:
+            form = dict(httpx.QueryParams((await request.aread()).decode()))
+            tokens.append(form["wstoken"])
+            await asyncio.sleep(0.05)
+            return httpx.Response(200, json={"userid": 5, "username": form["wstoken"]})
+        
+        transport = httpx.MockTransport(handler)
+        client = MoodleClient(
+            base_url="http://moodle.test",
+            http_client=httpx.AsyncClient(transport=transport)
+        )
+        
+        results = await asyncio.gather(
+            *(client.get_site_info(token="student-a") for _ in range(10)),
+            client.get_site_info(token="student-b")
+        )
+        await client.close()
+        
+        assert sorted(tokens) == ["student-a", "student-b"]
+        assert results[0]["username"] == "student-a"
+        assert results[-1]["username"] == "student-b"
+    
+    async def test_failed_read_is_not_remembered(self):
+        """Test that an error is shared by waiters but the next call retries."""
+        attempts = []
+        
+        async def handler(request: httpx.Request) -> httpx.Response:
+            attempts.append(1)
+            if len(attempts) == 1:
+                return httpx.Response(503)
+            return httpx.Response(200, json={"userid": 5})
+        
+        client = _mock_client(handler)
+        
+        with pytest.raises(MoodleAPIError):
+            await client.get_site_info()
+        assert (await client.get_site_info())["userid"] == 5
+        await client.close()
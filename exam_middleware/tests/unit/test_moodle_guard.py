@@ -0,0 +1,201 @@
+"""
+Unit Tests for Moodle Backend Guard
+
+Tests the protection in front of Moodle including:
+- Circuit breaker state transitions
+- AIMD concurrency limit (uploads exempt from the latency target)
+- Guarded transport error handling
+"""
+
+import asyncio
+
+import pytest
+
+import httpx
+
+from app.core.config import settings
+from app.services.moodle_client import MoodleUnavailableError
+from app.services.moodle_guard import (
+    CircuitBreaker,
+    AdaptiveLimiter,
+    MoodleGuard,
+    GuardedTransport,
+)
+from app.services.submission_service import SubmissionService
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestCircuitBreaker:
+    """Tests for closed / open / half-open transitions."""
+    
+    def test_opens_after_threshold_and_probes_after_reset(self):
+        """Test that consecutive failures open the circuit until a probe succeeds."""
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30, clock=clock)
+        
+        for _ in range(3):
+            breaker.before_request()
+            breaker.record_failure()
+        
+        assert breaker.is_open
+        with pytest.raises(MoodleUnavailableError):
+            breaker.before_request()
+        
+        clock.now += 31
+        breaker.before_request()  # the probe
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(MoodleUnavailableError):
+            breaker.before_request()  # only one probe at a time
+        
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.before_request()
+    
+    def test_failed_probe_reopens(self):
+        """Test that a failing half-open probe opens the circuit again."""
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30, clock=clock)
+        breaker.record_failure()
+        clock.now += 31
+        
+        breaker.before_request()
+        breaker.record_failure()
+        
+        assert breaker.is_open
+    
+    def test_success_resets_failure_count(self):
+        """Test that only consecutive failures count."""
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        
+        assert not breaker.is_open
+
+
+class TestAdaptiveLimiter:
+    """Tests for the AIMD concurrency limit."""
+    
+    async def test_additive_increase_multiplicative_decrease(self):
+        """Test that fast successes grow the limit and slow responses cut it."""
+        clock = FakeClock()
+        limiter = AdaptiveLimiter(
+            initial_limit=10, min_limit=2, max_limit=50, latency_target=1.0, clock=clock
+        )
+        
+        for _ in range(10):
+            await limiter.acquire()
+            await limiter.release(0.1, ok=True)
+        assert 10.9 < limiter.limit < 11.1
+        
+        await limiter.acquire()
+        await limiter.release(5.0, ok=True)
+        assert int(limiter.limit) == 7
+        
+        # A burst of failures within one latency window only cuts once
+        await limiter.acquire()
+        await limiter.release(0.1, ok=False)
+        assert int(limiter.limit) == 7
+        
+        clock.now += 2
+        await limiter.acquire()
+        await limiter.release(0.1, ok=False)
+        assert int(limiter.limit) == 5
+    
+    async def test_waiters_fail_fast_when_no_slot_frees(self):
+        """Test that a request over the limit gives up after wait_seconds."""
+        limiter = AdaptiveLimiter(initial_limit=1, min_limit=1, max_limit=1, wait_seconds=0.05)
+        await limiter.acquire()
+        
+        with pytest.raises(MoodleUnavailableError):
+            await limiter.acquire()
+        
+        await limiter.release(0.1, ok=True)
+        await limiter.acquire()
+        assert limiter.in_flight == 1
+
+
+class TestGuardedTransport:
+    """Tests for routing Moodle HTTP traffic through the guard."""
+    
+    async def test_outage_opens_circuit_and_fails_fast(self):
+        """Test that connection errors become MoodleUnavailableError and stop traffic."""
+        attempts = []
+        
+        def handler(request: httpx.Request) -> httpx.Response:
+            attempts.append(1)
+            raise httpx.ConnectError("refused", request=request)
+        
+        guard = MoodleGuard(
+            breaker=CircuitBreaker(failure_threshold=2, reset_seconds=60),
+            limiter=AdaptiveLimiter(initial_limit=5, min_limit=1, max_limit=5)
+        )
+        client = httpx.AsyncClient(transport=GuardedTransport(httpx.MockTransport(handler), guard))
+        
+        for _ in range(4):
+            with pytest.raises(MoodleUnavailableError):
+                await client.post("http://moodle.test/webservice/rest/server.php")
+        await client.aclose()
+        
+        assert len(attempts) == 2
+        assert guard.is_open
+        assert guard.limiter.in_flight == 0
+    
+    async def test_server_errors_count_but_moodle_errors_do_not(self):
+        """Test that 5xx responses trip the breaker while Moodle exceptions do not."""
+        responses = iter([
+            httpx.Response(200, json={"exception": "moodle_exception", "errorcode": "invalidtoken"}),
+            httpx.Response(503),
+        ])
+        guard = MoodleGuard(
+            breaker=CircuitBreaker(failure_threshold=1, reset_seconds=60),
+            limiter=AdaptiveLimiter(initial_limit=5, min_limit=1, max_limit=5)
+        )
+        client = httpx.AsyncClient(
+            transport=GuardedTransport(httpx.MockTransport(lambda request: next(responses)), guard)
+        )
+        
+        await client.post("http://moodle.test/")
+        assert not guard.is_open
+        
+        assert (await client.post("http://moodle.test/")).status_code == 503
+        assert guard.is_open
+        await client.aclose()
+    
+    async def test_slow_uploads_do_not_shrink_the_limit(self):
+        """Test that large file uploads are not mistaken for an overloaded backend."""
+        async def handler(request: httpx.Request) -> httpx.Response:
+            await asyncio.sleep(0.03)
+            return httpx.Response(200, json=[])
+        
+        guard = MoodleGuard(
+            breaker=CircuitBreaker(failure_threshold=3, reset_seconds=60),
+            limiter=AdaptiveLimiter(initial_limit=20, min_limit=2, max_limit=20, latency_target=0.01)
+        )
+        client = httpx.AsyncClient(transport=GuardedTransport(httpx.MockTransport(handler), guard))
+        
+        for _ in range(5):
+            await client.post(f"http://moodle.test{settings.moodle_upload_endpoint}", content=b"%PDF" * 1000)
+        assert int(guard.limiter.limit) == 20
+        
+        # The same latency on a web service call still counts as slow
+        await client.post("http://moodle.test/webservice/rest/server.php")
+        assert int(guard.limiter.limit) == 14
+        await client.aclose()
+
+
+class TestSubmissionFailFast:
+    """Tests for queueing submissions while Moodle is down."""
+    
+    def test_unavailable_errors_are_queued(self):
+        """Test that breaker rejections and outages go to the retry queue."""
+        service = SubmissionService.__new__(SubmissionService)
+        
+        assert service._should_queue_for_retry(MoodleUnavailableError("circuit open"))
@@ -0,0 +1,90 @@
+"""
+Unit Tests for Moodle Rate Limiter
+
+Tests outbound traffic shaping including:
+- Per-function token bucket budgets
+- Fair queuing between interactive and background calls
+- Mapping requests to their web service function
+"""
+
+import asyncio
+import time
+
+import httpx
+
+from app.services.moodle_guard import GuardedTransport
+from app.services.moodle_rate_limiter import (
+    MoodleRateLimiter,
+    TokenBucket,
+    background_priority,
+)
+
+
+class TestTokenBucket:
+    """Tests for the bucket arithmetic."""
+    
+    def test_burst_then_refill(self):
+        """Test that a full bucket allows a burst and then refills at the rate."""
+        now = [0.0]
+        bucket = TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+        
+        assert [bucket.try_take() for _ in range(4)] == [True, True, True, False]
+        assert bucket.delay() == 0.5
+        
+        now[0] += 0.5
+        assert bucket.try_take()
+        assert not bucket.try_take()
+
+
+class TestRateLimiter:
+    """Tests for per-function budgets and fair queuing."""
+    
+    async def test_functions_have_separate_budgets(self):
+        """Test that exhausting the upload budget does not slow down reads."""
+        limiter = MoodleRateLimiter({"default": (0, 0), "core_files_upload": (10, 1)})
+        
+        await limiter.acquire("core_files_upload")
+        started = time.monotonic()
+        for _ in range(50):
+            await limiter.acquire("mod_assign_get_submission_status")
+        assert time.monotonic() - started < 0.1
+        
+        waiter = asyncio.ensure_future(limiter.acquire("core_files_upload"))
+        await asyncio.sleep(0.02)
+        assert not waiter.done()
+        await waiter
+    
+    async def test_background_work_gets_a_fair_share(self):
+        """Test that queued students go first but retries are not starved."""
+        limiter = MoodleRateLimiter({"default": (200, 1)}, interactive_share=3)
+        await limiter.acquire("core_webservice_get_site_info")  # drain the burst
+        order = []
+        
+        async def call(kind: str):
+            if kind == "background":
+                with background_priority():
+                    await limiter.acquire("core_webservice_get_site_info")
+            else:
+                await limiter.acquire("core_webservice_get_site_info")
+            order.append(kind[0])
+        
+        await asyncio.gather(*(call("background") for _ in range(4)), *(call("interactive") for _ in range(4)))
+        
+        assert "".join(order) == "iiibibbb"
+
+
+class TestFunctionDetection:
+    """Tests for picking the budget of an outgoing request."""
+    
+    def test_ws_function_from_request(self):
+        """Test that form posts, uploads and logins map to their budgets."""
+        rest = httpx.Request(
+            "POST", "http://moodle.test/webservice/rest/server.php",
+            data={"wstoken": "t", "wsfunction": "mod_assign_save_submission"}
+        )
+        upload = httpx.Request("POST", "http://moodle.test/webservice/upload.php", content=b"x")
+        login = httpx.Request("POST", "http://moodle.test/login/token.php", data={"username": "u"})
+        
+        assert GuardedTransport._ws_function(rest) == "mod_assign_save_submission"
+        assert GuardedTransport._ws_function(upload) == "core_files_upload"
+        assert GuardedTransport._ws_function(login) == "login"
@@ -0,0 +1,85 @@
+"""
+Unit Tests for Paper File Serving
+
+Tests the helpers behind /student/paper/{uuid}/view including:
+- X-Accel-Redirect URI mapping
+- Content-Disposition headers
+- Conditional GET and byte ranges
+"""
+
+import pytest
+import os
+from unittest.mock import patch
+
+from app.api.routes.student import (
+    _x_accel_uri,
+    _content_disposition,
+    _etag_matches,
+    _parse_byte_range,
+)
+
+
+class TestXAccelRedirect:
+    """Tests for mapping stored files to the nginx internal location."""
+    
+    def test_file_in_upload_dir_maps_to_internal_location(self, temp_upload_dir):
+        """Test that blob paths become URIs under the configured prefix."""
+        path = os.path.join(temp_upload_dir, "blobs", "ab", "cd", "abcd.pdf")
+        
+        with patch("app.api.routes.student.settings") as settings:
+            settings.upload_dir = temp_upload_dir
+            settings.x_accel_redirect_prefix = "/_protected_uploads/"
+            
+            assert _x_accel_uri(path) == "/_protected_uploads/blobs/ab/cd/abcd.pdf"
+    
+    def test_file_outside_upload_dir_is_not_offloaded(self, temp_upload_dir):
+        """Test that paths outside the upload dir fall back to direct serving."""
+        with patch("app.api.routes.student.settings") as settings:
+            settings.upload_dir = os.path.join(temp_upload_dir, "uploads")
+            settings.x_accel_redirect_prefix = "/_protected_uploads/"
+            
+            assert _x_accel_uri(os.path.join(temp_upload_dir, "uploads-old", "a.pdf")) is None
+            assert _x_accel_uri(os.path.join(temp_upload_dir, "uploads", "..", "a.pdf")) is None
+
+
+class TestContentDisposition:
+    """Tests for download filename headers."""
+    
+    def test_plain_filename(self):
+        """Test that ASCII names are quoted directly."""
+        assert _content_disposition("123456789012_19AI405.pdf") == \
+            'attachment; filename="123456789012_19AI405.pdf"'
+    
+    def test_non_ascii_filename_is_encoded(self):
+        """Test that other names use RFC 5987 encoding."""
+        assert _content_disposition("scan é.pdf") == "attachment; filename*=utf-8''scan%20%C3%A9.pdf"
+
+
+class TestConditionalRequests:
+    """Tests for ETag matching and Range parsing."""
+    
+    def test_etag_matches_lists_and_weak_tags(self):
+        """Test If-None-Match with several, weak and wildcard tags."""
+        etag = '"abc"'
+        
+        assert _etag_matches('"abc"', etag)
+        assert _etag_matches('"old", W/"abc"', etag)
+        assert _etag_matches("*", etag)
+        assert not _etag_matches('"abcd"', etag)
+        assert not _etag_matches(None, etag)
+    
+    @pytest.mark.parametrize("header,expected", [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes=900-5000", (900, 999)),
+        ("bytes=1000-", (1000, 999)),
+        ("bytes=0-1,5-9", None),
+        ("items=0-1", None),
+        ("bytes=9-1", None),
+        ("bytes=abc", None),
+    ])
+    def test_parse_byte_range(self, header, expected):
+        """Test single-range parsing against a 1000 byte file."""
+        assert _parse_byte_range(header, 1000) == expected
@@ -0,0 +1,210 @@
+"""
+Unit Tests for Subject Catalog
+
+Tests the preloaded subject index including:
+- Index keys from course and assignment names
+- Crawling courses and assignments in chunks
+- Lookups replacing live Moodle discovery
+- Persisting new mappings
+"""
+
+from contextlib import asynccontextmanager
+from unittest.mock import MagicMock, AsyncMock, patch
+
+from app.services.moodle_client import MoodleClient
+from app.services.subject_catalog_service import SubjectCatalog, SubjectCodeMatcher, build_index
+from app.services.subject_discovery_service import SubjectDiscoveryService
+
+
+COURSES = [
+    {
+        "id": 3,
+        "shortname": "19AI405",
+        "fullname": "Deep Learning (19AI405)",
+        "assignments": [{"id": 10, "name": "Quiz"}, {"id": 11, "name": "End Semester"}]
+    },
+    {
+        "id": 4,
+        "shortname": "AI-ELECTIVES",
+        "fullname": "AI Electives",
+        "assignments": [{"id": 20, "name": "19AI411 - CIA II"}, {"id": 21, "name": "19AI405 retest"}]
+    },
+    {"id": 5, "shortname": "EMPTY", "fullname": "No assignments", "assignments": []},
+]
+
+
+def _session_maker(db):
+    @asynccontextmanager
+    async def _maker():
+        yield db
+    return _maker
+
+
+def _loaded_catalog():
+    catalog = SubjectCatalog(admin_token="admin", refresh_minutes=30)
+    catalog._index = build_index(COURSES)
+    catalog.built_at = MagicMock()
+    return catalog
+
+
+class TestBuildIndex:
+    """Tests for building the index."""
+    
+    def test_course_and_assignment_keys(self):
+        """Test that course names and assignment names both resolve."""
+        index = build_index(COURSES)
+        
+        assert index["19AI411"]["assignment_id"] == 20
+        assert index["AI-ELECTIVES"]["assignment_id"] == 20
+        assert index["DEEP"]["assignment_id"] == 10
+        assert "EMPTY" not in index
+    
+    def test_assignment_names_are_more_specific_than_courses(self):
+        """Test that an assignment named after a code wins over a course match."""
+        index = build_index(COURSES)
+        
+        assert index["19AI405"]["assignment_id"] == 21
+        assert index["19AI405"]["course_id"] == 4
+
+
+class TestCatalog:
+    """Tests for crawling and looking up."""
+    
+    def test_lookup_normalizes_code(self):
+        """Test that lookups ignore case and whitespace."""
+        catalog = _loaded_catalog()
+        
+        assert catalog.lookup(" 19ai411 ")["assignment_id"] == 20
+        assert catalog.lookup("19XX999") is None
+    
+    async def test_crawl_fetches_assignments_in_chunks(self):
+        """Test that one course list and chunked assignment calls cover every course."""
+        courses = [{"id": i, "shortname": f"C{i}", "idnumber": f"ID{i}"} for i in range(1, 6)]
+        
+        async def get_assignments(course_ids, token=None):
+            return {"courses": [{"id": i, "shortname": f"C{i}", "assignments": []} for i in course_ids]}
+        
+        catalog = SubjectCatalog(admin_token="admin", refresh_minutes=30)
+        with patch.object(MoodleClient, "get_courses", new=AsyncMock(return_value={"courses": courses})), \
+             patch.object(MoodleClient, "get_assignments", new=AsyncMock(side_effect=get_assignments)) as fetch, \
+             patch.object(MoodleClient, "close", new=AsyncMock()), \
+             patch("app.services.subject_catalog_service.ASSIGNMENTS_PER_REQUEST", 2):
+            crawled = await catalog.crawl()
+        
+        assert fetch.await_count == 3
+        assert [c["id"] for c in crawled] == [1, 2, 3, 4, 5]
+        assert crawled[0]["idnumber"] == "ID1"
+    
+    async def test_persist_inserts_only_unmapped_codes(self):
+        """Test that codes with a mapping already are left alone."""
+        db = AsyncMock()
+        artifact_codes = MagicMock()
+        artifact_codes.scalars.return_value.all.return_value = ["19ai405", "19AI411", "19XX999"]
+        mapped = MagicMock()
+        mapped.scalars.return_value.all.return_value = ["19AI405"]
+        db.execute = AsyncMock(side_effect=[artifact_codes, mapped, MagicMock()])
+        catalog = _loaded_catalog()
+        catalog.session_maker = _session_maker(db)
+        
+        created = await catalog.persist()
+        
+        assert created == 1
+        inserted = db.execute.call_args_list[2].args[0].compile().params
+        assert inserted["subject_code_m0"] == "19AI411"
+        assert inserted["moodle_assignment_id_m0"] == 20
+        db.commit.assert_awaited_once()
+
+
+class TestDiscoveryUsesCatalog:
+    """Tests for layer 3 once the catalog is loaded."""
+    
+    async def test_catalog_replaces_live_discovery(self):
+        """Test that a loaded catalog answers without crawling Moodle."""
+        service = SubjectDiscoveryService(AsyncMock())
+        service._discover_from_moodle = AsyncMock()
+        
+        with patch("app.services.subject_discovery_service.subject_catalog", _loaded_catalog()):
+            found = await service._discover_if_possible("19AI411", user_token="token")
+            missing = await service._discover_if_possible("19XX999", user_token="token")
+        
+        assert found["assignment_id"] == 20
+        assert missing is None
+        service._discover_from_moodle.assert_not_awaited()
+
+
+class TestSubjectCodeMatcher:
+    """Tests for matching many subject codes in one pass."""
+    
+    def test_finds_overlapping_codes(self):
+        """Test that codes sharing prefixes and suffixes are all found."""
+        matcher = SubjectCodeMatcher(["19ai405", "AI405", "19AI4", "19CS101"])
+        
+        assert matcher.find("Deep Learning 19AI405-B") == {"19AI405", "AI405", "19AI4"}
+        assert matcher.find("19AI4 retest") == {"19AI4"}
+        assert matcher.find(None) == set()
+    
+    def test_resolve_follows_discovery_rules(self):
+        """Test course matches, fullname-only matches and assignment-name fallback."""
+        courses = [
+            {"id": 1, "shortname": "MISC", "fullname": "Misc", "assignments": [
+                {"id": 10, "name": "19CS101 makeup"}, {"id": 11, "name": "19AI411 retest"}
+            ]},
+            {"id": 2, "shortname": "19AI405-2025", "fullname": "Deep Learning", "assignments": [
+                {"id": 20, "name": "Quiz"}, {"id": 21, "name": "19AI405 End Sem"}
+            ]},
+            {"id": 3, "shortname": "ELECTIVES", "fullname": "19AI411 and 19ME201", "assignments": [
+                {"id": 30, "name": "CIA I"}, {"id": 31, "name": "19AI411 CIA II"}
+            ]},
+        ]
+        
+        resolved = SubjectCodeMatcher(["19AI405", "19AI411", "19CS101", "19ME201", "19XX999"]).resolve(courses)
+        
+        # Shortname match: the course's first assignment
+        assert resolved["19AI405"]["assignment_id"] == 20
+        # Fullname match: only that course, and only by assignment name
+        assert resolved["19AI411"]["assignment_id"] == 31
+        assert "19ME201" not in resolved
+        # No course match: first assignment named after the code anywhere
+        assert resolved["19CS101"]["assignment_id"] == 10
+        assert "19XX999" not in resolved
+    
+    def test_resolve_matches_live_discovery(self):
+        """Test that the matcher picks what per-code discovery would."""
+        courses = [
+            {"id": 1, "shortname": "GEN", "fullname": "General", "assignments": [{"id": 10, "name": "19AI405 draft"}]},
+            {"id": 2, "shortname": "X19AI405", "fullname": "Deep Learning", "assignments": [{"id": 20, "name": "Final"}]},
+        ]
+        
+        resolved = SubjectCodeMatcher(["19AI405"]).resolve(courses)
+        
+        # A course match restricts the search to matched courses, as discovery does
+        assert resolved["19AI405"]["assignment_id"] == 20
+    
+    async def test_crawl_fetches_chunks_concurrently(self):
+        """Test that assignment chunks are fetched in parallel up to the limit."""
+        import asyncio
+        
+        courses = [{"id": i, "shortname": f"C{i}"} for i in range(1, 7)]
+        running = []
+        peak = []
+        
+        async def get_assignments(course_ids, token=None):
+            running.append(course_ids)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(course_ids)
+            return {"courses": [{"id": i, "assignments": []} for i in course_ids]}
+        
+        catalog = SubjectCatalog(admin_token="admin", refresh_minutes=30)
+        progress = {}
+        with patch.object(MoodleClient, "get_courses", new=AsyncMock(return_value={"courses": courses})), \
+             patch.object(MoodleClient, "get_assignments", new=AsyncMock(side_effect=get_assignments)), \
+             patch.object(MoodleClient, "close", new=AsyncMock()), \
+             patch("app.services.subject_catalog_service.ASSIGNMENTS_PER_REQUEST", 1), \
+             patch("app.services.subject_catalog_service.settings") as settings:
+            settings.subject_catalog_crawl_concurrency = 2
+            crawled = await catalog.crawl(progress=progress)
+        
+        assert max(peak) == 2
+        assert [c["id"] for c in crawled] == [1, 2, 3, 4, 5, 6]
+        assert progress == {"courses": 6, "chunks_total": 6, "chunks_done": 6}
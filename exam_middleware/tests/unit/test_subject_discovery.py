@@ -16,7 +16,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.db.models import SubjectMapping
 from app.services.subject_discovery_service import SubjectDiscoveryService
-from app.core.cache import subject_cache
+from app.services.subject_catalog_service import subject_catalog
+from app.core.cache import subject_cache, subject_negative_cache
 
 import sys
 import os
@@ -24,6 +25,14 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from tests.factories import SubjectMappingFactory, MoodleResponseFactory
 
 
+@pytest.fixture(autouse=True)
+async def clear_negative_cache():
+    """Failed lookups cached by one test must not leak into the next."""
+    await subject_negative_cache.clear()
+    yield
+    await subject_negative_cache.clear()
+
+
 class TestCacheLayer:
     """Tests for the cache layer of subject discovery."""
     
@@ -367,20 +376,100 @@ class TestBulkOperations:
         """Test refreshing all mappings from Moodle."""
         service = SubjectDiscoveryService(db_session)
         
-        # Mock discovery to return updated info
+        # Mock the crawl to return updated info
         with patch.object(
-            service, '_discover_from_moodle',
-            return_value={
-                "assignment_id": 999,  # Different from original
-                "course_id": 10,
-                "assignment_name": "Updated Assignment"
-            }
+            subject_catalog, 'crawl',
+            new=AsyncMock(return_value=[{
+                "id": 10,
+                "shortname": "19AI405",
+                "assignments": [{"id": 999, "name": "Updated Assignment"}]  # Different from original
+            }])
         ):
             result = await service.refresh_all_mappings(user_token="test-token")
             
             assert "total" in result
             assert "refreshed" in result
             assert "failed" in result
+    
+    @pytest.mark.asyncio
+    async def test_refresh_crawls_once_and_writes_only_the_diff(self):
+        """Test that remapping many subjects costs one crawl and one write per kind of change."""
+        mappings = [
+            SubjectMapping(id=i, subject_code=code, moodle_course_id=1, moodle_assignment_id=1)
+            for i, code in enumerate(("19AI405", "19AI411", "19XX999"), start=1)
+        ]
+        
+        def rows(values):
+            result = MagicMock()
+            result.scalars.return_value.all.return_value = values
+            return result
+        
+        db = AsyncMock()
+        db.execute = AsyncMock(side_effect=[
+            rows(mappings),
+            rows(["19AI405", "19cs101", "19ME201"]),  # uploaded subject codes
+            rows(["19AI405", "19AI411", "19XX999"]),  # every mapped code
+            MagicMock(), MagicMock(), MagicMock(),
+        ])
+        service = SubjectDiscoveryService(db)
+        courses = [
+            {"id": 3, "shortname": "19AI405", "assignments": [{"id": 5, "name": "End Sem"}]},
+            {"id": 4, "shortname": "ELECTIVES", "assignments": [
+                {"id": 1, "name": "19AI411 CIA"}, {"id": 7, "name": "19CS101 Lab"}
+            ]},
+        ]
+        progress = {}
+        
+        with patch.object(subject_catalog, 'crawl', new=AsyncMock(return_value=courses)) as crawl:
+            result = await service.refresh_all_mappings(user_token="test-token", progress=progress)
+        
+        crawl.assert_awaited_once()
+        assert (result["refreshed"], result["unchanged"], result["failed"], result["created"]) == (1, 1, 1, 1)
+        assert progress["phase"] == "persisting"
+        
+        bulk_update, verified, inserted = [c.args for c in db.execute.call_args_list[3:]]
+        assert bulk_update[1] == [{
+            "id": 1, "moodle_assignment_id": 5, "moodle_course_id": 3,
+            "moodle_assignment_name": "End Sem", "last_verified_at": bulk_update[1][0]["last_verified_at"]
+        }]
+        assert verified[0].compile().params["id_1"] == [2]
+        assert inserted[0].compile().params["subject_code_m0"] == "19CS101"
+    
+    @pytest.mark.asyncio
+    async def test_background_refresh_reports_progress(self):
+        """Test that the refresher runs once at a time and records the result."""
+        from contextlib import asynccontextmanager
+        import asyncio
+        from app.services.subject_discovery_service import MappingRefresher
+        
+        db = AsyncMock()
+        
+        @asynccontextmanager
+        async def session_maker():
+            yield db
+        
+        release = asyncio.Event()
+        
+        async def refresh(self, token, progress=None):
+            progress["phase"] = "crawling"
+            await release.wait()
+            return {"refreshed": 2}
+        
+        refresher = MappingRefresher(session_maker=session_maker)
+        with patch.object(SubjectDiscoveryService, 'refresh_all_mappings', new=refresh):
+            first = refresher.start("token")
+            await asyncio.sleep(0)
+            second = refresher.start("token")
+            assert second["status"] == "RUNNING" and second["started_at"] == first["started_at"]
+            assert refresher.status()["phase"] == "crawling"
+            
+            release.set()
+            await refresher._task
+        
+        done = refresher.status()
+        assert done["status"] == "COMPLETED"
+        assert done["result"] == {"refreshed": 2}
+        db.commit.assert_awaited_once()
 
 
 class TestEdgeCases:
@@ -438,3 +527,197 @@ class TestEdgeCases:
         # All should succeed
         assert all(r is not None for r in results)
         assert all(r["assignment_id"] == results[0]["assignment_id"] for r in results)
+    
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_misses_share_one_discovery(self):
+        """Test that a burst of cold lookups runs Moodle discovery only once."""
+        import asyncio
+        
+        await subject_cache.clear()
+        calls = []
+        
+        async def discover(subject_code, token):
+            calls.append(subject_code)
+            await asyncio.sleep(0.05)
+            return {"course_id": 3, "assignment_id": 42, "assignment_name": "Exam"}
+        
+        services = [SubjectDiscoveryService(AsyncMock()) for _ in range(20)]
+        for service in services:
+            service._get_from_database = AsyncMock(return_value=None)
+            service._discover_from_moodle = discover
+            service._save_discovered_mapping = AsyncMock()
+        
+        results = await asyncio.gather(*(
+            service.get_assignment_info("19AI405", user_token="token") for service in services
+        ))
+        await subject_cache.clear()
+        
+        assert calls == ["19AI405"]
+        assert all(r["assignment_id"] == 42 for r in results)
+        # The shared discovery never touches a request session; every caller
+        # persists the result in its own
+        assert all(s._save_discovered_mapping.await_count == 1 for s in services)
+    
+    @pytest.mark.asyncio
+    async def test_lookups_without_token_do_not_share_discovery(self):
+        """Test that a token-less miss cannot hand its empty result to a caller with a token."""
+        import asyncio
+        
+        await subject_cache.clear()
+        
+        async def discover(subject_code, token):
+            await asyncio.sleep(0.01)
+            return {"course_id": 3, "assignment_id": 42, "assignment_name": "Exam"}
+        
+        service = SubjectDiscoveryService(AsyncMock())
+        service._discover_from_moodle = discover
+        service._save_discovered_mapping = AsyncMock()
+        service._get_from_config = AsyncMock(return_value=None)
+        db_result = MagicMock()
+        db_result.scalars.return_value.all.return_value = []
+        service.db.execute = AsyncMock(return_value=db_result)
+        
+        without_token, with_token = await asyncio.gather(
+            service.get_assignment_infos(["19AI405"]),
+            service.get_assignment_infos(["19AI405"], user_token="token")
+        )
+        await subject_cache.clear()
+        
+        assert without_token == {}
+        assert with_token["19AI405"]["assignment_id"] == 42
+
+
+class TestBatchResolution:
+    """Tests for resolving several subjects at once (student dashboard)."""
+    
+    @pytest.fixture(autouse=True)
+    async def clear_cache(self):
+        """Clear cache before tests."""
+        await subject_cache.clear()
+        yield
+        await subject_cache.clear()
+    
+    @pytest.mark.asyncio
+    async def test_one_query_and_concurrent_discovery_for_missing_codes(self):
+        """Test that cache, one IN query and parallel discovery cover all codes."""
+        import asyncio
+        
+        await subject_cache.set("subject:19AI401", {"assignment_id": 1, "source": "cache"})
+        mapping = SubjectMapping(
+            subject_code="19AI405", moodle_course_id=3, moodle_assignment_id=5,
+            moodle_assignment_name="Exam", subject_name="Deep Learning"
+        )
+        db = AsyncMock()
+        db_result = MagicMock()
+        db_result.scalars.return_value.all.return_value = [mapping]
+        db.execute = AsyncMock(return_value=db_result)
+        
+        running = []
+        peak = []
+        
+        async def discover(subject_code, token):
+            running.append(subject_code)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(subject_code)
+            if subject_code == "19AI411":
+                return {"course_id": 4, "assignment_id": 7, "assignment_name": "Exam"}
+            return None
+        
+        service = SubjectDiscoveryService(db)
+        service._discover_from_moodle = discover
+        service._save_discovered_mapping = AsyncMock()
+        service._get_from_config = AsyncMock(return_value=None)
+        
+        results = await service.get_assignment_infos(
+            ["19ai401", "19AI405", "19AI411", "UNKNOWN", "19AI405"],
+            user_token="token"
+        )
+        
+        assert db.execute.await_count == 1
+        assert max(peak) == 2
+        assert {code: info["assignment_id"] for code, info in results.items()} == {
+            "19AI401": 1, "19AI405": 5, "19AI411": 7
+        }
+        assert results["19AI405"]["subject_name"] == "Deep Learning"
+        service._save_discovered_mapping.assert_awaited_once()
+        assert (await subject_cache.get("subject:19AI411"))["assignment_id"] == 7
+    
+    @pytest.mark.asyncio
+    async def test_cached_codes_skip_the_database(self):
+        """Test that a warm cache resolves the dashboard without queries."""
+        await subject_cache.set("subject:19AI405", {"assignment_id": 5})
+        db = AsyncMock()
+        service = SubjectDiscoveryService(db)
+        
+        results = await service.get_assignment_infos(["19AI405"], user_token="token")
+        
+        assert results["19AI405"]["assignment_id"] == 5
+        db.execute.assert_not_awaited()
+
+
+class TestNegativeCache:
+    """Tests for caching subject codes that cannot be resolved."""
+    
+    @pytest.fixture(autouse=True)
+    async def clear_cache(self):
+        """Clear cache before tests."""
+        await SubjectDiscoveryService.clear_cache()
+        yield
+        await SubjectDiscoveryService.clear_cache()
+    
+    def _unresolvable_service(self):
+        service = SubjectDiscoveryService(AsyncMock())
+        service._get_from_database = AsyncMock(return_value=None)
+        service._discover_from_moodle = AsyncMock(return_value=None)
+        service._get_from_config = AsyncMock(return_value=None)
+        return service
+    
+    @pytest.mark.asyncio
+    async def test_unresolvable_code_is_not_rediscovered(self):
+        """Test that a failed lookup is answered from cache the next time."""
+        service = self._unresolvable_service()
+        
+        assert await service.get_assignment_info("19XX999", user_token="token") is None
+        assert await service.get_assignment_info("19xx999", user_token="token") is None
+        
+        service._discover_from_moodle.assert_awaited_once()
+        service._get_from_database.assert_awaited_once()
+    
+    @pytest.mark.asyncio
+    async def test_lookup_without_token_does_not_block_discovery(self):
+        """Test that a miss that could not try Moodle does not hide a later discovery."""
+        service = self._unresolvable_service()
+        
+        await service.get_assignment_info("19XX999")
+        await service.get_assignment_info("19XX999", user_token="token")
+        
+        service._discover_from_moodle.assert_awaited_once()
+    
+    @pytest.mark.asyncio
+    async def test_new_mapping_invalidates_failed_lookup(self):
+        """Test that creating a mapping makes the code resolvable right away."""
+        service = self._unresolvable_service()
+        await service.get_assignment_info("19XX999", user_token="token")
+        
+        await SubjectDiscoveryService.invalidate_subject("19xx999")
+        service._get_from_database = AsyncMock(return_value=SubjectMapping(
+            subject_code="19XX999", moodle_course_id=3, moodle_assignment_id=8
+        ))
+        
+        result = await service.get_assignment_info("19XX999", user_token="token")
+        assert result["assignment_id"] == 8
+    
+    @pytest.mark.asyncio
+    async def test_batch_lookup_skips_known_failures(self):
+        """Test that the dashboard resolver does not query for cached failures."""
+        service = self._unresolvable_service()
+        await service.get_assignment_info("19XX999", user_token="token")
+        db = AsyncMock()
+        service.db = db
+        
+        results = await service.get_assignment_infos(["19XX999"], user_token="token")
+        
+        assert results == {}
+        db.execute.assert_not_awaited()
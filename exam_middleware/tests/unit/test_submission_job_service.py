@@ -0,0 +1,224 @@
+"""
+Unit Tests for Submission Jobs
+
+Tests background submission handling including:
+- Deduplicating jobs for the same paper
+- Recording job outcomes and wiping the Moodle token
+- Leases for running jobs
+- Worker pool lifecycle
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import MagicMock, AsyncMock, patch
+
+from sqlalchemy.dialects import postgresql
+
+from app.core.security import token_encryption
+from app.services.submission_job_service import SubmissionJobService, SubmissionWorker
+
+
+def _session_maker(db):
+    @asynccontextmanager
+    async def _maker():
+        yield db
+    return _maker
+
+
+def _job(**overrides):
+    values = dict(
+        id=1,
+        job_uuid="job-1",
+        artifact_id=7,
+        moodle_user_id=42,
+        moodle_username="student",
+        register_number="212222240047",
+        encrypted_token=token_encryption.encrypt("moodle-token"),
+        actor_ip="10.0.0.1",
+        lock_submission=True,
+        status=SubmissionJobService.RUNNING,
+        message=None,
+        result=None,
+        finished_at=None,
+    )
+    values.update(overrides)
+    return SimpleNamespace(**values)
+
+
+def _db_with(job, artifact):
+    db = AsyncMock()
+    db.get = AsyncMock(side_effect=lambda model, key: job if key == job.id else artifact)
+    db.add = MagicMock()
+    return db
+
+
+class TestEnqueue:
+    """Tests for creating jobs."""
+    
+    async def test_pending_job_is_reused(self):
+        """Test that a second submit while a job is pending does not queue another."""
+        existing = _job(status=SubmissionJobService.QUEUED)
+        db = AsyncMock()
+        db.add = MagicMock()
+        result = MagicMock()
+        # The conflicting insert hands back the active job
+        result.scalars.return_value.all.return_value = [existing]
+        db.execute = AsyncMock(return_value=result)
+        
+        job = await SubmissionJobService(db).enqueue(
+            SimpleNamespace(id=7, artifact_uuid="a-1"),
+            moodle_token="moodle-token",
+            moodle_user_id=42,
+            moodle_username="student",
+            register_number="212222240047"
+        )
+        
+        assert job is existing
+        db.add.assert_not_called()
+
+
+class TestEnqueueMany:
+    """Tests for queueing all of a student's papers at once."""
+    
+    async def test_one_insert_returns_new_and_existing_jobs(self):
+        """Test that every paper gets a job from one statement, reusing active jobs."""
+        artifacts = [SimpleNamespace(id=7), SimpleNamespace(id=8), SimpleNamespace(id=7)]
+        existing = _job(artifact_id=8, status=SubmissionJobService.RUNNING)
+        new = _job(id=2, artifact_id=7, status=SubmissionJobService.QUEUED)
+        db = AsyncMock()
+        result = MagicMock()
+        result.scalars.return_value.all.return_value = [existing, new]
+        db.execute = AsyncMock(return_value=result)
+        
+        jobs = await SubmissionJobService(db).enqueue_many(
+            artifacts,
+            moodle_token="moodle-token",
+            moodle_user_id=42,
+            moodle_username="student",
+            register_number="212222240047"
+        )
+        
+        db.execute.assert_awaited_once()
+        sql = str(db.execute.call_args.args[0].compile(dialect=postgresql.dialect()))
+        assert "ON CONFLICT (artifact_id) WHERE status IN" in sql
+        assert "RETURNING" in sql
+        assert jobs == [new, existing]
+
+
+class TestLeases:
+    """Tests for reclaiming jobs of workers that died."""
+    
+    async def test_claim_takes_queued_or_expired_jobs_and_sets_a_lease(self):
+        """Test that claiming considers expired RUNNING jobs and leases the claimed one."""
+        orphan = _job(status=SubmissionJobService.RUNNING, started_at=None, lease_expires_at=None)
+        db = AsyncMock()
+        result = MagicMock()
+        result.scalar_one_or_none.return_value = orphan
+        db.execute = AsyncMock(return_value=result)
+        
+        job = await SubmissionJobService(db).claim_next()
+        
+        query = str(db.execute.call_args.args[0])
+        assert "lease_expires_at <" in query
+        assert "FOR UPDATE SKIP LOCKED" in str(db.execute.call_args.args[0].compile(dialect=postgresql.dialect()))
+        assert job is orphan
+        assert job.status == SubmissionJobService.RUNNING
+        assert job.lease_expires_at > job.started_at
+    
+    async def test_running_job_renews_its_lease(self):
+        """Test that a long job keeps renewing its lease and stops once done."""
+        job = _job()
+        db = _db_with(job, SimpleNamespace(id=7, artifact_uuid="a-1"))
+        worker = SubmissionWorker(concurrency=1, session_maker=_session_maker(db))
+        
+        async def slow_submit(**kwargs):
+            await asyncio.sleep(0.05)
+            return True, "Submission successful", None
+        
+        with patch("app.services.submission_job_service.SubmissionService") as service_cls, \
+             patch("app.services.submission_job_service.settings") as settings, \
+             patch.object(SubmissionJobService, "renew_lease", new=AsyncMock(return_value=True)) as renew:
+            settings.submission_job_lease_seconds = 0.03
+            service_cls.return_value.submit_artifact = slow_submit
+            await worker.run_job(job.id)
+            renewals = renew.await_count
+            await asyncio.sleep(0.03)
+        
+        assert renewals >= 2
+        assert renew.await_count == renewals
+        assert job.lease_expires_at is None
+
+
+class TestRunJob:
+    """Tests for executing a claimed job."""
+    
+    async def test_success_is_recorded_and_token_wiped(self):
+        """Test that the job stores a JSON-safe result and forgets the token."""
+        job = _job()
+        db = _db_with(job, SimpleNamespace(id=7, artifact_uuid="a-1"))
+        worker = SubmissionWorker(concurrency=1, session_maker=_session_maker(db))
+        submitted_at = datetime(2026, 5, 1, 10, 0)
+        
+        with patch("app.services.submission_job_service.SubmissionService") as service_cls:
+            service_cls.return_value.submit_artifact = AsyncMock(
+                return_value=(True, "Submission successful", {"submitted_at": submitted_at})
+            )
+            await worker.run_job(job.id)
+        
+        kwargs = service_cls.return_value.submit_artifact.call_args.kwargs
+        assert kwargs["moodle_token"] == "moodle-token"
+        assert kwargs["artifact_uuid"] == "a-1"
+        assert job.status == SubmissionJobService.SUCCEEDED
+        assert job.result == {"submitted_at": str(submitted_at)}
+        assert job.encrypted_token is None
+        assert job.finished_at is not None
+        db.commit.assert_awaited()
+    
+    async def test_crash_marks_job_failed(self):
+        """Test that an unexpected error fails the job instead of leaving it RUNNING."""
+        job = _job()
+        db = _db_with(job, SimpleNamespace(id=7, artifact_uuid="a-1"))
+        worker = SubmissionWorker(concurrency=1, session_maker=_session_maker(db))
+        
+        with patch("app.services.submission_job_service.SubmissionService") as service_cls:
+            service_cls.return_value.submit_artifact = AsyncMock(side_effect=RuntimeError("boom"))
+            await worker.run_job(job.id)
+        
+        assert job.status == SubmissionJobService.FAILED
+        assert "boom" in job.message
+        assert job.encrypted_token is None
+        db.rollback.assert_awaited()
+
+
+class TestWorkerPool:
+    """Tests for the worker lifecycle."""
+    
+    async def test_notify_wakes_idle_workers(self):
+        """Test that enqueued jobs are picked up without waiting for the poll."""
+        db = AsyncMock()
+        db.execute = AsyncMock(return_value=MagicMock(rowcount=0))
+        worker = SubmissionWorker(concurrency=2, poll_seconds=60, session_maker=_session_maker(db))
+        queued = []
+        done = []
+        
+        async def claim():
+            return queued.pop() if queued else None
+        
+        async def run_job(job_id):
+            done.append(job_id)
+        
+        worker._claim = claim
+        worker.run_job = run_job
+        
+        await worker.start()
+        await asyncio.sleep(0)
+        queued.append(5)
+        worker.notify()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        await worker.stop()
+        
+        assert done == [5]
+        assert worker.stats()["workers"] == 0
@@ -0,0 +1,155 @@
+"""
+Unit Tests for the Submission Queue Processor
+
+Tests queued submission retries including:
+- Exponential backoff with jitter
+- Retry scheduling and giving up after max_retries
+- Skipping rows that were already submitted
+- Concurrent batch processing
+"""
+
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import MagicMock, AsyncMock, patch
+
+from app.db.models import WorkflowStatus
+from app.services.moodle_client import MoodleUnavailableError
+from app.services.submission_queue_service import SubmissionQueueProcessor
+from app.services.submission_service import SubmissionService
+
+
+def _item(**overrides):
+    values = dict(
+        id=1,
+        artifact_id=7,
+        status="PROCESSING",
+        retry_count=0,
+        max_retries=5,
+        next_retry_at=None,
+        processed_at=None,
+        last_error=None,
+    )
+    values.update(overrides)
+    return SimpleNamespace(**values)
+
+
+def _service(artifact):
+    service = SubmissionService.__new__(SubmissionService)
+    service.db = AsyncMock()
+    service.artifact_service = MagicMock()
+    service.artifact_service.claim_for_submission = AsyncMock(return_value=True)
+    service.artifact_service.release_submission_claim = AsyncMock()
+    service.artifact_service.get_by_id = AsyncMock(return_value=artifact)
+    service.artifact_service.mark_submitted = AsyncMock()
+    service.artifact_service.mark_failed = AsyncMock()
+    service._execute_submission = AsyncMock(side_effect=MoodleUnavailableError("timeout"))
+    return service
+
+
+def _artifact(status=WorkflowStatus.QUEUED):
+    return SimpleNamespace(id=7, artifact_uuid="a-1", workflow_status=status, moodle_assignment_id=4)
+
+
+class TestBackoff:
+    """Tests for the retry delay."""
+    
+    def test_backoff_grows_and_is_capped(self):
+        """Test that delays double per retry, stay within the jitter band and hit the cap."""
+        with patch("app.services.submission_service.settings") as settings:
+            settings.submission_queue_backoff_base_seconds = 30
+            settings.submission_queue_backoff_max_seconds = 1800
+            
+            for _ in range(50):
+                assert 15 <= SubmissionService.retry_backoff(1) <= 30
+                assert 60 <= SubmissionService.retry_backoff(3) <= 120
+                assert 900 <= SubmissionService.retry_backoff(20) <= 1800
+
+
+class TestProcessQueueItem:
+    """Tests for retrying one claimed row."""
+    
+    async def test_failure_is_rescheduled(self):
+        """Test that a failed retry goes back to QUEUED with a future next_retry_at."""
+        item = _item()
+        service = _service(_artifact())
+        
+        detail = await service.process_queue_item(item, "admin-token")
+        
+        assert detail["status"] == "failed"
+        assert item.status == "QUEUED"
+        assert item.retry_count == 1
+        assert item.next_retry_at is not None
+        service.artifact_service.mark_failed.assert_not_awaited()
+        service.artifact_service.release_submission_claim.assert_awaited_once_with(7, WorkflowStatus.QUEUED)
+    
+    async def test_last_retry_fails_the_artifact(self):
+        """Test that reaching max_retries marks the row and artifact failed."""
+        item = _item(retry_count=4)
+        service = _service(_artifact())
+        
+        await service.process_queue_item(item, "admin-token")
+        
+        assert item.status == "FAILED"
+        service.artifact_service.mark_failed.assert_awaited_once()
+    
+    async def test_already_submitted_is_not_resubmitted(self):
+        """Test that a row whose artifact already reached Moodle is just closed."""
+        item = _item()
+        service = _service(_artifact(WorkflowStatus.SUBMITTED_TO_LMS))
+        
+        detail = await service.process_queue_item(item, "admin-token")
+        
+        assert detail["status"] == "already_submitted"
+        assert item.status == "COMPLETED"
+        service._execute_submission.assert_not_awaited()
+    
+    async def test_paper_claimed_elsewhere_is_deferred(self):
+        """Test that a paper being submitted by someone else is not sent again."""
+        item = _item()
+        service = _service(_artifact())
+        service.artifact_service.claim_for_submission = AsyncMock(return_value=False)
+        
+        detail = await service.process_queue_item(item, "admin-token")
+        
+        assert detail["status"] == "deferred"
+        assert item.status == "QUEUED"
+        assert item.retry_count == 0
+        service._execute_submission.assert_not_awaited()
+
+
+class TestDrain:
+    """Tests for processing a claimed batch."""
+    
+    async def test_batch_is_processed_concurrently(self):
+        """Test that claimed rows run in parallel up to the concurrency limit."""
+        processor = SubmissionQueueProcessor(admin_token="admin-token", concurrency=3, batch_size=6)
+        processor.claim_batch = AsyncMock(return_value=[1, 2, 3, 4, 5, 6])
+        running = []
+        peak = []
+        
+        async def process_item(item_id):
+            running.append(item_id)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(item_id)
+            return {"artifact_uuid": str(item_id), "status": "success" if item_id % 2 else "failed"}
+        
+        processor.process_item = process_item
+        result = await processor.drain_once()
+        
+        assert result["processed"] == 6
+        assert result["successful"] == 3
+        assert result["failed"] == 3
+        assert max(peak) == 3
+    
+    async def test_open_circuit_claims_nothing(self):
+        """Test that rows stay queued (and unclaimed) while Moodle is down."""
+        processor = SubmissionQueueProcessor(admin_token="admin-token")
+        processor.claim_batch = AsyncMock(return_value=[])
+        
+        with patch("app.services.submission_queue_service.moodle_guard") as guard:
+            guard.is_open = True
+            result = await processor.drain_once()
+        
+        assert result["processed"] == 0
+        processor.claim_batch.assert_not_awaited()
@@ -0,0 +1,156 @@
+"""
+Unit Tests for Upload Session Service
+
+Tests the resumable chunked upload protocol including:
+- Session creation and limits
+- Chunk verification and retries
+- Resume state and assembly
+- Ownership and expiry
+"""
+
+import pytest
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+from app.services.upload_session_service import UploadSessionService, UploadSessionError
+
+
+async def _body(data: bytes, piece: int = 3):
+    """Simulate request.stream() delivering a chunk in small pieces."""
+    for start in range(0, len(data), piece):
+        yield data[start:start + piece]
+
+
+def _sha(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class TestUploadSessions:
+    """Tests for chunked, resumable upload sessions."""
+    
+    async def test_chunks_out_of_order_assemble_in_order(self, temp_upload_dir):
+        """Test that chunks can arrive in any order and resume state is reported."""
+        service = UploadSessionService(upload_dir=temp_upload_dir)
+        content = b"0123456789abcdefghij!"
+        session = await service.create_session("hall-a.zip", len(content), staff_id=1, chunk_size=8)
+        session_id = session["session_id"]
+        chunks = [content[i:i + 8] for i in range(0, len(content), 8)]
+        
+        assert session["total_chunks"] == 3
+        
+        await service.write_chunk(session_id, 2, _body(chunks[2]), _sha(chunks[2]), staff_id=1)
+        state = await service.write_chunk(session_id, 0, _body(chunks[0]), _sha(chunks[0]), staff_id=1)
+        
+        assert state["received_chunks"] == [0, 2]
+        assert state["missing_chunks"] == [1]
+        assert state["received_bytes"] == 8 + 5
+        
+        with pytest.raises(UploadSessionError) as exc:
+            await service.claim(session_id, staff_id=1)
+        assert exc.value.status_code == 409
+        
+        await service.write_chunk(session_id, 1, _body(chunks[1]), _sha(chunks[1]), staff_id=1)
+        assert (await service.get_session(session_id, 1))["complete"] is True
+        
+        with await service.open_assembled(session_id, staff_id=1) as f:
+            assert f.read() == content
+            f.seek(-4, os.SEEK_END)
+            assert f.read(3) == b"hij"
+        
+        # Assembly reads the chunks in place instead of writing a copy
+        assert sorted(os.listdir(service._session_dir(session_id))) == [
+            "000000.chunk", "000001.chunk", "000002.chunk", service.MANIFEST
+        ]
+    
+    async def test_bad_checksum_keeps_previous_chunk(self, temp_upload_dir):
+        """Test that a corrupt retransmission does not replace a verified chunk."""
+        service = UploadSessionService(upload_dir=temp_upload_dir)
+        session = await service.create_session("scan.pdf", 4, staff_id=1)
+        session_id = session["session_id"]
+        
+        await service.write_chunk(session_id, 0, _body(b"%PDF"), _sha(b"%PDF"))
+        
+        with pytest.raises(UploadSessionError) as exc:
+            await service.write_chunk(session_id, 0, _body(b"XXXX"), _sha(b"%PDF"))
+        assert exc.value.status_code == 422
+        
+        stream = await service.stream_assembled(session_id)
+        assert await stream.read(8) == b"%PDF"
+        assert await stream.read(8) == b""
+        stream.close()
+        assert not any(name.endswith(".part") for name in os.listdir(service._session_dir(session_id)))
+    
+    async def test_chunk_size_is_enforced(self, temp_upload_dir):
+        """Test that short and oversized chunks are rejected."""
+        service = UploadSessionService(upload_dir=temp_upload_dir)
+        session = await service.create_session("scan.pdf", 10, staff_id=1, chunk_size=6)
+        session_id = session["session_id"]
+        
+        with pytest.raises(UploadSessionError):
+            await service.write_chunk(session_id, 0, _body(b"12345"), _sha(b"12345"))
+        with pytest.raises(UploadSessionError):
+            await service.write_chunk(session_id, 1, _body(b"12345"), _sha(b"12345"))
+        with pytest.raises(UploadSessionError):
+            await service.write_chunk(session_id, 2, _body(b"1"), _sha(b"1"))
+    
+    async def test_received_chunks_come_from_disk(self, temp_upload_dir):
+        """Test that chunks written by another worker count without a manifest update."""
+        service = UploadSessionService(upload_dir=temp_upload_dir)
+        other_worker = UploadSessionService(upload_dir=temp_upload_dir)
+        session = await service.create_session("scan.pdf", 8, staff_id=1, chunk_size=4)
+        session_id = session["session_id"]
+        
+        await service.write_chunk(session_id, 0, _body(b"%PDF"), _sha(b"%PDF"))
+        await other_worker.write_chunk(session_id, 1, _body(b"-1.4"), _sha(b"-1.4"))
+        
+        assert (await service.get_session(session_id))["received_chunks"] == [0, 1]
+    
+    async def test_session_can_only_be_claimed_once(self, temp_upload_dir):
+        """Test that concurrent finalize calls cannot both assemble a session."""
+        service = UploadSessionService(upload_dir=temp_upload_dir)
+        session = await service.create_session("scan.pdf", 4, staff_id=1)
+        session_id = session["session_id"]
+        await service.write_chunk(session_id, 0, _body(b"%PDF"), _sha(b"%PDF"))
+        
+        claimed = await service.claim(session_id, staff_id=1)
+        assert claimed["complete"] is True
+        
+        with pytest.raises(UploadSessionError) as exc:
+            await service.claim(session_id, staff_id=1)
+        assert exc.value.status_code == 409
+        with pytest.raises(UploadSessionError) as exc:
+            await service.write_chunk(session_id, 0, _body(b"%PDF"), _sha(b"%PDF"))
+        assert exc.value.status_code == 409
+        
+        await service.release(session_id)
+        await service.claim(session_id, staff_id=1)
+    
+    async def test_sessions_are_private_to_their_owner(self, temp_upload_dir):
+        """Test that another staff member cannot see or touch a session."""
+        service = UploadSessionService(upload_dir=temp_upload_dir)
+        session = await service.create_session("scan.pdf", 4, staff_id=1)
+        
+        with pytest.raises(UploadSessionError) as exc:
+            await service.get_session(session["session_id"], staff_id=2)
+        assert exc.value.status_code == 404
+        
+        with pytest.raises(UploadSessionError):
+            await service.get_session("../../etc", staff_id=1)
+    
+    async def test_expired_sessions_are_purged(self, temp_upload_dir):
+        """Test that stale sessions are removed when new ones are created."""
+        service = UploadSessionService(upload_dir=temp_upload_dir)
+        old = await service.create_session("old.pdf", 4, staff_id=1)
+        
+        manifest_path = os.path.join(service._session_dir(old["session_id"]), service.MANIFEST)
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        manifest["updated_at"] = (datetime.utcnow() - timedelta(days=30)).isoformat()
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+        
+        await service.create_session("new.pdf", 4, staff_id=1)
+        
+        assert old["session_id"] not in os.listdir(service.root)